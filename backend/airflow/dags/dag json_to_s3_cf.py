@@ -29,31 +29,47 @@ default_args = {
 )
 
 def etl():
+    ## fact_kpis is downloaded once per run, the tasks that need it load the local snapshot of the run (tasks run on the same machine)
     @task()
-    def run_create_chain_details():
+    def run_create_snapshot(run_id=None):
         import os
         db_connector = DbConnector()
 
         json_creator = JSONCreation(os.getenv("S3_CF_BUCKET"), os.getenv("CF_DISTRIBUTION_ID"), db_connector, api_version)
-        df = json_creator.get_all_data()
+        return json_creator.create_snapshot(os.getenv("KPI_SNAPSHOT_DIR", f"/home/{sys_user}/gtp/backend/output/snapshots"), run_id)
+
+    ## runs once all snapshot tasks are done (also if they failed), a cleared task of this run then needs the snapshot task to be cleared as well
+    @task(trigger_rule='all_done')
+    def run_cleanup_snapshots(snapshot_path:str):
+        import os
+        json_creator = JSONCreation(os.getenv("S3_CF_BUCKET"), os.getenv("CF_DISTRIBUTION_ID"), None, api_version)
+        json_creator.cleanup_snapshots(os.getenv("KPI_SNAPSHOT_DIR", f"/home/{sys_user}/gtp/backend/output/snapshots"), snapshot_path)
+
+    @task()
+    def run_create_chain_details(snapshot_path:str):
+        import os
+        db_connector = DbConnector()
+
+        json_creator = JSONCreation(os.getenv("S3_CF_BUCKET"), os.getenv("CF_DISTRIBUTION_ID"), db_connector, api_version)
+        df = json_creator.load_snapshot(snapshot_path)
         json_creator.create_chain_details_jsons(df)
 
     @task()
-    def run_create_metrics_details():
+    def run_create_metrics_details(snapshot_path:str):
         import os
         db_connector = DbConnector()
 
         json_creator = JSONCreation(os.getenv("S3_CF_BUCKET"), os.getenv("CF_DISTRIBUTION_ID"), db_connector, api_version)
-        df = json_creator.get_all_data()
+        df = json_creator.load_snapshot(snapshot_path)
         json_creator.create_metric_details_jsons(df)
 
     @task()
-    def run_create_landingpage():
+    def run_create_landingpage(snapshot_path:str):
         import os
         db_connector = DbConnector()
 
         json_creator = JSONCreation(os.getenv("S3_CF_BUCKET"), os.getenv("CF_DISTRIBUTION_ID"), db_connector, api_version)
-        df = json_creator.get_all_data()
+        df = json_creator.load_snapshot(snapshot_path)
         json_creator.create_landingpage_json(df)
 
     @task()
@@ -65,12 +81,12 @@ def etl():
         json_creator.create_master_json()
 
     @task()
-    def run_create_fundamentals():
+    def run_create_fundamentals(snapshot_path:str):
         import os
         db_connector = DbConnector()
 
         json_creator = JSONCreation(os.getenv("S3_CF_BUCKET"), os.getenv("CF_DISTRIBUTION_ID"), db_connector, api_version)
-        df = json_creator.get_all_data()
+        df = json_creator.load_snapshot(snapshot_path)
         json_creator.create_fundamentals_json(df)
 
     @task()
@@ -97,11 +113,15 @@ def etl():
         blockspace_json_creator = BlockspaceJSONCreation(os.getenv("S3_CF_BUCKET"), os.getenv("CF_DISTRIBUTION_ID"), db_connector, api_version)
         blockspace_json_creator.create_blockspace_comparison_json()    
 
-    run_create_chain_details()
-    run_create_metrics_details()
-    run_create_landingpage()
+    snapshot_path = run_create_snapshot()
+    snapshot_tasks = [
+        run_create_chain_details(snapshot_path),
+        run_create_metrics_details(snapshot_path),
+        run_create_landingpage(snapshot_path),
+        run_create_fundamentals(snapshot_path),
+    ]
+    snapshot_tasks >> run_cleanup_snapshots(snapshot_path)
     run_create_master()
-    run_create_fundamentals()
     run_create_contracts()
     run_create_blockspace_overview()
     run_create_blockspace_category_comparison()
@@ -23,12 +23,12 @@ default_args = {
     dag_id = 'dag_cross_check_v02',
     description = 'Load txcount data from explorers',
     start_date = datetime(2023,12,9),
-    schedule = '30 06 * * *'
+    schedule = '30 * * * *'
 )
 
 def etl():
     @task()
-    def run_explorers():
+    def run_explorers(data_interval_end=None):
         adapter_params = {
         }
 
@@ -44,8 +44,8 @@ def etl():
         # load
         ad.load(df)
 
-        ## cross-check and send Discord message
-        ad.cross_check()
+        ## cross-check every hour, but only send the Discord message once per day (manual runs without a data interval don't notify)
+        ad.cross_check(notify = data_interval_end is not None and data_interval_end.hour == 6)
     
     run_explorers()
 
@@ -8,6 +8,11 @@ sys.path.append(f"/home/{sys_user}/gtp/backend/")
 from airflow.decorators import dag, task 
 from src.db_connector import DbConnector
 from src.adapters.adapter_sql import AdapterSQL
+from src.adapters.mapping import adapter_mapping
+from src.misc.query_profiler import profile_report
+
+## every chain gets its own blockspace task, at most 4 of them run at the same time
+blockspace_chains = [chain.origin_key for chain in adapter_mapping if chain.aggregate_blockspace == True]
 
 default_args = {
     'owner' : 'mseidl',
@@ -28,8 +33,28 @@ default_args = {
 def etl():
 
     @task()
-    def run_metrics():
+    def run_rollup():
         adapter_params = {
+            'user_base_exact' : True, ## also maintain the exact address bitmaps for user_base
+        }
+        load_params = {
+            'load_type' : 'rollup', ## refresh chain_daily_rollup for all days with new blocks
+            'days' : 'auto', ## not used, the days to refresh are derived from the newly loaded blocks
+            'origin_keys' : None, ## origin_keys as list or None
+        }
+
+       # initialize adapter
+        db_connector = DbConnector()
+        ad = AdapterSQL(adapter_params, db_connector)
+        with profile_report():
+            # extract
+            ad.extract(load_params)
+
+    @task()
+    def run_metrics(run_rollup:str):
+        adapter_params = {
+            'threads' : 8, ## chains that are aggregated concurrently (engine pool size is 20)
+            'user_base_exact' : True, ## exact user_base from the address bitmaps instead of the HLL estimates
         }
         load_params = {
             'load_type' : 'metrics', ## load metrics such as imx txcount, daa, fees paid and user_base metric
@@ -41,10 +66,11 @@ def etl():
        # initialize adapter
         db_connector = DbConnector()
         ad = AdapterSQL(adapter_params, db_connector)
-        # extract
-        df = ad.extract(load_params)
-        # # load
-        ad.load(df)
+        with profile_report():
+            # extract
+            df = ad.extract(load_params)
+            # # load
+            ad.load(df)
 
     @task()
     def run_profit(run_metrics:str):
@@ -60,10 +86,11 @@ def etl():
        # initialize adapter
         db_connector = DbConnector()
         ad = AdapterSQL(adapter_params, db_connector)
-        # extract
-        df = ad.extract(load_params)
-        # # load
-        ad.load(df)
+        with profile_report():
+            # extract
+            df = ad.extract(load_params)
+            # # load
+            ad.load(df)
 
     @task()
     def run_usd_to_eth(run_profit:str):
@@ -72,6 +99,7 @@ def etl():
         load_params = {
             'load_type' : 'usd_to_eth',
             'days' : 5000, ## days as int
+            'only_changed' : True, ## only upsert eth values whose usd value or eth price changed, False for a full recompute
             'origin_keys' : None, ## origin_keys as list or None
             'metric_keys' : None, ## metric_keys as list or None
         }
@@ -79,32 +107,42 @@ def etl():
        # initialize adapter
         db_connector = DbConnector()
         ad = AdapterSQL(adapter_params, db_connector)
-        # extract
-        df = ad.extract(load_params)
-        # # load
-        ad.load(df)
+        with profile_report():
+            # extract
+            df = ad.extract(load_params)
+            # # load
+            ad.load(df)
 
+    ## the label tracking tables are created once before the chains are aggregated in parallel
     @task()
-    def run_blockspace():
+    def create_blockspace_tables():
+        db_connector = DbConnector()
+        db_connector.create_blockspace_label_tracking()
+
+    @task(max_active_tis_per_dag=4)
+    def run_blockspace(origin_key:str):
         db_connector = DbConnector()
 
         adapter_params = {
+            'threads' : 1, ## one chain per task
         }
 
         load_params = {
             'load_type' : 'blockspace', ## usd_to_eth or metrics or blockspace
             'days' : 'auto', ## days as or auto
-            'origin_keys' : None, ## origin_keys as list or None
+            'origin_keys' : [origin_key], ## origin_keys as list or None
+            'create_tables' : False, ## created by create_blockspace_tables
         }
 
         # initialize adapter
         ad = AdapterSQL(adapter_params, db_connector)
 
-        # extract
-        ad.extract(load_params)
+        with profile_report(origin_key):
+            # extract
+            ad.extract(load_params)
 
-    run_usd_to_eth(run_profit(run_metrics()))    
-    run_blockspace()
+    run_usd_to_eth(run_profit(run_metrics(run_rollup())))    
+    create_blockspace_tables() >> run_blockspace.expand(origin_key=blockspace_chains)
 
 etl()
 
@@ -0,0 +1,44 @@
+from datetime import datetime,timedelta
+import getpass
+sys_user = getpass.getuser()
+
+import sys
+sys.path.append(f"/home/{sys_user}/gtp/backend/")
+
+from airflow.decorators import dag, task
+from src.db_connector import DbConnector
+from src.queries.sql_queries import rollup_chains
+
+default_args = {
+    'owner' : 'mseidl',
+    'retries' : 1,
+    'email' : ['matthias@orbal-analytics.com'],
+    'email_on_failure': True,
+    'retry_delay' : timedelta(minutes=5)
+}
+
+## Maintenance of the monthly partitioned {chain}_tx tables
+## Chains are migrated manually (db_connector.migrate_tx_table('{chain}_tx')), this DAG only makes sure that
+## the partitions of the current and the next month exist for all migrated tables before the loaders need them.
+@dag(
+    default_args=default_args,
+    dag_id = 'dag_tx_partitions',
+    description = 'Create upcoming monthly partitions of the tx tables.',
+    start_date = datetime(2023,11,1),
+    schedule = '00 02 25 * *'
+)
+
+def etl():
+    @task()
+    def create_partitions():
+        db_connector = DbConnector()
+        today = datetime.today().date()
+        for chain in rollup_chains:
+            table_name = f"{chain}_tx"
+            if db_connector.is_partitioned(table_name):
+                db_connector.create_tx_partitions(table_name, today, today + timedelta(days=31))
+            else:
+                print(f"...{table_name} is not partitioned yet")
+
+    create_partitions()
+etl()
@@ -1,9 +1,10 @@
-import time
 import pandas as pd
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from src.adapters.abstract_adapters import AbstractAdapter
 from src.adapters.mapping import adapter_mapping
-from src.misc.helper_functions import api_get_call, return_projects_to_load, check_projects_to_load, get_df_kpis, upsert_to_kpis, get_missing_days_kpis
+from src.misc.helper_functions import api_get_call, return_projects_to_load, check_projects_to_load, get_df_kpis, upsert_to_kpis, get_missing_days_kpis, RateLimiter
 from src.misc.helper_functions import print_init, print_load, print_extract
 
 ##ToDos: 
@@ -13,18 +14,23 @@ class AdapterCoingecko(AbstractAdapter):
     """
     adapter_params require the following fields
         none
+    optional fields:
+        calls_per_minute:int - shared rate limit for all coingecko calls of this adapter (default 30)
+        threads:int - number of concurrent requests (default 4)
     """
     def __init__(self, adapter_params:dict, db_connector):
         super().__init__("Coingecko", adapter_params, db_connector)
         self.base_url = 'https://api.coingecko.com/api/v3/coins/'
         self.projects = [x for x in adapter_mapping if x.coingecko_naming is not None]
+        self.rate_limiter = RateLimiter(adapter_params.get('calls_per_minute', 30)) ## only 10-50 calls allowed per minute with free tier
+        self.threads = adapter_params.get('threads', 4)
         print_init(self.name, self.adapter_params)
 
     """
     load_params require the following fields:
         metric_keys:list - list of metrics that should be loaded. E.g. prices, total_volumes, market_cap
         origin_keys:list - the projects that this metric should be loaded for. If None, all available projects will be loaded
-        days:str - days of historical data that should be loaded, starting from today. Can be set to 'max'
+        days:str - days of historical data that should be loaded, starting from today. Can be set to 'max' or 'auto' (only load missing days based on fact_kpis)
         vs_currencies:list - list of currencies that we load financials for. E.g. eth, usd
         load_type:str - can be project or imx_tokens 
     """
@@ -73,38 +79,51 @@ class AdapterCoingecko(AbstractAdapter):
 
     ## ----------------- Helper functions --------------------
 
+    ## market_chart returns prices, volumes and market caps in one response, so one call per coin and currency is enough
+    def get_market_chart(self, naming, currency, days):
+        url = f"{self.base_url}{naming}/market_chart?vs_currency={currency}&days={days}&interval=daily"
+        return api_get_call(url, sleeper=10, retries=20, rate_limiter=self.rate_limiter)
+
+    ## runs all market_chart calls concurrently, the rate limiter makes sure that we stay within the API limits
+    def get_market_charts(self, calls:list):
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            responses = list(executor.map(lambda c: self.get_market_chart(*c), calls))
+        return responses
+
     def extract_projects(self, projects_to_load, vs_currencies, days, base_url, metric_keys):
-        dfMain = get_df_kpis()
+        response_keys = {'price': 'prices', 'volume': 'total_volumes', 'market_cap': 'market_caps'}
+
+        ## determine the missing date range per project and currency (watermark in fact_kpis)
+        calls = []
+        request_meta = []
         for adapter_mapping in projects_to_load:
             origin_key = adapter_mapping.origin_key
-            naming = adapter_mapping.coingecko_naming
-            if days == 'auto':
-                day_val = get_missing_days_kpis(self.db_connector, metric_key= 'price_usd', origin_key=origin_key)
-
             for currency in vs_currencies:
-                url = f"{base_url}{naming}/market_chart?vs_currency={currency}&days={day_val}&interval=daily"
-                response_json = api_get_call(url, sleeper=10, retries=20)
-
-                dfAllFi = pd.json_normalize(response_json)
-                for fi in metric_keys:
-                    match fi:
-                        case 'price':
-                            series = dfAllFi['prices'].explode()
-                        case 'volume':
-                            series = dfAllFi['total_volumes'].explode()
-                        case 'market_cap':
-                            series = dfAllFi['market_caps'].explode()
-                    df = pd.DataFrame(columns = ['date', 'value'], data = series.to_list())
-                    df['date'] = pd.to_datetime(df['date'],unit='ms')
-                    df['date'] = df['date'].dt.date
-                    df['metric_key'] = f"{fi}_{currency}"
-                    df['origin_key'] = origin_key
-                    max_date = df['date'].max()
-                    df.drop(df[df.date == max_date].index, inplace=True)
-                    df.value.fillna(0, inplace=True)
-                    dfMain = pd.concat([dfMain,df])
-                    print(f"...{self.name} {origin_key} done for {currency} and {fi}. Shape: {df.shape}")
-                time.sleep(5) #only 10-50 calls allowed per minute with free tier
+                if days == 'auto':
+                    day_val = get_missing_days_kpis(self.db_connector, metric_key= f'price_{currency}', origin_key=origin_key)
+                else:
+                    day_val = days
+                calls.append((adapter_mapping.coingecko_naming, currency, day_val))
+                request_meta.append((origin_key, currency))
+
+        responses = self.get_market_charts(calls)
+
+        dfs = [get_df_kpis()]
+        for (origin_key, currency), response_json in zip(request_meta, responses):
+            for fi in metric_keys:
+                df = pd.DataFrame(response_json[response_keys[fi]], columns=['date', 'value'])
+                df['metric_key'] = f"{fi}_{currency}"
+                df['origin_key'] = origin_key
+                dfs.append(df)
+            print(f"...{self.name} {origin_key} done for {currency} and {metric_keys}.")
+
+        dfMain = pd.concat(dfs, ignore_index=True)
+        dfMain['date'] = pd.to_datetime(dfMain['date'], unit='ms').dt.date
+
+        ## drop the latest (incomplete) day of each series
+        max_dates = dfMain.groupby(['metric_key', 'origin_key'])['date'].transform('max')
+        dfMain = dfMain[dfMain['date'] != max_dates].copy()
+        dfMain['value'] = dfMain['value'].fillna(0)
 
         dfMain.set_index(['metric_key', 'origin_key', 'date'], inplace=True)
         return dfMain
@@ -126,26 +145,32 @@ class AdapterCoingecko(AbstractAdapter):
     def extract_imx_tokens(self):
         df_tokens = self.get_imx_tokens(self.db_connector)
 
-        dfMain = pd.DataFrame()
-        ## iterate over all tokens
-        for index, row in df_tokens.iterrows():
-            print(f"... loading price for {row['symbol']} with coingecko_id {row['coingecko_id']}")
-            url = f"https://api.coingecko.com/api/v3/coins/{row['coingecko_id']}/market_chart?vs_currency=usd&days=2000&interval=daily"
-            response = api_get_call(url)
+        ## only load the days that are missing in prices_daily (per token watermark), 2000 days for new tokens
+        max_dates = self.db_connector.get_prices_daily_max_dates()
+        today = datetime.today().date()
+        df_tokens['days'] = [
+            (today - max_dates[symbol]).days + 5 if max_dates.get(symbol) is not None else 2000
+            for symbol in df_tokens['symbol']
+        ]
+
+        ## tokens that share the same coingecko_id are only requested once
+        df_ids = df_tokens.groupby('coingecko_id', as_index=False)['days'].max()
+        print(f"... loading prices for {df_ids.shape[0]} coingecko_ids ({df_tokens.shape[0]} tokens)")
+        responses = self.get_market_charts([(row.coingecko_id, 'usd', row.days) for row in df_ids.itertuples()])
+
+        dfs = []
+        for coingecko_id, response in zip(df_ids['coingecko_id'], responses):
             df = pd.DataFrame(response['prices'], columns=['timestamp', 'price'])
-            df['token_symbol'] = row['symbol']
-            df['token_address'] = row['token_address']
+            df['coingecko_id'] = coingecko_id
+            dfs.append(df)
+        dfPrices = pd.concat(dfs, ignore_index=True)
 
-            dfMain = pd.concat([dfMain, df])
-            time.sleep(5)
+        dfMain = df_tokens[['symbol', 'token_address', 'coingecko_id']].merge(dfPrices, on='coingecko_id', how='inner')
+        dfMain.rename(columns={'symbol': 'token_symbol', 'price': 'price_usd'}, inplace=True)
 
         ## unix timestamp to date
-        dfMain['date'] = pd.to_datetime(dfMain['timestamp'], unit='ms')
-        dfMain['date'] = dfMain['date'].dt.date
-        dfMain.drop(columns=['timestamp'], inplace=True)
-
-        ##change column price to price_usd
-        dfMain.rename(columns={'price': 'price_usd'}, inplace=True)
+        dfMain['date'] = pd.to_datetime(dfMain['timestamp'], unit='ms').dt.date
+        dfMain = dfMain[['date', 'token_symbol', 'token_address', 'price_usd']]
 
         ## drop duplicates in date and token_symbol
         dfMain.drop_duplicates(subset=['date', 'token_symbol'], inplace=True)
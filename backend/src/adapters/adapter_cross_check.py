@@ -1,12 +1,12 @@
-import time
 import pandas as pd
 import os
 import io
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from src.adapters.abstract_adapters import AbstractAdapter
 from src.adapters.mapping import adapter_mapping
-from src.misc.helper_functions import return_projects_to_load, upsert_to_kpis, check_projects_to_load, api_get_call
+from src.misc.helper_functions import return_projects_to_load, upsert_to_kpis, check_projects_to_load, api_get_call, RateLimiter
 from src.misc.helper_functions import print_init, print_load
 from src.misc.discord_utils import send_discord_message
 
@@ -17,6 +17,9 @@ class AdapterCrossCheck(AbstractAdapter):
     """
     adapter_params require the following fields
         none
+    optional fields:
+        calls_per_minute:dict - rate limit per block explorer type, e.g. {'etherscan': 10} (defaults below)
+        threads:int - number of concurrent explorer requests (default 4)
     """
     def __init__(self, adapter_params:dict, db_connector):
         super().__init__("Cross-Check", adapter_params, db_connector)
@@ -27,6 +30,12 @@ class AdapterCrossCheck(AbstractAdapter):
         self.proxy =  {
             'https': os.getenv('PROXY'),
         }
+        ## one rate limiter per explorer type, all projects on the same explorer type share it
+        calls_per_minute = {'etherscan': 10, 'blockscout': 30, 'l2beat': 10}
+        calls_per_minute.update(adapter_params.get('calls_per_minute', {}))
+        self.rate_limiters = {k: RateLimiter(v) for k, v in calls_per_minute.items()}
+        self.threads = adapter_params.get('threads', 4)
+        self.metric_key = 'txcount_explorer'
         print_init(self.name, self.adapter_params)
 
     """
@@ -39,97 +48,105 @@ class AdapterCrossCheck(AbstractAdapter):
         check_projects_to_load(self.projects, origin_keys)
         projects_to_load = return_projects_to_load(self.projects, origin_keys)
 
-        dfMain = pd.DataFrame()
-        metric_key = 'txcount_explorer'
-
-        for project in projects_to_load:
-            print(f"... loading {project.origin_key} txcount data from explorer ({project.block_explorer_type})...")
-            
-            if project.block_explorer_type == 'etherscan':
-                response = api_get_call(project.block_explorer_txcount, header = self.headers, as_json=False, proxy=self.proxy)
-                
-                data = io.StringIO(response)
-                df = pd.read_csv(data)
-
-                df['date'] = pd.to_datetime(df['Date(UTC)'])
-                df['metric_key'] = metric_key
-                df['origin_key'] = project.origin_key
-                df.rename(columns={'Value': 'value'}, inplace=True)
-                df = df[['date', 'metric_key', 'origin_key', 'value']]
-
-                dfMain = pd.concat([dfMain, df], ignore_index=True)
-
-            elif project.block_explorer_type == 'blockscout':
-                response = api_get_call(project.block_explorer_txcount, header = self.headers, proxy=self.proxy)
-                df = pd.DataFrame(response['chart_data'])
-
-                df['date'] = pd.to_datetime(df['date'])
-                df['metric_key'] = metric_key
-                df['origin_key'] = project.origin_key
-                df.rename(columns={'tx_count': 'value'}, inplace=True)
-                df = df[['date', 'metric_key', 'origin_key', 'value']]
-
-                dfMain = pd.concat([dfMain, df], ignore_index=True)        
-
-            elif project.block_explorer_type == 'l2beat':
-                response_json = api_get_call(project.block_explorer_txcount, sleeper=10, retries=20)
-                df = pd.json_normalize(response_json['daily'], record_path=['data'], sep='_')
-
-                ## only keep the columns 0 (date) and 1 (transactions)
-                df = df.iloc[:,[0,1]]
-
-                df['date'] = pd.to_datetime(df[0],unit='s').dt.date
-                df.drop(df[df[1] == 0].index, inplace=True)
-                df.drop([0], axis=1, inplace=True)
-                df.rename(columns={1:'value'}, inplace=True)
-                df['metric_key'] = metric_key
-                df['origin_key'] = project.origin_key
-
-                dfMain = pd.concat([dfMain, df], ignore_index=True)  
-
-            else:
-                print(f'not implemented {project.block_explorer_type}')
-                raise ValueError('Block Explorer Type not supported')
-            
-            time.sleep(1)
-        
-        today = datetime.today().strftime('%Y-%m-%d')
-        dfMain.drop(dfMain[dfMain.date == today].index, inplace=True, errors='ignore')
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            dfs = list(executor.map(self.extract_project, projects_to_load))
+
+        dfMain = pd.concat(dfs, ignore_index=True)
         dfMain.value.fillna(0, inplace=True)
 
         dfMain.set_index(['date', 'origin_key', 'metric_key'], inplace=True)
         return dfMain
 
     def load(self, df:pd.DataFrame):
+        if df.shape[0] == 0:
+            print(f"...no new {self.metric_key} data to load")
+            return
         upserted, tbl_name = upsert_to_kpis(df, self.db_connector)
-        print_load(self.name, upserted, tbl_name)     
-
-    def cross_check(self):
-        webhook_url = os.getenv('DISCORD_TX_CHECKER')
-
-        exec_string = """
-            with temp as (
-            SELECT 
-                origin_key,
-                SUM(case when metric_key = 'txcount_raw' then value end) as raw,
-                SUM(case when metric_key = 'txcount_explorer' then value end) as explorer
+        print_load(self.name, upserted, tbl_name)
+
+    ## ----------------- Helper functions --------------------
+
+    ## downloads and parses the txcount chart of one project, only days from the last txcount_explorer entry onwards are kept
+    def extract_project(self, project):
+        print(f"... loading {project.origin_key} txcount data from explorer ({project.block_explorer_type})...")
+        if project.block_explorer_type not in ['etherscan', 'blockscout', 'l2beat']:
+            print(f'not implemented {project.block_explorer_type}')
+            raise ValueError('Block Explorer Type not supported')
+        rate_limiter = self.rate_limiters[project.block_explorer_type]
+
+        if project.block_explorer_type == 'etherscan':
+            response = api_get_call(project.block_explorer_txcount, header = self.headers, as_json=False, proxy=self.proxy, rate_limiter=rate_limiter)
+            df = pd.read_csv(io.StringIO(response), usecols=['Date(UTC)', 'Value'])
+            df.columns = ['date', 'value']
+            df['date'] = pd.to_datetime(df['date']).dt.date
+
+        elif project.block_explorer_type == 'blockscout':
+            response = api_get_call(project.block_explorer_txcount, header = self.headers, proxy=self.proxy, rate_limiter=rate_limiter)
+            df = pd.DataFrame(response['chart_data'], columns=['date', 'tx_count'])
+            df.columns = ['date', 'value']
+            df['date'] = pd.to_datetime(df['date']).dt.date
+
+        elif project.block_explorer_type == 'l2beat':
+            response_json = api_get_call(project.block_explorer_txcount, sleeper=10, retries=20, rate_limiter=rate_limiter)
+            ## only keep the columns 0 (date) and 1 (transactions)
+            df = pd.DataFrame([row[:2] for row in response_json['daily']['data']], columns=['date', 'value'])
+            df = df[df['value'] != 0]
+            df['date'] = pd.to_datetime(df['date'], unit='s').dt.date
+
+        ## incremental: the last loaded day is loaded again (explorers can still update it), older days are skipped
+        last_date = self.db_connector.get_max_date(self.metric_key, project.origin_key)
+        if last_date is not None:
+            df = df[df['date'] >= last_date]
+        ## today is incomplete
+        df = df[df['date'] < datetime.today().date()].copy()
+
+        df['metric_key'] = self.metric_key
+        df['origin_key'] = project.origin_key
+        print(f"...{project.origin_key}: {df.shape[0]} new days since {last_date}")
+        return df[['date', 'metric_key', 'origin_key', 'value']]
+
+    ## returns the explorer vs raw txcount discrepancy for every chain and every sliding window that ends in the last `days` days
+    def get_discrepancies(self, days:int=7, window:int=7):
+        exec_string = f"""
+            SELECT date, origin_key, metric_key, value
             FROM fact_kpis 
-            WHERE metric_key in ('txcount_raw', 'txcount_explorer')
+            WHERE metric_key in ('txcount_raw', '{self.metric_key}')
             and date < date_trunc('day', NOW()) 
-            and date >= date_trunc('day',now()) - interval '7 days' 
-            group by 1
-        )
-
-        select 
-            *, 
-            explorer - raw as diff,
-            (explorer - raw) / explorer as diff_percent
-            from temp
+            and date >= date_trunc('day',now()) - interval '{days + window - 1} days' 
         """
-
         df = pd.read_sql(exec_string, self.db_connector.engine.connect())
+        df['date'] = pd.to_datetime(df['date'])
+
+        ## one column per metric and chain, one row per day (missing days count as 0 in the window sums)
+        dates = pd.date_range(end=pd.Timestamp.today().normalize() - timedelta(days=1), periods=days + window - 1)
+        df = df.pivot_table(index='date', columns=['metric_key', 'origin_key'], values='value', aggfunc='sum').reindex(dates)
+        sums = df.rolling(window, min_periods=1).sum().iloc[window - 1:]
+
+        raw = sums['txcount_raw'] if 'txcount_raw' in sums else pd.DataFrame(index=sums.index)
+        explorer = sums[self.metric_key] if self.metric_key in sums else pd.DataFrame(index=sums.index)
+        raw, explorer = raw.align(explorer, join='outer')
+        ## explorers that report 0 (or nothing) for a window are treated as missing instead of a 100% (inf) discrepancy
+        explorer = explorer.where(explorer > 0)
+
+        df = pd.DataFrame({
+            'raw': raw.stack(dropna=False),
+            'explorer': explorer.stack(dropna=False),
+        })
+        df['diff'] = df['explorer'] - df['raw']
+        df['diff_percent'] = df['diff'] / df['explorer']
+        df.index.names = ['window_end', 'origin_key']
+        return df.reset_index()
+
+    def cross_check(self, notify:bool=True, threshold:float=0.02):
+        webhook_url = os.getenv('DISCORD_TX_CHECKER')
+
+        df = self.get_discrepancies()
+        ## alert on the latest complete 7-day window
+        df = df[df['window_end'] == df['window_end'].max()]
+        df = df[df['diff_percent'] > threshold]
 
-        for index, row in df.iterrows():
-            if row['diff_percent'] > 0.02:
-                send_discord_message(f"txcount discrepancy in last 7 days for {row['origin_key']}: {row['diff_percent'] * 100:.2f}% ({int(row['diff'])} tx)", webhook_url)
-                print(f"txcount discrepancy for {row['origin_key']}: {row['diff_percent'] * 100:.2f}% ({int(row['diff'])})")
\ No newline at end of file
+        for row in df.itertuples():
+            message = f"txcount discrepancy in last 7 days for {row.origin_key}: {row.diff_percent * 100:.2f}% ({int(row.diff)} tx)"
+            print(message)
+            if notify:
+                send_discord_message(message, webhook_url)
@@ -1,11 +1,14 @@
 import time
 import pandas as pd
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
 
 from src.adapters.abstract_adapters import AbstractAdapter
 
 from src.queries.dune_queries import dune_queries
 from dune_client.client import DuneClient
 from dune_client.types import QueryParameter
+from dune_client.models import ExecutionState
 
 from src.misc.helper_functions import upsert_to_kpis, get_df_kpis
 from src.misc.helper_functions import print_init, print_load, print_extract
@@ -14,10 +17,16 @@ from src.misc.helper_functions import print_init, print_load, print_extract
 class AdapterDune(AbstractAdapter):
     """
     adapter_params require the following fields:
+        api_key:str - Dune API key
+    optional fields:
+        reuse_hours:int - reuse the latest execution of a query if it ran with the same parameters within the last x hours (default 6, 0 to always execute)
+        ping_frequency:int - seconds between two status polls of the running executions (default 5)
     """
     def __init__(self, adapter_params:dict, db_connector):
         super().__init__("Dune", adapter_params, db_connector)
         self.api_key = adapter_params['api_key']
+        self.reuse_hours = adapter_params.get('reuse_hours', 6)
+        self.ping_frequency = adapter_params.get('ping_frequency', 5)
 
         self.client = DuneClient(self.api_key)
         print_init(self.name, self.adapter_params)
@@ -62,9 +71,34 @@ class AdapterDune(AbstractAdapter):
         
         return df
 
-    def extract_data(self, queries_to_load, days):
-        dfMain = get_df_kpis()
+    ## returns the execution_id of the latest completed execution with the same parameters if it is younger than reuse_hours
+    ## the latest results endpoint is only asked for its first row (to get the execution_id), freshness is checked with the
+    ## execution status and the full result is downloaded once as csv in extract_data
+    def get_reusable_execution(self, query):
+        if self.reuse_hours == 0:
+            return None
+        params = {f"params.{p.key}": p.to_dict()["value"] for p in query.parameters()}
+        params['limit'] = 1
+        try:
+            ## DuneClient.get_latest_result has no limit parameter, so the route is called directly
+            latest = self.client._get(route=f"/query/{query.query_id}/results", params=params)
+            status = self.client.get_status(latest['execution_id'])
+        except Exception as e:
+            print(f"...no latest execution available for {query.name}: {e}")
+            return None
+        if status.state != ExecutionState.COMPLETED or status.times.execution_ended_at is None:
+            return None
+        if datetime.now(timezone.utc) - status.times.execution_ended_at > timedelta(hours=self.reuse_hours):
+            return None
+        return status.execution_id
+
+    def get_result_df(self, execution_id):
+        response = self.client.get_result_csv(execution_id)
+        return pd.read_csv(BytesIO(response.data.getvalue()))
 
+    def extract_data(self, queries_to_load, days):
+        ## submit all queries at once (or reuse recent executions), Dune runs them in parallel
+        executions = {}
         for query in queries_to_load:
             if days == 'auto':
                 if query.name in ['waa', 'maa']:
@@ -76,13 +110,30 @@ class AdapterDune(AbstractAdapter):
 
             query.params = [QueryParameter.text_type(name="Days", value=str(day_val))]
 
-            print(f"...start loading {query.name} with query_id: {query.query_id} and params: {query.params}")
-            df = self.client.refresh_into_dataframe(query)
-
-            df = self.prepare_df(df)
-            print(f"...finished loading {query.name}. Loaded {df.shape[0]} rows")
-            dfMain = pd.concat([dfMain,df])
-            time.sleep(1)
-
+            execution_id = self.get_reusable_execution(query)
+            if execution_id is not None:
+                print(f"...reusing latest execution {execution_id} of {query.name} with params: {query.params}")
+            else:
+                execution_id = self.client.execute(query).execution_id
+                print(f"...submitted {query.name} with query_id: {query.query_id} and params: {query.params}. Execution: {execution_id}")
+            executions[execution_id] = query
+
+        ## poll all running executions together and process each result as soon as it is ready
+        dfs = [get_df_kpis()]
+        while len(executions) > 0:
+            for execution_id, query in list(executions.items()):
+                status = self.client.get_status(execution_id)
+                if status.state == ExecutionState.COMPLETED:
+                    df = self.prepare_df(self.get_result_df(execution_id))
+                    print(f"...finished loading {query.name}. Loaded {df.shape[0]} rows")
+                    dfs.append(df)
+                    del executions[execution_id]
+                elif status.state in ExecutionState.terminal_states():
+                    print(f"Dune execution {execution_id} of {query.name} ended with state {status.state}")
+                    raise ValueError(f"Dune query {query.name} failed with state {status.state}")
+            if len(executions) > 0:
+                time.sleep(self.ping_frequency)
+
+        dfMain = pd.concat(dfs)
         dfMain.set_index(['metric_key', 'origin_key', 'date'], inplace=True)
         return dfMain
\ No newline at end of file
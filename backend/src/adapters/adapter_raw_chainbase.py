@@ -4,7 +4,7 @@ import pandas as pd
 
 from src.adapters.abstract_adapters import AbstractAdapterRaw
 from src.queries.chainbase_queries import chainbase_raws 
-from src.misc.helper_functions import print_init, dataframe_to_s3, api_post_call
+from src.misc.helper_functions import print_init, dataframe_to_s3, flush_dataframes_to_s3, api_post_call
 
 class AdapterChainbaseRaw(AbstractAdapterRaw):
     """
@@ -36,6 +36,7 @@ class AdapterChainbaseRaw(AbstractAdapterRaw):
 
         ## Trigger queries
         self.trigger_check_extract_queries(self.queries_to_load, self.block_start)
+        flush_dataframes_to_s3()
         print(f"FINISHED loading raw data for {self.keys}.")
 
     ## ----------------- Helper functions --------------------
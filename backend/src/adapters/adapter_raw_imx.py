@@ -4,7 +4,7 @@ from datetime import datetime, timedelta
 
 from src.adapters.abstract_adapters import AbstractAdapterRaw
 from src.misc.helper_functions import api_get_call
-from src.misc.helper_functions import print_init, print_extract_raw, dataframe_to_s3
+from src.misc.helper_functions import print_init, print_extract_raw, dataframe_to_s3, flush_dataframes_to_s3
 
 ##disable pandas warnings
 pd.options.mode.chained_assignment = None
@@ -80,6 +80,7 @@ class AdapterRawImx(AbstractAdapterRaw):
             total_load += type_load
             print(f"... Load for {load_type} finished. Loaded: {type_load} rows.")
         
+        flush_dataframes_to_s3()
         print_extract_raw(self.name, total_load)
         return dfMain
 
@@ -7,7 +7,7 @@ from src.misc.helper_functions import api_post_call, dataframe_to_s3
 from datetime import datetime
 
 from src.adapters.abstract_adapters import AbstractAdapterRaw
-from src.misc.helper_functions import print_init, dataframe_to_s3, api_post_call
+from src.misc.helper_functions import print_init, dataframe_to_s3, flush_dataframes_to_s3, api_post_call
 
 class AdapterRPCRaw(AbstractAdapterRaw):
     """
@@ -53,6 +53,7 @@ class AdapterRPCRaw(AbstractAdapterRaw):
 
         ## Trigger queries and upload data to S3 and database
         self.run(self.block_start, self.batch_size, self.threads)
+        flush_dataframes_to_s3()
         print(f"FINISHED loading raw tx data for {self.chain}.")
 
     ## ----------------- Helper functions --------------------
@@ -4,7 +4,7 @@ import pandas as pd
 from src.adapters.abstract_adapters import AbstractAdapterRaw
 from src.queries.zettablock_queries import zettablock_raws 
 from src.adapters.clients.zettablock_api import ZettaBlock_API
-from src.misc.helper_functions import print_init, dataframe_to_s3
+from src.misc.helper_functions import print_init, dataframe_to_s3, flush_dataframes_to_s3
 
 ##ToDos: 
 # Add days parameter once functionality is available & then also better logic for days to load
@@ -34,6 +34,7 @@ class AdapterZettaBlockRaw(AbstractAdapterRaw):
 
         ## Trigger queries
         df = self.trigger_check_extract_queries(self.queries_to_load, self.block_start, if_exists)
+        flush_dataframes_to_s3()
         return df
 
     ## ----------------- Helper functions --------------------
@@ -1,27 +1,46 @@
 import time
 import pandas as pd
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from src.adapters.abstract_adapters import AbstractAdapter
 from src.adapters.mapping import adapter_mapping
-from src.queries.sql_queries import sql_queries
+from src.queries.sql_queries import sql_queries, rollup_chains, user_base_chains, user_base_metrics
 from src.misc.helper_functions import upsert_to_kpis, get_missing_days_kpis, get_missing_days_blockspace
 from src.misc.helper_functions import print_init, print_load, print_extract, check_projects_to_load
+from src.misc.sketches import get_sketches_df, get_user_base_df, get_period_start, get_fee_digests_df, get_merged_fee_quantiles_df
+from src.misc import address_bitmaps
+from src.misc.query_profiler import query_name
+
+## first day of imx data (backfill start of the imx address bitmaps)
+imx_start_date = datetime(2021, 1, 1).date()
 
 ##ToDos: 
 # Add logs (query execution, execution fails, etc)
 
+## fee quantiles that are stored in chain_daily_rollup (column: quantile)
+fee_quantiles = {'txcosts_median': 0.5, 'txcosts_p10': 0.1, 'txcosts_p90': 0.9}
+
 class AdapterSQL(AbstractAdapter):
     """
     adapter_params require the following fields
+    optional fields:
+        threads:int - number of chains whose queries run concurrently (default 8, must stay below the engine pool size)
+        user_base_exact:bool - maintain exact address bitmaps in the 'rollup' load and use them for user_base instead of the HLL estimates (default False)
+        rollup_recompute_days:int - trailing days of the rollup, sketches and bitmaps that are always recomputed to pick up late blocks (default 5)
     """
     def __init__(self, adapter_params:dict, db_connector):
         super().__init__("SQL Aggregation", adapter_params, db_connector)
+        self.threads = adapter_params.get('threads', 8)
+        self.user_base_exact = adapter_params.get('user_base_exact', False)
+        self.rollup_recompute_days = adapter_params.get('rollup_recompute_days', 5)
         print_init(self.name, self.adapter_params)
 
     """
     load_params require the following fields:
-        load_type:str - can be 'usd_to_eth' or 'metrics' or 'blockspace' or 'profit'
+        load_type:str - can be 'usd_to_eth' or 'metrics' or 'blockspace' or 'profit' or 'rollup'
         days:str - days of historical data that should be loaded, starting from today.
+        only_changed:bool - usd_to_eth only: only load the eth values that changed since the last conversion (default False)
         origin_keys:list - list of origin_keys
         metric_keys:list - the metrics that should be loaded. If None, all available metrics will be loaded
     """
@@ -32,8 +51,9 @@ class AdapterSQL(AbstractAdapter):
 
         ## aggregation types
         if load_type == 'usd_to_eth': ## also make sure to add new metrics in db_connector
-            raw_metrics = ['tvl', 'rent_paid_usd', 'profit_usd', 'fees_paid_usd', 'stables_mcap', 'txcosts_median_usd']
-            df = self.db_connector.get_values_in_eth(raw_metrics, days)
+            raw_metrics = ['tvl', 'rent_paid_usd', 'profit_usd', 'fees_paid_usd', 'stables_mcap', 'txcosts_median_usd', 'txcosts_p10_usd', 'txcosts_p90_usd']
+            ## only_changed: only upsert eth values that differ from the stored ones (set to False for a full recompute)
+            df = self.db_connector.get_values_in_eth(raw_metrics, days, only_changed=load_params.get('only_changed', False))
         elif load_type == 'profit':
             days = load_params['days']
             self.queries_to_load = [x for x in sql_queries if x.metric_key == 'profit_usd']
@@ -59,10 +79,23 @@ class AdapterSQL(AbstractAdapter):
 
             ## Load data
             df = self.extract_data_from_db(self.queries_to_load, days)
+
+            ## multichain user base from the HLL sketches
+            if origin_keys is None or 'multi' in origin_keys:
+                df = pd.concat([df, self.extract_user_base(metric_keys, days)], ignore_index=True)
+
+            ## tx cost quantiles over all L2s from the merged fee digests
+            if origin_keys is None:
+                df = pd.concat([df, self.extract_txcosts_all_l2s(metric_keys, days)], ignore_index=True)
         elif load_type == 'blockspace':
             origin_keys = load_params['origin_keys']
             days = load_params['days']
-            self.run_blockspace_queries(origin_keys, days)
+            create_tables = load_params.get('create_tables', True)
+            self.run_blockspace_queries(origin_keys, days, create_tables)
+            return None
+        elif load_type == 'rollup':
+            origin_keys = load_params['origin_keys']
+            self.run_rollup(origin_keys)
             return None
         else:
             raise ValueError('load_type not supported')
@@ -77,8 +110,34 @@ class AdapterSQL(AbstractAdapter):
         upserted, tbl_name = upsert_to_kpis(df, self.db_connector)
         print_load(self.name, upserted, tbl_name)
 
+    def prepare_df(self, df, metric_key, origin_key):
+        df['date'] = pd.to_datetime(df['day']).dt.date
+        df.drop(['day'], axis=1, inplace=True)
+        df.rename(columns= {'val':'value'}, inplace=True)
+        if 'metric_key' not in df.columns:
+            df['metric_key'] = metric_key
+        if 'origin_key' not in df.columns:
+            df['origin_key'] = origin_key
+        df.value.fillna(0, inplace=True)
+        return df
+
+    def run_query(self, query):
+        print(f"... executing query: {query.metric_key} - {query.origin_key} with {query.query_parameters} days")
+        start = time.time()
+        with self.db_connector.engine.connect() as connection, query_name(f"{query.metric_key}.{query.origin_key}"):
+            df = query.read_df(connection)
+        runtime = time.time() - start
+
+        df = self.prepare_df(df, query.metric_key, query.origin_key)
+        print(f"...query loaded: {query.metric_key} {query.origin_key} with {query.query_parameters} days in {round(runtime, 2)}s. DF shape: {df.shape}")
+        return df, (query.metric_key, query.origin_key, runtime, df.shape[0])
+
+    ## queries of the same chain hit the same tables, so they run one after another
+    def run_query_group(self, queries):
+        return [self.run_query(query) for query in queries]
+
     def extract_data_from_db(self, queries_to_load, days):
-        dfMain = pd.DataFrame()
+        query_groups = {}
         for query in queries_to_load:
             if days == 'auto':
                 if query.origin_key == 'multi':
@@ -88,94 +147,197 @@ class AdapterSQL(AbstractAdapter):
             else:
                 day_val = days
             query.update_query_parameters({'Days': day_val})
-            
-            print(f"... executing query: {query.metric_key} - {query.origin_key} with {query.query_parameters} days")
-            df = pd.read_sql(query.sql, self.db_connector.engine.connect())
-            df['date'] = df['day'].apply(pd.to_datetime)
-            df['date'] = df['date'].dt.date
-            df.drop(['day'], axis=1, inplace=True)
-            df.rename(columns= {'val':'value'}, inplace=True)
-            df['metric_key'] = query.metric_key
-            if 'origin_key' not in df.columns:
-                df['origin_key'] = query.origin_key
-            df.value.fillna(0, inplace=True)
-
-            dfMain = pd.concat([dfMain, df], ignore_index=True)
-            print(f"...query loaded: {query.metric_key} {query.origin_key} with {day_val} days. DF shape: {df.shape}")
+            query_groups.setdefault(query.origin_key, []).append(query)
+
+        ## different chains run concurrently on the engine's connection pool
+        print(f"...running {len(queries_to_load)} queries in {len(query_groups)} chain groups with {self.threads} threads")
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            results = [result for group in executor.map(self.run_query_group, query_groups.values()) for result in group]
+
+        dfMain = pd.concat([pd.DataFrame()] + [df for df, _ in results], ignore_index=True)
+
+        stats = pd.DataFrame([stat for _, stat in results], columns=['metric_key', 'origin_key', 'runtime_s', 'rows'])
+        stats = stats.sort_values('runtime_s', ascending=False)
+        print(f"...all queries loaded in {round(time.time() - start, 2)}s. Slowest queries:")
+        print(stats.head(10).to_string(index=False))
         return dfMain
     
-    def run_blockspace_queries(self, origin_keys, days):
+    ## refreshes chain_daily_rollup and the HLL sketches in chain_daily_hll for all days that received new blocks, has to run before the 'metrics' load
+    ## with user_base_exact also the address dictionary and the daily address bitmaps in chain_daily_bitmap
+    def run_rollup(self, origin_keys):
         if origin_keys is None:
-            origin_keys = [chain.origin_key for chain in adapter_mapping if chain.aggregate_blockspace == True]
-            print(f"...no specific origin_key found, aggregating blockspace for all chains: {origin_keys}...")
+            origin_keys = rollup_chains + ['imx']
+        self.db_connector.create_chain_daily_rollup()
+        self.db_connector.create_chain_daily_hll()
+        if self.user_base_exact:
+            self.db_connector.create_address_bitmap_tables()
 
-        for chain in origin_keys:
-            if days == 'auto':
-                days = get_missing_days_blockspace(self.db_connector, chain)
+        def refresh(chain):
+            start = time.time()
+            if chain == 'imx':
+                ## imx isn't part of the rollup, only its sketches are refreshed (last stored day onwards)
+                last_date = self.db_connector.get_hll_max_date(chain)
+                days = 5000 if last_date is None else (datetime.today().date() - last_date).days
+                df = self.db_connector.get_hll_registers(self.db_connector.get_imx_address_sql(datetime.today().date() - timedelta(days=days)))
             else:
-                days = days
+                dates = self.db_connector.refresh_chain_daily_rollup(chain, self.rollup_recompute_days)
+                print(f"...refreshed chain_daily_rollup for {chain}: {len(dates)} days updated in {round(time.time() - start, 2)}s")
+                if len(dates) == 0:
+                    return
+                df = get_fee_digests_df(self.db_connector.get_fee_buckets(chain, dates), fee_quantiles)
+                upserted = self.db_connector.update_rollup_fee_digests(chain, df)
+                print(f"...refreshed fee digests for {chain}: {upserted} days updated in {round(time.time() - start, 2)}s")
+                df = self.db_connector.get_hll_registers(self.db_connector.get_chain_address_sql(chain, dates))
+            upserted = self.db_connector.upsert_hll_sketches(get_sketches_df(df, chain))
+            print(f"...refreshed chain_daily_hll for {chain}: {upserted} days updated in {round(time.time() - start, 2)}s")
 
-            if chain == 'imx':
-                print(f"...aggregating imx data for last {days} days...")
-                df = self.db_connector.get_blockspace_imx(days)
-                df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
+            if self.user_base_exact:
+                self.refresh_bitmaps(chain)
 
-                print(f"...upserting imx data . Total rows: {df.shape[0]}...")
-                self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
-            
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            list(executor.map(refresh, origin_keys))
+        print(f"Finished refreshing chain_daily_rollup and chain_daily_hll for {origin_keys}")
+
+    ## bitmaps are refreshed from their own last stored day (minus the recompute window for late blocks) onwards, so they also backfill if they were switched on later
+    ## the days are processed month by month, so a backfill of the whole history never loads more than one month of (day, address_id) pairs
+    def refresh_bitmaps(self, chain):
+        start = time.time()
+        last_date = self.db_connector.get_bitmap_max_date(chain)
+        if last_date is not None:
+            last_date = last_date - timedelta(days=self.rollup_recompute_days)
+        if chain == 'imx':
+            start_date = imx_start_date if last_date is None else last_date
+            months = pd.period_range(start_date, datetime.today().date(), freq='M')
+            address_sqls = [self.db_connector.get_imx_address_sql(max(month.start_time.date(), start_date), (month + 1).start_time.date()) for month in months]
+        else:
+            dates = self.db_connector.get_rollup_dates(chain, last_date)
+            months = pd.Series(dates, dtype='object').groupby(pd.to_datetime(pd.Series(dates)).dt.to_period('M'))
+            address_sqls = [self.db_connector.get_chain_address_sql(chain, list(month_dates)) for _, month_dates in months]
+
+        upserted = 0
+        for address_sql in address_sqls:
+            df = self.db_connector.get_active_address_ids(address_sql)
+            upserted += self.db_connector.upsert_bitmaps(address_bitmaps.get_bitmaps_df(df, chain))
+        print(f"...refreshed chain_daily_bitmap for {chain}: {upserted} days updated in {len(address_sqls)} chunks in {round(time.time() - start, 2)}s")
+
+    ## user_base_daily/weekly/monthly: distinct addresses per period, split by single chain or 'multiple' chains
+    ## exact from the address bitmaps with user_base_exact, otherwise estimated from the HLL sketches (see src/misc/sketches.py for the error bound)
+    def extract_user_base(self, metric_keys, days):
+        dfs = [pd.DataFrame()]
+        today = datetime.today().date()
+        for metric_key, (aggregation, default_days) in user_base_metrics.items():
+            if metric_keys is not None and metric_key not in metric_keys:
+                continue
+            day_val = default_days if days == 'auto' else days
+            ## only complete periods
+            start_date = get_period_start(today - timedelta(days=day_val), aggregation)
+            end_date = get_period_start(today, aggregation)
+
+            start = time.time()
+            if self.user_base_exact:
+                df = self.db_connector.get_bitmaps(start_date, end_date)
+                df = address_bitmaps.get_user_base_df(df[df['origin_key'].isin(user_base_chains)], aggregation)
             else:
-                ## aggregate contract data
-                print(f"...aggregating contract data for {chain} and last {days} days...")
-                df = self.db_connector.get_blockspace_contracts(chain, days)
-                df.set_index(['address', 'date', 'origin_key'], inplace=True)
+                df = self.db_connector.get_hll_sketches(start_date, end_date)
+                df = get_user_base_df(df[df['origin_key'].isin(user_base_chains)], aggregation)
+            df = self.prepare_df(df, metric_key, 'multi')
+            print(f"...{metric_key} loaded from {start_date} until {end_date} in {round(time.time() - start, 2)}s. DF shape: {df.shape}")
+            dfs.append(df)
+        return pd.concat(dfs, ignore_index=True)
 
-                print(f"...upserting contract data for {chain}. Total rows: {df.shape[0]}...")
-                self.db_connector.upsert_table('blockspace_fact_contract_level', df)
+    ## txcosts_median_usd, txcosts_p10_usd, txcosts_p90_usd over all L2 txs (origin_key all_l2s)
+    def extract_txcosts_all_l2s(self, metric_keys, days):
+        quantiles = {f'{column}_usd': q for column, q in fee_quantiles.items()}
+        if metric_keys is not None:
+            quantiles = {k: v for k, v in quantiles.items() if k in metric_keys}
+        if len(quantiles) == 0:
+            return pd.DataFrame()
 
-                ## determine total usage
-                print(f"...aggregating total usage for {chain} and last {days} days...")
-                df = self.db_connector.get_blockspace_total(chain, days)
-                df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
+        day_val = 7 if days == 'auto' else days
+        today = datetime.today().date()
+        df = self.db_connector.get_fee_digests(today - timedelta(days=day_val), today)
+        df = get_merged_fee_quantiles_df(df, quantiles)
 
-                print(f"...upserting total usage usage for {chain}. Total rows: {df.shape[0]}...")
-                self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
+        df = self.prepare_df(df, None, 'all_l2s')
+        print(f"...txcosts quantiles for all_l2s loaded for {day_val} days. DF shape: {df.shape}")
+        return df
 
-                ## aggregate native transfers
-                print(f"...aggregating native_transfers for {chain} and last {days} days...")
-                df = self.db_connector.get_blockspace_native_transfers(chain, days)
-                df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
+    ## create_tables=False if the label tracking tables were already created upstream (e.g. before the mapped blockspace tasks of the DAG)
+    def run_blockspace_queries(self, origin_keys, days, create_tables:bool=True):
+        if origin_keys is None:
+            origin_keys = [chain.origin_key for chain in adapter_mapping if chain.aggregate_blockspace == True]
+            print(f"...no specific origin_key found, aggregating blockspace for all chains: {origin_keys}...")
+        if create_tables:
+            self.db_connector.create_blockspace_label_tracking()
+
+        ## chains are aggregated concurrently, each one on its own connections and with its own watermark
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            stats = list(executor.map(lambda chain: self.run_blockspace_chain(chain, days), origin_keys))
 
-                print(f"...upserting native_transfers for {chain}. Total rows: {df.shape[0]}...")
-                self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
+        stats = pd.DataFrame(stats, columns=['origin_key', 'days', 'runtime_s']).sort_values('runtime_s', ascending=False)
+        print(F"Finished loading blockspace for all chains in {round(time.time() - start, 2)}s")
+        print(stats.to_string(index=False))
 
-                ## aggregate contract deployments
-                print(f"...aggregating smart_contract_deployments for {chain} and last {days} days...")
-                df = self.db_connector.get_blockspace_contract_deplyments(chain, days)
-                df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
+    ## aggregates the blockspace of one chain, days can be 'auto' (resolved from the chain's blockspace watermark), returns (chain, days, runtime)
+    def run_blockspace_chain(self, chain, days):
+        start = time.time()
+        if days == 'auto':
+            days = get_missing_days_blockspace(self.db_connector, chain)
 
-                print(f"...upserting smart_contract_deployments for {chain}. Total rows: {df.shape[0]}...")
-                self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
+        if chain == 'imx':
+            print(f"...aggregating imx data for last {days} days...")
+            df = self.db_connector.get_blockspace_imx(days)
+            df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
 
-                # ALL below needs to be retriggerd when mapping changes (e.g. new addresses got labeled or new categories added etc.)
-                ## aggregate by sub categories
+            print(f"...upserting imx data . Total rows: {df.shape[0]}...")
+            self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
+        
+        else:
+            ## aggregate contract data, total usage, native transfers and smart contract deployments in one scan of the tx table
+            print(f"...aggregating contract data and usage for {chain} and last {days} days...")
+            df = self.db_connector.get_blockspace_usage(chain, days)
+
+            df_contracts = df[df['sub_category_key'] == 'contract'].drop(columns=['sub_category_key'])
+            df_contracts.set_index(['address', 'date', 'origin_key'], inplace=True)
+            print(f"...upserting contract data for {chain}. Total rows: {df_contracts.shape[0]}...")
+            self.db_connector.upsert_table('blockspace_fact_contract_level', df_contracts)
 
-                days_mapping = 5000
-                print(f"...aggregating sub categories for {chain} and last {days_mapping} days...")
-                df = self.db_connector.get_blockspace_sub_categories(chain, days_mapping)
-                df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
+            df_usage = df[df['sub_category_key'] != 'contract'].drop(columns=['address'])
+            df_usage.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
+            print(f"...upserting total usage, native_transfers and smart_contract_deployments for {chain}. Total rows: {df_usage.shape[0]}...")
+            self.db_connector.upsert_table('blockspace_fact_sub_category_level', df_usage)
+
+            ## sub categories: the days of the current window are aggregated with the current labels, for older days only the contribution
+            ## of contracts whose label changed since the last run is moved (full recompute on the first run of a chain)
+            state_key = f'blockspace_labels_{chain}'
+            if self.db_connector.get_etl_state(state_key) is None:
+                self.db_connector.reset_blockspace_labels_applied(chain)
+                days_mapping = days_unlabeled = 5000
+            else:
+                days_mapping = days_unlabeled = days
+                changed_dates = self.db_connector.apply_blockspace_label_changes(chain)
+                print(f"...moved the usage of relabeled contracts for {chain} on {len(changed_dates)} days")
+                if len(changed_dates) > 0:
+                    days_unlabeled = max(days, (datetime.today().date() - pd.to_datetime(changed_dates[0]).date()).days + 1)
 
-                print(f"...upserting sub categories for {chain}. Total rows: {df.shape[0]}...")
-                self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
+            print(f"...aggregating sub categories for {chain} and last {days_mapping} days...")
+            df = self.db_connector.get_blockspace_sub_categories(chain, days_mapping)
+            df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
 
-                ## determine unlabeled usage
-                print(f"...aggregating unlabeled usage for {chain} and last {days_mapping} days...")
-                df = self.db_connector.get_blockspace_unlabeled(chain, days_mapping)
-                df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
+            print(f"...upserting sub categories for {chain}. Total rows: {df.shape[0]}...")
+            self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
 
-                print(f"...upserting unlabeled usage for {chain}. Total rows: {df.shape[0]}...")
-                self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
+            ## determine unlabeled usage for all days that changed
+            print(f"...aggregating unlabeled usage for {chain} and last {days_unlabeled} days...")
+            df = self.db_connector.get_blockspace_unlabeled(chain, days_unlabeled)
+            df.set_index(['date', 'sub_category_key' ,'origin_key'], inplace=True)
 
-            print(F"Finished loading blockspace queries for {chain}")
-       
+            print(f"...upserting unlabeled usage for {chain}. Total rows: {df.shape[0]}...")
+            self.db_connector.upsert_table('blockspace_fact_sub_category_level', df)
+            self.db_connector.set_etl_state(state_key, str(datetime.now()))
 
-        print(F"Finished loading blockspace for all chains")
+        runtime = time.time() - start
+        print(F"Finished loading blockspace queries for {chain} in {round(runtime, 2)}s")
+        return (chain, days, runtime)
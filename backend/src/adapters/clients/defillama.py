@@ -3,10 +3,15 @@
 ## MSeidl 08.02.2023 - added to get_stablecoin_hist_mcap_on_a_chain() and get_stablecoin_hist_mcap()
 
 import requests
+import json
 import pandas as pd
 import numpy as np
 import time
 from urllib.parse import urlencode, quote
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from src.misc.http_cache import get_http_cache
 
 TVL_BASE_URL = VOLUMES_BASE_URL = FEES_BASE_URL = "https://api.llama.fi"
 COINS_BASE_URL = "https://coins.llama.fi"
@@ -20,8 +25,22 @@ class DefiLlama:
     Implements methods for calling DeFiLlama APIs and cleaning returned data. 
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=4, retries=3):
+        """
+        Parameters
+        ----------
+        max_workers : int
+            Max number of concurrent requests when historical prices are 
+            fetched in chunks.
+        retries : int
+            Number of retries per chunk before giving up.
+        """
+        self.max_workers = max_workers
+        self.retries = retries
         self.session = requests.Session()
+        # keep enough pooled connections for all workers of the chunk scheduler
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
 
     def _get(self, api_name, endpoint, params=None):
         """Send 'GET' request.
@@ -56,7 +75,24 @@ class DefiLlama:
             url = BRIDGES_BASE_URL + endpoint
         else: 
             url = ABI_DECODER_BASE_URL + endpoint
-        return self.session.request('GET', url,params=params,timeout=30).json()
+
+        # serve from the on-disk http cache if configured, unchanged responses 
+        # only cost a 304
+        http_cache = get_http_cache()
+        if http_cache is None:
+            return self.session.request('GET', url,params=params,timeout=30).json()
+
+        entry = http_cache.lookup(url, params)
+        if entry is not None and http_cache.is_fresh(entry):
+            return json.loads(entry['body'])
+        headers = http_cache.conditional_headers(entry) if entry is not None else None
+        resp = self.session.request('GET', url, params=params, headers=headers, timeout=30)
+        if resp.status_code == 304 and entry is not None:
+            http_cache.refresh(entry, params)
+            return json.loads(entry['body'])
+        if resp.status_code == 200:
+            http_cache.store(url, resp, params)
+        return resp.json()
 
     # --- TVL --- #
     
@@ -331,6 +367,45 @@ class DefiLlama:
         df = df.set_index('timestamp')
         return df.loc[:, ['symbol','price','chain','token_address']] 
 
+    def _get_hist_batch_prices_chunk(self, chain_token_addr_timestamps):
+        """ Download one chunk of historical batch prices, retry with backoff 
+        if the API call fails. """
+        for attempt in range(self.retries + 1):
+            try:
+                return self.get_tokens_hist_batch_prices(chain_token_addr_timestamps)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print(f'...DefiLlama batchHistorical failed ({e}), retry {attempt + 1}/{self.retries}')
+                time.sleep(2 ** attempt)
+
+    def _get_hist_batch_prices_chunked(self, token_addrs_n_chains, dttms, chunk_size):
+        """Get historical batch prices for many timestamps by splitting them 
+        into chunks (necessary due to api limit) and downloading the chunks 
+        concurrently.
+
+        Parameters
+        ----------
+        token_addrs_n_chains : dictionary
+            Same as in get_tokens_hist_prices().
+        dttms : list
+            Unix timestamps in seconds.
+        chunk_size : int
+            Max number of timestamps per API call.
+
+        Returns 
+        -------
+        data frame
+        """
+        chunks = [{f'{v}:{k}':dttms[i:i+chunk_size] 
+                   for k, v in token_addrs_n_chains.items()}
+                  for i in range(0, max(len(dttms), 1), chunk_size)]
+        if len(chunks) == 1:
+            return self._get_hist_batch_prices_chunk(chunks[0])
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            lst = list(executor.map(self._get_hist_batch_prices_chunk, chunks))
+        return pd.concat(lst, axis=0)
+
     def get_daily_open_close(self, token_addrs_n_chains, start, end, kind='close'):
         """Get historical daily open and close prices of tokens by contract 
         address. Data on both the starting and end dates are included. 
@@ -374,23 +449,7 @@ class DefiLlama:
 
         # necessary due to api limit
         chunk_size = 30 # 30 days
-        if len(dttms) <= chunk_size:
-            # make input dict for getting historical batch prices
-            dd = {f'{v}:{k}':dttms for k, v in token_addrs_n_chains.items()}            
-            df = self.get_tokens_hist_batch_prices(dd)
-        else: # break into batches and iterate due to API call limit
-            nchunks = int(np.ceil(len(dttms) / chunk_size))
-            lst = list()
-            for i in range(nchunks):
-                # i = 11
-                # make input dict for getting historical batch prices
-                dd = {f'{v}:{k}':dttms[i*chunk_size:(i+1)*chunk_size]
-                      for k, v in token_addrs_n_chains.items()}
-                # download historical prices at these time points
-                lst.append(self.get_tokens_hist_batch_prices(dd))
-                time.sleep(0.1)
-                # print(len(lst))
-            df = pd.concat(lst, axis=0)
+        df = self._get_hist_batch_prices_chunked(token_addrs_n_chains, dttms, chunk_size)
 
         # clean data so that the resulting frame has 
         #   - each row is a date
@@ -405,8 +464,7 @@ class DefiLlama:
             df['date'] = np.where(df.timestamp.dt.hour == 0, 
                                   df.timestamp.dt.date, 
                                   df.timestamp.dt.date + pd.Timedelta(days=1))
-        df = df.groupby(['date', 'symbol'])['price'].mean()
-        df = df.reset_index().pivot(index='date', columns='symbol', values='price')
+        df = df.groupby(['date', 'symbol'])['price'].mean().unstack('symbol')
         df.columns.name = None
         df.index = pd.to_datetime(df.index, utc=True).date # date is an attribute
         # here, and calling date() as a method throws error. 
@@ -449,35 +507,16 @@ class DefiLlama:
         
         # necessary due to api limit
         chunk_size = 24*2 # 2 days
-        if len(dttms) <= chunk_size:
-            # make input dict for getting historical batch prices
-            dd = {f'{v}:{k}':dttms for k, v in token_addrs_n_chains.items()}
-            df = self.get_tokens_hist_batch_prices(dd)
-        else: # break into batches and iterate due to API call limit
-            nchunks = int(np.ceil(len(dttms) / chunk_size))
-            lst = list()
-            for i in range(nchunks):
-                # i = 11
-                # make input dict for getting historical batch prices
-                dd = {f'{v}:{k}':dttms[i*chunk_size:(i+1)*chunk_size]
-                      for k, v in token_addrs_n_chains.items()}
-                # download historical prices at these time points
-                lst.append(self.get_tokens_hist_batch_prices(dd))
-                time.sleep(0.1)
-                # print(len(lst))
-            df = pd.concat(lst, axis=0)
+        df = self._get_hist_batch_prices_chunked(token_addrs_n_chains, dttms, chunk_size)
         
         # clean data so that the resulting frame has 
         #   - each row is a datetime
         #   - each column is a token
         #   - each value is a price (open or close)
         df = df.reset_index()
-        df['datetime'] = [elt.round(freq='H') for elt in df['timestamp']]
-        # df[['timestamp', 'datetime']].head(10)
+        df['datetime'] = df['timestamp'].dt.round(freq='H')
         # `datetime` can have duplicates, so take their avg price
-        df = df.groupby(['datetime', 'symbol']).agg({'price':'mean'})
-        df = df.reset_index()\
-            .pivot(index='datetime', columns='symbol', values='price')
+        df = df.groupby(['datetime', 'symbol'])['price'].mean().unstack('symbol')
         df.columns.name = None
         df.index = pd.to_datetime(df.index, utc=True)
         
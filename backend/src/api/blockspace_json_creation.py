@@ -1,10 +1,11 @@
 import os
-import simplejson as json
 import datetime
 import pandas as pd
 
 from src.adapters.mapping import adapter_mapping, adapter_all2_mapping
-from src.misc.helper_functions import upload_json_to_cf_s3, db_addresses_to_checksummed_addresses
+from src.misc.helper_functions import db_addresses_to_checksummed_addresses
+from src.misc.json_publisher import JSONPublisher
+from src.misc.json_serializer import dumps
 
 class BlockspaceJSONCreation():
 
@@ -14,6 +15,8 @@ class BlockspaceJSONCreation():
         self.s3_bucket = s3_bucket
         self.cf_distribution_id = cf_distribution_id
         self.db_connector = db_connector
+        ## skips unchanged jsons and batches the CloudFront invalidations (flushed at the end of every create_* method)
+        self.publisher = JSONPublisher(s3_bucket, cf_distribution_id) if s3_bucket != None else None
 
     def download_chain_blockspace_overview_data(self, chain_key):
         exec_string = f"""
@@ -268,8 +271,8 @@ class BlockspaceJSONCreation():
         #create directory if not exists
         os.makedirs(os.path.dirname(f'output/{self.api_version}/{path}.json'), exist_ok=True)
         ## save to file
-        with open(f'output/{self.api_version}/{path}.json', 'w') as fp:
-            json.dump(data, fp, ignore_nan=True)
+        with open(f'output/{self.api_version}/{path}.json', 'wb') as fp:
+            fp.write(dumps(data))
 
     ##### JSON GENERATION METHODS #####
 
@@ -361,7 +364,7 @@ class BlockspaceJSONCreation():
 
                 # create list of lists for each main_category_key
                 mk_list = main_category_df[[
-                    'unix', 'gas_fees_eth', 'gas_fees_usd', 'txcount', 'gas_fees_share_eth', 'gas_fees_share_usd', 'txcount_share']].values.tolist()
+                    'unix', 'gas_fees_eth', 'gas_fees_usd', 'txcount', 'gas_fees_share_eth', 'gas_fees_share_usd', 'txcount_share']].to_numpy()
 
                 # add the list of lists to the main_category_key dict
                 chain_dict["daily"][main_category_key]['data'] = mk_list
@@ -404,7 +407,8 @@ class BlockspaceJSONCreation():
         if self.s3_bucket == None:
             self.save_to_json(overview_dict, f'blockspace/overview')
         else:
-            upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/blockspace/overview', overview_dict, self.cf_distribution_id)
+            self.publisher.publish(f'{self.api_version}/blockspace/overview', overview_dict)
+            self.publisher.flush()
         print(f'-- DONE -- Blockspace export for overview')
 
     def get_comparison_aggregate_data_day(self, days, category_type, origin_keys:list):
@@ -689,7 +693,7 @@ class BlockspaceJSONCreation():
                     ## for values in column 'gas_fees_usd' keep only 2 decimals
                     chain_df['gas_fees_usd'] = chain_df['gas_fees_usd'].apply(lambda x: round(x, 2))
                     
-                    comparison_dict['data'][main_cat]['daily'][chain] = chain_df[['unix', 'gas_fees_eth', 'gas_fees_usd', 'txcount']].values.tolist()
+                    comparison_dict['data'][main_cat]['daily'][chain] = chain_df[['unix', 'gas_fees_eth', 'gas_fees_usd', 'txcount']].to_numpy()
                     
                     # calculate rolling 7d average
                     chain_df['7d_gas_fees_eth'] = chain_df['gas_fees_eth'].rolling(7).mean()
@@ -704,7 +708,7 @@ class BlockspaceJSONCreation():
                     ## for values in column 'gas_fees_usd' keep only 2 decimals
                     chain_df['7d_gas_fees_usd'] = chain_df['7d_gas_fees_usd'].apply(lambda x: round(x, 2))
                     
-                    comparison_dict['data'][main_cat]['daily_7d_rolling'][chain] = chain_df[['unix', '7d_gas_fees_eth', '7d_gas_fees_usd', '7d_txcount']].values.tolist()
+                    comparison_dict['data'][main_cat]['daily_7d_rolling'][chain] = chain_df[['unix', '7d_gas_fees_eth', '7d_gas_fees_usd', '7d_txcount']].to_numpy()
 
                     # add daily data for each chain for each sub category of main category
                     for sub_cat in sub_cat_daily_df[sub_cat_daily_df['main_category_key'] == main_cat]['sub_category_key'].unique():
@@ -717,7 +721,7 @@ class BlockspaceJSONCreation():
                             ## for values in column 'gas_fees_usd' keep only 2 decimals
                             chain_df['gas_fees_usd'] = chain_df['gas_fees_usd'].apply(lambda x: round(x, 2))
 
-                            comparison_dict['data'][main_cat]['subcategories'][sub_cat]['daily'][chain] = chain_df[['unix', 'gas_fees_eth', 'gas_fees_usd', 'txcount']].values.tolist()
+                            comparison_dict['data'][main_cat]['subcategories'][sub_cat]['daily'][chain] = chain_df[['unix', 'gas_fees_eth', 'gas_fees_usd', 'txcount']].to_numpy()
                             
                             # calculate rolling 7d average
                             chain_df['7d_gas_fees_eth'] = chain_df['gas_fees_eth'].rolling(7).mean()
@@ -733,12 +737,13 @@ class BlockspaceJSONCreation():
                             chain_df['7d_gas_fees_usd'] = chain_df['7d_gas_fees_usd'].apply(lambda x: round(x, 2))
 
                             #comparison_dict['data'][main_cat]['subcategories'][sub_cat]['daily_7d_rolling'][chain] = chain_df[['unix', '7d_gas_fees_eth', '7d_gas_fees_usd', '7d_gas_fees_share', '7d_txcount', '7d_txcount_share']].values.tolist()
-                            comparison_dict['data'][main_cat]['subcategories'][sub_cat]['daily_7d_rolling'][chain] = chain_df[['unix', '7d_gas_fees_eth', '7d_gas_fees_usd', '7d_txcount']].values.tolist()
+                            comparison_dict['data'][main_cat]['subcategories'][sub_cat]['daily_7d_rolling'][chain] = chain_df[['unix', '7d_gas_fees_eth', '7d_gas_fees_usd', '7d_txcount']].to_numpy()
 
         if self.s3_bucket == None:
             self.save_to_json(comparison_dict, f'blockspace/category_comparison')
         else:
-            upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/blockspace/category_comparison', comparison_dict, self.cf_distribution_id)
+            self.publisher.publish(f'{self.api_version}/blockspace/category_comparison', comparison_dict)
+            self.publisher.flush()
         print(f'-- DONE -- Blockspace export for category_comparison')
 
     def create_all_jsons(self):
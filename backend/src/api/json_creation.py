@@ -1,11 +1,15 @@
 import os
-import simplejson as json
+import re
 import datetime
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 
 from src.adapters.mapping import adapter_mapping, adapter_multi_mapping
-from src.misc.helper_functions import upload_json_to_cf_s3, db_addresses_to_checksummed_addresses
+from src.api.metric_cube import MetricCube, change_days, get_change_values
+from src.misc.helper_functions import db_addresses_to_checksummed_addresses
+from src.misc.json_publisher import JSONPublisher
+from src.misc.json_serializer import dumps
 
 class JSONCreation():
 
@@ -15,6 +19,8 @@ class JSONCreation():
         self.s3_bucket = s3_bucket
         self.cf_distribution_id = cf_distribution_id
         self.db_connector = db_connector
+        ## skips unchanged jsons and batches the CloudFront invalidations (flushed at the end of every create_* method)
+        self.publisher = JSONPublisher(s3_bucket, cf_distribution_id) if s3_bucket != None else None
 
         self.metrics = {
             'tvl': {
@@ -85,9 +91,20 @@ class JSONCreation():
         #concat all values of chains_list to a string and add apostrophes around each value
         self.chains_string = "'" + "','".join(self.chains_list) + "'"
 
+        ## indexed version of the df that is passed to the json methods, built once per df (see get_cube)
+        self.cube = None
+        self.cube_df = None
+
     
     ###### CHAIN DETAILS AND METRIC DETAILS METHODS ########
 
+    ## the chain and metric details jsons slice the same df for every (chain, metric) pair, so it is indexed once
+    def get_cube(self, df):
+        if self.cube_df is not df:
+            self.cube = MetricCube(df)
+            self.cube_df = df
+        return self.cube
+
     def df_rename(self, df, metric_id, col_name_removal=False):
         # print(f'called df_rename for {metric_id}')
         # print(df.columns.to_list())
@@ -120,7 +137,7 @@ class JSONCreation():
     def generate_daily_list(self, df, metric_id, origin_key):
         ##print(f'called generate int for {metric_id} and {chain_id}')
         mks = self.metrics[metric_id]['metric_keys']
-        df_tmp = df.loc[(df.origin_key==origin_key) & (df.metric_key.isin(mks)), ["unix", "value", "metric_key"]].pivot(index='unix', columns='metric_key', values='value').reset_index()
+        df_tmp = self.get_cube(df).get_pivot(origin_key, mks, index='unix').reset_index()
         df_tmp.sort_values(by=['unix'], inplace=True, ascending=True)
         
         df_tmp = self.df_rename(df_tmp, metric_id, True)
@@ -138,30 +155,49 @@ class JSONCreation():
     
 
     ## create 7d rolling average over a list of lists where the first element is the date and the second element is the value (necessary for daily_avg field)
+    ## the first 7 rows are passed through, the window sums are added in the order value[i] + value[i-1] + ... + value[i-6] so that the floats match the former per row sums exactly
     def create_7d_rolling_avg(self, list_of_lists):
-        avg_list = []
-        if len(list_of_lists[0]) == 2: ## all non USD metrics e.g. txcount
-            for i in range(len(list_of_lists)):
-                if i < 7:
-                    avg_list.append([list_of_lists[i][0], list_of_lists[i][1]])
-                else:
-                    avg = (list_of_lists[i][1] + list_of_lists[i-1][1] + list_of_lists[i-2][1] + list_of_lists[i-3][1] + list_of_lists[i-4][1] + list_of_lists[i-5][1] + list_of_lists[i-6][1]) / 7
-                    ## round to 2 decimals
-                    avg = round(avg, 2)
-                    avg_list.append([list_of_lists[i][0], avg])
+        n = len(list_of_lists)
+        if n <= 7:
+            return [list(row) for row in list_of_lists]
+
+        ## transposed with zip (np.array of the list of lists is slower than the whole row by row average),
+        ## the unix column is only carried along, the output keeps the original int timestamps
+        columns = list(zip(*list_of_lists))
+        avg = []
+        for column in columns[1:]:
+            values = np.array(column, dtype='float64')
+            window_sum = values[6:n]
+            for lag in range(1, 7):
+                window_sum = window_sum + values[6-lag:n-lag]
+            avg.append((window_sum[1:] / 7).tolist())
+
+        avg_list = [list(row) for row in list_of_lists[:7]]
+        unix = columns[0][7:]
+        if len(columns) == 2: ## all non USD metrics e.g. txcount
+            ## python round (not np.round) to keep the exact same 2 decimal rounding as before
+            avg_list += [[u, round(v, 2)] for u, v in zip(unix, avg[0])]
         else: ## all USD metrics e.g. fees that have USD and ETH values
-            for i in range(len(list_of_lists)):
-                if i < 7:
-                    avg_list.append([list_of_lists[i][0], list_of_lists[i][1], list_of_lists[i][2]] )
-                else:
-                    avg_1 = (list_of_lists[i][1] + list_of_lists[i-1][1] + list_of_lists[i-2][1] + list_of_lists[i-3][1] + list_of_lists[i-4][1] + list_of_lists[i-5][1] + list_of_lists[i-6][1]) / 7
-                    avg_2 = (list_of_lists[i][2] + list_of_lists[i-1][2] + list_of_lists[i-2][2] + list_of_lists[i-3][2] + list_of_lists[i-4][2] + list_of_lists[i-5][2] + list_of_lists[i-6][2]) / 7
-    
-                    avg_list.append([list_of_lists[i][0], avg_1, avg_2])
-        
+            avg_list += [[u, v_1, v_2] for u, v_1, v_2 in zip(unix, avg[0], avg[1])]
         return avg_list
 
 
+    ## 7d rolling average of a chain and metric for the daily_7d_rolling field, read from the averages that the cube computes once for all chains
+    ## (same values as create_7d_rolling_avg on mk_list_int). Falls back to create_7d_rolling_avg if the USD and ETH keys have different dates.
+    def generate_7d_rolling_avg(self, df, metric_id, origin_key, mk_list_int):
+        mks = self.metrics[metric_id]['metric_keys']
+        cube = self.get_cube(df)
+        if len(mk_list_int) <= 7 or len(mk_list_int[0]) != len(mks) + 1 or not cube.is_aligned(origin_key, mks):
+            return self.create_7d_rolling_avg(mk_list_int)
+
+        avg_list = [list(row) for row in mk_list_int[:7]]
+        if len(mks) == 1: ## all non USD metrics e.g. txcount
+            avg_list += [[row[0], round(v, 2)] for row, v in zip(mk_list_int[7:], cube.get_rolling_avg(origin_key, mks[0]).tolist())]
+        else: ## all USD metrics e.g. fees, same column order as df_rename (usd, eth)
+            mk_usd, mk_eth = sorted(mks, key=lambda mk: mk.endswith('_eth'))
+            avg_list += [[row[0], v_1, v_2] for row, v_1, v_2 in zip(mk_list_int[7:], cube.get_rolling_avg(origin_key, mk_usd).tolist(), cube.get_rolling_avg(origin_key, mk_eth).tolist())]
+        return avg_list
+
     def download_data(self, chains_string, metrics_string):
         exec_string = f"""
             SELECT 
@@ -190,9 +226,6 @@ class JSONCreation():
 
     def create_changes_dict(self, df, metric_id, origin_key):
         #print(f'called create_changes_dict for {metric_id} and {origin_key}')
-        df_tmp = df.loc[(df.origin_key==origin_key) & (df.metric_key.isin(self.metrics[metric_id]['metric_keys'])), ["date", "value", "metric_key"]].pivot(index='date', columns='metric_key', values='value')
-        df_tmp.sort_values(by=['date'], inplace=True, ascending=False)
-
         changes_dict = {
                         'types': [],
                         '1d': [],
@@ -203,27 +236,25 @@ class JSONCreation():
                         '365d': []
                     }
 
-        for mk in self.metrics[metric_id]['metric_keys']:
-            #print(mk)
-            cur_val = df_tmp[mk].iloc[0]
-            changes = [1,7,30,90,180,365]
-            for change in changes:
-                if df_tmp[mk].shape[0] <= change:
-                    change_val = None
-                elif df_tmp[mk].iloc[change] == 0:
-                    change_val = None
-                else:
-                    prev_val = df_tmp[mk].iloc[change]
-                    if prev_val < 0 and cur_val > 0:
-                        change_val = None
-                    elif prev_val > 0 and cur_val < 0:
-                        change_val = None
-                    elif prev_val < 0 and cur_val < 0:
-                        change_val = None
-                    else:
-                        change_val = (cur_val - prev_val) / prev_val
-                        change_val = round(change_val, 4)
-                changes_dict[f'{change}d'].append(change_val)
+        mks = self.metrics[metric_id]['metric_keys']
+        cube = self.get_cube(df)
+        if cube.is_aligned(origin_key, mks):
+            ## all keys have the same dates: the changes are read from the values that the cube computes once for all chains
+            for mk in mks:
+                for change, change_val in zip(change_days, cube.get_changes(origin_key, mk)):
+                    changes_dict[f'{change}d'].append(change_val)
+            df_tmp = pd.DataFrame(columns=pd.Index(sorted(set(mks)), name='metric_key'))
+        else:
+            ## USD and ETH values on different dates: the changes are read from the outer joined pivot (sorted by date ascending, read from the end)
+            df_tmp = cube.get_pivot(origin_key, mks, index='date')
+            for mk in mks:
+                values = df_tmp[mk].to_numpy()[::-1]
+                available = change_days < values.shape[0]
+                prev_val = np.full(change_days.shape, np.nan)
+                prev_val[available] = values[change_days[available]]
+                change_vals, valid = get_change_values(values[0], prev_val, available)
+                for change, is_valid, change_val in zip(change_days, valid, change_vals):
+                    changes_dict[f'{change}d'].append(change_val if is_valid else None)
 
         df_tmp = self.df_rename(df_tmp, metric_id)
         changes_dict['types'] = df_tmp.columns.to_list()
@@ -240,6 +271,53 @@ class JSONCreation():
 
         df = self.download_data(chain_user_string, metrics_user_string)
         return df
+
+    ## The export tasks all work on the same fact_kpis download. create_snapshot downloads it once and writes it as an
+    ## uncompressed Arrow IPC file, the downstream tasks get the path and read it with load_snapshot.
+    ## Snapshots are scoped per DAG run (fact_kpis_<run_id>.arrow), so a run never reads or deletes the snapshot of another run.
+    ## They are removed by cleanup_snapshots after all tasks of the run are done.
+    def create_snapshot(self, snapshot_dir:str, run_id:str=None) -> str:
+        df = self.get_all_data()
+        os.makedirs(snapshot_dir, exist_ok=True)
+        if run_id is None:
+            run_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        ## run ids contain ':' and '+' (e.g. scheduled__2023-04-24T04:30:00+00:00)
+        path = os.path.join(snapshot_dir, f"fact_kpis_{re.sub(r'[^A-Za-z0-9_.-]', '_', run_id)}.arrow")
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        ## written to a tmp file first so that a task never sees a half written snapshot
+        with pa.OSFile(path + '.tmp', 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(path + '.tmp', path)
+        print(f"...wrote snapshot with {df.shape[0]} rows to {path}")
+        return path
+
+    ## The file is memory-mapped, but to_pandas materializes the whole frame (all columns are copied into pandas blocks).
+    ## The snapshot saves the fact_kpis download per task, not the memory of the frame.
+    def load_snapshot(self, path:str):
+        if not os.path.exists(path):
+            print(f"ERROR: snapshot {path} does not exist")
+            raise ValueError(f"snapshot {path} does not exist")
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        df = table.to_pandas()
+        print(f"...loaded snapshot with {df.shape[0]} rows from {path}")
+        return df
+
+    ## removes the snapshot of this run and snapshots of older runs that were not cleaned up (e.g. the cleanup task did not run)
+    ## snapshots younger than max_age_days can belong to a running DAG run and are kept
+    def cleanup_snapshots(self, snapshot_dir:str, path:str=None, max_age_days:int=2):
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+            print(f"...removed snapshot {path}")
+        if not os.path.exists(snapshot_dir):
+            return
+        for f in os.listdir(snapshot_dir):
+            f_path = os.path.join(snapshot_dir, f)
+            if f.startswith('fact_kpis_') and (f.endswith('.arrow') or f.endswith('.arrow.tmp')) and datetime.datetime.now().timestamp() - os.path.getmtime(f_path) > max_age_days * 86400:
+                os.remove(f_path)
+                print(f"...removed stale snapshot {f_path}")
     
     ##### LANDING PAGE METHODS #####
     ## This method calculates the total l2 users or the users for a specific chain
@@ -415,8 +493,8 @@ class JSONCreation():
         #create directory if not exists
         os.makedirs(os.path.dirname(f'output/{self.api_version}/{path}.json'), exist_ok=True)
         ## save to file
-        with open(f'output/{self.api_version}/{path}.json', 'w') as fp:
-            json.dump(data, fp, ignore_nan=True)
+        with open(f'output/{self.api_version}/{path}.json', 'wb') as fp:
+            fp.write(dumps(data))
 
 
     ##### JSON GENERATION METHODS #####
@@ -465,9 +543,12 @@ class JSONCreation():
             if self.s3_bucket == None:
                 self.save_to_json(details_dict, f'chains/{origin_key}')
             else:
-                upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/chains/{origin_key}', details_dict, self.cf_distribution_id)
+                self.publisher.publish(f'{self.api_version}/chains/{origin_key}', details_dict)
             print(f'-- DONE -- Chain details export for {origin_key}')
 
+        if self.s3_bucket != None:
+            self.publisher.flush()
+
     def create_metric_details_jsons(self, df):
         ## loop over all metrics and generate a metric details json for all metrics and with all possible chains
 
@@ -503,7 +584,7 @@ class JSONCreation():
 
                 ## check if metric should be averagd and add 7d rolling avg field
                 if self.metrics[metric]['avg'] == True:
-                    mk_list_int_7d = self.create_7d_rolling_avg(mk_list_int)
+                    mk_list_int_7d = self.generate_7d_rolling_avg(df, metric, origin_key, mk_list_int)
                     chains_dict[origin_key]['daily_7d_rolling'] = {
                         'types' : mk_list_columns,
                         'data' : mk_list_int_7d
@@ -522,9 +603,12 @@ class JSONCreation():
             if self.s3_bucket == None:
                 self.save_to_json(details_dict, f'metrics/{metric}')
             else:
-                upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/metrics/{metric}', details_dict, self.cf_distribution_id)
+                self.publisher.publish(f'{self.api_version}/metrics/{metric}', details_dict)
             print(f'-- DONE -- Metric details export for {metric}')
 
+        if self.s3_bucket != None:
+            self.publisher.flush()
+
     def create_master_json(self):
         exec_string = "SELECT sub_category_key, main_category_name, sub_category_name, main_category_key FROM blockspace_category_mapping"
         df = pd.read_sql(exec_string, self.db_connector.engine.connect())
@@ -576,7 +660,8 @@ class JSONCreation():
         if self.s3_bucket == None:
             self.save_to_json(master_dict, 'master')
         else:
-            upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/master', master_dict, self.cf_distribution_id)
+            self.publisher.publish(f'{self.api_version}/master', master_dict)
+            self.publisher.flush()
 
     def create_landingpage_json(self, df):
         landing_dict = {
@@ -624,7 +709,8 @@ class JSONCreation():
         if self.s3_bucket == None:
             self.save_to_json(landing_dict, 'landing_page')
         else:
-            upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/landing_page', landing_dict, self.cf_distribution_id)
+            self.publisher.publish(f'{self.api_version}/landing_page', landing_dict)
+            self.publisher.flush()
         print(f'-- DONE -- landingpage export')
 
     def create_fundamentals_json(self, df):
@@ -639,7 +725,8 @@ class JSONCreation():
         if self.s3_bucket == None:
             self.save_to_json(fundamentals_dict, 'fundamentals')
         else:
-            upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/fundamentals', fundamentals_dict, self.cf_distribution_id)
+            self.publisher.publish(f'{self.api_version}/fundamentals', fundamentals_dict)
+            self.publisher.flush()
 
     def create_contracts_json(self):
         exec_string = f"""
@@ -654,7 +741,8 @@ class JSONCreation():
         if self.s3_bucket == None:
             self.save_to_json(contracts_dict, 'contracts')
         else:
-            upload_json_to_cf_s3(self.s3_bucket, f'{self.api_version}/contracts', contracts_dict, self.cf_distribution_id)
+            self.publisher.publish(f'{self.api_version}/contracts', contracts_dict)
+            self.publisher.flush()
 
     def create_all_jsons(self):
         df = self.get_all_data()
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+## horizons of the changes dict in days (rows)
+change_days = np.array([1,7,30,90,180,365])
+
+## change values of the latest values cur_val vs. the previous values prev_val (broadcast over the horizons)
+## no change value (valid=False) if there is no data that far back, the previous value is 0 or the values have different signs / are both negative
+def get_change_values(cur_val, prev_val, available):
+    valid = available & (prev_val != 0) & ~((prev_val < 0) & (cur_val > 0)) & ~((prev_val > 0) & (cur_val < 0)) & ~((prev_val < 0) & (cur_val < 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change_vals = np.round((cur_val - prev_val) / prev_val, 4)
+    return change_vals, valid
+
+## Pre-indexed fact_kpis data for the json creation
+## The frame from JSONCreation.download_data is sorted once by (origin_key, metric_key, unix) and split into one NumPy array slice per
+## (origin_key, metric_key). Series and pivots of one chain are then built from these slices (O(slice)) instead of masking the full frame every time.
+class MetricCube():
+    def __init__(self, df:pd.DataFrame):
+        df = df.sort_values(['origin_key', 'metric_key', 'unix'], kind='stable')
+        self.unix = df['unix'].to_numpy()
+        self.date = df['date'].to_numpy()
+        self.value = df['value'].to_numpy()
+
+        ## (origin_key, metric_key) -> slice of the sorted arrays (the rows of a key are contiguous after sorting)
+        positions = df.reset_index(drop=True).groupby(['origin_key', 'metric_key'], sort=False).indices
+        self.slices = {key: slice(idx[0], idx[-1] + 1) for key, idx in positions.items()}
+        self.date_dtype = df['date'].dtype
+
+        ## 7d rolling averages and change values of all keys, computed on first use (see get_rolling_avg and get_changes)
+        self.rolling_avg = None
+        self.changes = None
+
+    def has(self, origin_key:str, metric_key:str) -> bool:
+        return (origin_key, metric_key) in self.slices
+
+    ## values of one chain and metric, indexed by unix or date (ascending)
+    def get_series(self, origin_key:str, metric_key:str, index:str='unix') -> pd.Series:
+        s = self.slices.get((origin_key, metric_key), slice(0, 0))
+        idx = self.unix[s] if index == 'unix' else self.date[s]
+        return pd.Series(self.value[s], index=pd.Index(idx, name=index), name=metric_key)
+
+    ## same result as df.loc[(df.origin_key==origin_key) & (df.metric_key.isin(metric_keys))].pivot(index=index, columns='metric_key', values='value')
+    def get_pivot(self, origin_key:str, metric_keys:list, index:str='unix') -> pd.DataFrame:
+        series = [self.get_series(origin_key, mk, index) for mk in sorted(set(metric_keys)) if self.has(origin_key, mk)]
+        if len(series) == 0:
+            df = pd.DataFrame(index=pd.Index([], name=index, dtype=self.date_dtype if index == 'date' else 'float64'))
+        else:
+            df = pd.concat(series, axis=1, join='outer').sort_index()
+            df.index.name = index
+        df.columns.name = 'metric_key'
+        return df
+
+    ## True if all metric keys exist for the chain and have the same dates, then the rows of the pivot are the rows of each slice
+    def is_aligned(self, origin_key:str, metric_keys:list) -> bool:
+        if not all(self.has(origin_key, mk) for mk in metric_keys):
+            return False
+        unix = self.unix[self.slices[(origin_key, metric_keys[0])]]
+        return all(np.array_equal(unix, self.unix[self.slices[(origin_key, mk)]]) for mk in metric_keys[1:])
+
+    ## 7d rolling average of one chain and metric from the 8th day on (the first 7 days have no average)
+    ## The window sums are built once for the whole value array: value[i] + value[i-1] + ... + value[i-6] in this order, so that the floats
+    ## match the former per row sums exactly (pandas rolling().sum() uses a running sum and is off in the last bits).
+    ## Windows that cross the border of two keys are never read, a slice only uses the positions from its 8th row on.
+    def get_rolling_avg(self, origin_key:str, metric_key:str) -> np.ndarray:
+        if self.rolling_avg is None:
+            n = self.value.shape[0]
+            self.rolling_avg = np.full(n, np.nan)
+            if n > 6:
+                window_sum = self.value[6:n].astype('float64')
+                for lag in range(1, 7):
+                    window_sum = window_sum + self.value[6-lag:n-lag]
+                self.rolling_avg[6:] = window_sum / 7
+        s = self.slices[(origin_key, metric_key)]
+        return self.rolling_avg[s][7:]
+
+    ## change of the latest value vs. the values 1d, 7d, ... before (by rows of the slice) for one chain and metric, computed once for all keys
+    def get_changes(self, origin_key:str, metric_key:str) -> list:
+        if self.changes is None:
+            keys = list(self.slices.keys())
+            ends = np.array([self.slices[key].stop for key in keys])
+            lengths = ends - np.array([self.slices[key].start for key in keys])
+
+            cur_val = self.value[ends - 1].astype('float64')[:, None]
+            available = change_days[None, :] < lengths[:, None]
+            prev_val = np.where(available, self.value[np.maximum(ends[:, None] - 1 - change_days[None, :], 0)], np.nan)
+            change_vals, valid = get_change_values(cur_val, prev_val, available)
+            self.changes = {key: [v if ok else None for v, ok in zip(change_vals[i], valid[i])] for i, key in enumerate(keys)}
+        return self.changes[(origin_key, metric_key)]
@@ -1,6 +1,11 @@
 from pangres import upsert
 import sqlalchemy
 import pandas as pd
+import threading
+import time
+
+from src.queries.query_templates import register_template
+from src.misc.query_profiler import get_query_profiler
 
 from dotenv import load_dotenv
 load_dotenv() 
@@ -25,8 +30,27 @@ class DbConnector:
                 },
                 pool_size=20, max_overflow=20
         )
+            ## watermarks (max dates) are loaded once per run with a single grouped query and kept up to date on upserts
+            self.max_dates = None
+            self.blockspace_max_dates = None
+            self.watermark_lock = threading.Lock()
+            ## opt-in profiling of all queries on this engine (see src/misc/query_profiler.py)
+            self.profiler = get_query_profiler()
+            if self.profiler is not None:
+                self.profiler.attach(self.engine)
+            ## partitioned tables and their known partitions, loaded on first use (see upsert_table)
+            self.partitions = None
+            self.partition_lock = threading.Lock()
+            ## in-memory index of metric_sources, loaded on first use (see get_metric_sources)
+            self.metric_sources = None
+            self.metric_sources_loaded_at = None
+            self.metric_sources_ttl = int(os.getenv("METRIC_SOURCES_TTL")) if os.getenv("METRIC_SOURCES_TTL") else None
+            self.metric_sources_lock = threading.Lock()
 
         def upsert_table(self, table_name:str, df:pd.DataFrame, if_exists='update'):
+                if df.shape[0] > 0 and self.is_partitioned(table_name):
+                        return self.upsert_partitioned_table(table_name, df, if_exists)
+
                 batch_size = 100000
                 if df.shape[0] > 0:
                         if df.shape[0] > batch_size:
@@ -40,36 +64,106 @@ class DbConnector:
                                         batch_start = batch_end
                         else:
                                 upsert(con=self.engine, df=df, table_name=table_name, if_row_exists='update', create_table=False)
+                        self.update_watermarks(table_name, df)
                         return df.shape[0]
+
+        ## rows are split by month and upserted directly into the monthly partitions (created if missing),
+        ## the primary key of a partitioned table has to include the partition key, hence block_timestamp is added to the index
+        def upsert_partitioned_table(self, table_name:str, df:pd.DataFrame, if_exists='update'):
+                if 'block_timestamp' not in df.index.names:
+                        df = df.set_index('block_timestamp', append=True)
+                months = pd.to_datetime(df.index.get_level_values('block_timestamp')).to_period('M')
+                self.create_tx_partitions(table_name, months.min().start_time.date(), months.max().start_time.date())
+
+                for month, df_month in df.groupby(months):
+                        partition_name = self.get_partition_name(table_name, month.start_time.date())
+                        print(f"...upserting {df_month.shape[0]} rows to {partition_name}")
+                        batch_size = 100000
+                        for batch_start in range(0, df_month.shape[0], batch_size):
+                                upsert(con=self.engine, df=df_month.iloc[batch_start:batch_start + batch_size], table_name=partition_name, if_row_exists=if_exists, create_table=False)
+                return df.shape[0]
                 
 # ------------------------- additional db functions -------------------------
 
-        def get_max_date(self, metric_key:str, origin_key:str):
-                exec_string = f"SELECT MAX(date) as val FROM fact_kpis WHERE metric_key = '{metric_key}' AND origin_key = '{origin_key}';"
+        ## loads max(date) for all (metric_key, origin_key) pairs in fact_kpis with one query
+        def load_max_dates(self):
+                exec_string = "SELECT metric_key, origin_key, MAX(date) as val FROM fact_kpis GROUP BY 1,2;"
 
                 with self.engine.connect() as connection:
                         result = connection.execute(exec_string)
-                for row in result:
-                        val = row['val']
-                return val
+                        max_dates = {(row['metric_key'], row['origin_key']): row['val'] for row in result}
+                print(f"...loaded {len(max_dates)} fact_kpis watermarks")
+                return max_dates
+
+        ## loads max(date) for all origin_keys in the blockspace fact tables with one query (imx only has sub category level data)
+        def load_blockspace_max_dates(self):
+                exec_string = """
+                        SELECT origin_key, MAX(date) as val FROM blockspace_fact_contract_level WHERE origin_key <> 'imx' GROUP BY 1
+                        UNION ALL
+                        SELECT origin_key, MAX(date) as val FROM blockspace_fact_sub_category_level WHERE origin_key = 'imx' GROUP BY 1;
+                """
+
+                with self.engine.connect() as connection:
+                        result = connection.execute(exec_string)
+                        max_dates = {row['origin_key']: row['val'] for row in result}
+                return max_dates
+
+        def get_max_date(self, metric_key:str, origin_key:str):
+                with self.watermark_lock:
+                        if self.max_dates is None:
+                                self.max_dates = self.load_max_dates()
+                        return self.max_dates.get((metric_key, origin_key))
         
         def get_blockspace_max_date(self, origin_key:str):
-                if origin_key == 'imx':
-                        exec_string = f"SELECT MAX(date) as val FROM blockspace_fact_sub_category_level WHERE origin_key = '{origin_key}';"                        
+                with self.watermark_lock:
+                        if self.blockspace_max_dates is None:
+                                self.blockspace_max_dates = self.load_blockspace_max_dates()
+                        return self.blockspace_max_dates.get(origin_key)
+
+        ## keeps the cached watermarks in sync after an upsert (only if they were loaded already)
+        def update_watermarks(self, table_name:str, df:pd.DataFrame):
+                if table_name == 'fact_kpis':
+                        watermarks, keys = self.max_dates, ['metric_key', 'origin_key']
+                elif table_name == 'blockspace_fact_contract_level' or table_name == 'blockspace_fact_sub_category_level':
+                        watermarks, keys = self.blockspace_max_dates, ['origin_key']
                 else:
-                        exec_string = f"SELECT MAX(date) as val FROM blockspace_fact_contract_level WHERE origin_key = '{origin_key}';"
+                        return
+                if watermarks is None:
+                        return
+
+                df = df.reset_index()
+                if table_name == 'blockspace_fact_sub_category_level':
+                        df = df[df['origin_key'] == 'imx']
+                elif table_name == 'blockspace_fact_contract_level':
+                        df = df[df['origin_key'] != 'imx']
+
+                new_max_dates = pd.to_datetime(df['date']).dt.date.groupby([df[k] for k in keys]).max()
+                with self.watermark_lock:
+                        for key, val in new_max_dates.items():
+                                if watermarks.get(key) is None or val > watermarks[key]:
+                                        watermarks[key] = val
+
+        def get_prices_daily_max_dates(self):
+                exec_string = "SELECT token_symbol, MAX(date) as val FROM prices_daily GROUP BY 1;"
 
                 with self.engine.connect() as connection:
                         result = connection.execute(exec_string)
-                for row in result:
-                        val = row['val']
-                return val
-        
+                        max_dates = {row['token_symbol']: row['val'] for row in result}
+                return max_dates
+
         def get_max_block(self, table_name:str):
-                exec_string = f"SELECT MAX(block_number) as val FROM {table_name};"
+                ## partitioned tables: only look into the newest non-empty partition instead of merging the max of all partitions
+                if self.is_partitioned(table_name):
+                        for partition_name in sorted(self.get_partitions(table_name), reverse=True):
+                                val = self.get_max_block(partition_name)
+                                if val != 0:
+                                        return val
+                        return 0
+
+                exec_string = "SELECT MAX(block_number) as val FROM {{table_name}};"
 
                 with self.engine.connect() as connection:
-                        result = connection.execute(exec_string)
+                        result = register_template(exec_string, 'max_block').execute(connection, {'table_name': table_name})
                 for row in result:
                         val = row['val']
                 
@@ -78,36 +172,60 @@ class DbConnector:
                 else:
                         return val
         
-        def get_values_in_eth(self, raw_metrics, days): ## also make sure to add new metrics in adapter_sql
-                mk_string = "'" + "', '".join(raw_metrics) + "'"
-                print(f"load usd values for : {mk_string}")
-                exec_string = f'''
+        ## with only_changed, only rows whose eth value differs from the one that is already stored in fact_kpis are returned
+        ## (new usd values, changed usd values or changed eth prices), missing eth prices are compared as 0 like they are loaded.
+        ## This only shrinks the upsert: the conversion still reads the whole days window of fact_kpis (and joins it against fact_kpis again
+        ## for the comparison), fact_kpis has no updated_at column that would allow to only convert rows that changed since the last run
+        def get_values_in_eth(self, raw_metrics, days, only_changed:bool=False): ## also make sure to add new metrics in adapter_sql
+                print(f"load usd values for : {raw_metrics}")
+                exec_string = '''
                         with eth_price as (
                                 SELECT "date", value
                                 FROM fact_kpis
                                 WHERE metric_key = 'price_usd' and origin_key = 'ethereum'
-                        )
+                        ),
 
-                        SELECT 
-                                Case tkd.metric_key 
-                                        WHEN 'rent_paid_usd' THEN 'rent_paid_eth'
-                                        WHEN 'fees_paid_usd' THEN 'fees_paid_eth'
-                                        WHEN 'profit_usd' THEN 'profit_eth'
-                                        WHEN 'tvl' THEN 'tvl_eth'
-                                        WHEN 'stables_mcap' THEN 'stables_mcap_eth' 
-                                        WHEN 'txcosts_median_usd' THEN 'txcosts_median_eth'
-                                        ELSE 'error'
-                                END AS metric_key, 
-                                tkd.origin_key,
-                                tkd."date", 
-                                tkd.value / p.value as value
-                        FROM fact_kpis tkd
-                        LEFT JOIN eth_price p on tkd."date" = p."date"
-                        WHERE tkd.metric_key in ({mk_string})
-                                AND tkd.date < date_trunc('day', NOW()) 
-                                AND tkd.date >= date_trunc('day',now()) - interval '{days} days'
+                        converted as (
+                                SELECT 
+                                        Case tkd.metric_key 
+                                                WHEN 'rent_paid_usd' THEN 'rent_paid_eth'
+                                                WHEN 'fees_paid_usd' THEN 'fees_paid_eth'
+                                                WHEN 'profit_usd' THEN 'profit_eth'
+                                                WHEN 'tvl' THEN 'tvl_eth'
+                                                WHEN 'stables_mcap' THEN 'stables_mcap_eth' 
+                                                WHEN 'txcosts_median_usd' THEN 'txcosts_median_eth'
+                                                WHEN 'txcosts_p10_usd' THEN 'txcosts_p10_eth'
+                                                WHEN 'txcosts_p90_usd' THEN 'txcosts_p90_eth'
+                                                ELSE 'error'
+                                        END AS metric_key, 
+                                        tkd.origin_key,
+                                        tkd."date", 
+                                        tkd.value / p.value as value
+                                FROM fact_kpis tkd
+                                LEFT JOIN eth_price p on tkd."date" = p."date"
+                                WHERE tkd.metric_key = ANY(CAST('{{metric_keys}}' AS varchar[]))
+                                        AND tkd.date < date_trunc('day', NOW()) 
+                                        AND tkd.date >= date_trunc('day',now()) - interval '{{days}} days'
+                        )
                 '''
-                df = pd.read_sql(exec_string, self.engine.connect())
+                ## values are compared with a relative tolerance, the division by the eth price isn't bit-stable across recomputes
+                if only_changed:
+                        exec_string += '''
+                        SELECT c.*
+                        FROM converted c
+                        LEFT JOIN fact_kpis e on e.metric_key = c.metric_key AND e.origin_key = c.origin_key AND e."date" = c."date"
+                        WHERE e.value IS NULL
+                                OR abs(e.value - coalesce(c.value, 0)) > 1e-9 * greatest(abs(e.value), abs(coalesce(c.value, 0)))
+                        '''
+                        template = register_template(exec_string, 'values_in_eth_changed')
+                else:
+                        exec_string += "SELECT * FROM converted"
+                        template = register_template(exec_string, 'values_in_eth')
+
+                with self.engine.connect() as connection:
+                        df = template.read_df(connection, {'metric_keys': list(raw_metrics), 'days': days})
+                if only_changed:
+                        print(f"...{df.shape[0]} eth values changed")
                 return df
         
         def get_latest_imx_refresh_date(self, tbl_name):
@@ -126,130 +244,526 @@ class DbConnector:
                 else:
                         return last_refresh
                 
+        ## the json exports ask for the sources of every chain x metric, so the whole (small) metric_sources table is loaded once
+        ## and kept as metric_key -> {origin_key -> set of sources}. With METRIC_SOURCES_TTL (seconds) it is reloaded after the ttl expired,
+        ## otherwise it is loaded once per DbConnector (i.e. once per export)
+        def load_metric_sources(self):
+                ## NULL sources are left out, they can't be sorted together with the source names
+                exec_string = "SELECT DISTINCT metric_key, origin_key, source FROM metric_sources WHERE source IS NOT NULL;"
+
+                with self.engine.connect() as connection:
+                        result = connection.execute(exec_string)
+                        metric_sources = {}
+                        for row in result:
+                                metric_sources.setdefault(row['metric_key'], {}).setdefault(row['origin_key'], set()).add(row['source'])
+                print(f"...loaded metric_sources for {len(metric_sources)} metrics")
+                return metric_sources
+
         def get_metric_sources(self, metric_key:str, origin_keys:list):
+                with self.metric_sources_lock:
+                        if self.metric_sources is None or (self.metric_sources_ttl is not None and time.time() - self.metric_sources_loaded_at > self.metric_sources_ttl):
+                                self.metric_sources = self.load_metric_sources()
+                                self.metric_sources_loaded_at = time.time()
+                        sources_by_origin = self.metric_sources.get(metric_key, {})
+
                 if len(origin_keys) == 0:
-                        exec_string = f'''
-                                SELECT DISTINCT source
-                                FROM metric_sources
-                                WHERE metric_key = '{metric_key}'
-                        '''
+                        sources = set().union(*sources_by_origin.values())
                 else:
-                        ok_string = "'" + "', '".join(origin_keys) + "'"
-                        exec_string = f'''
-                                SELECT DISTINCT source
-                                FROM metric_sources
-                                WHERE metric_key = '{metric_key}'
-                                        AND origin_key in ({ok_string})
-                        '''
-                        # print (exec_string)
-                
-
-                df = pd.read_sql(exec_string, self.engine.connect())
-                return df['source'].to_list()
+                        sources = set().union(*[sources_by_origin.get(origin_key, set()) for origin_key in origin_keys])
+                return sorted(sources)
         
 
-        def get_blockspace_contracts(self, chain, days):
-                ## Mantle stores fees in MNT: hence different logic for gas_fees_eth and gas_fees_usd
-                if chain == 'mantle':
-                        additional_cte = """
-                                , mnt_price AS (
-                                        SELECT "date", price_usd as value
-                                        FROM public.prices_daily
-                                        WHERE token_symbol = 'MNT'
-                                )
-                        """
-                        tx_fee_eth_string = 'tx_fee * mp.value / p.value'
-                        tx_fee_usd_string = 'tx_fee * mp.value'                        
-                        additional_join = """LEFT JOIN mnt_price mp on date_trunc('day', tx.block_timestamp) = mp."date" """
+# ------------------------- partitioned tx tables -------------------------
+        ## The {chain}_tx tables can be migrated to declarative monthly range partitions on block_timestamp (see migrate_tx_table).
+        ## Partitions are named {chain}_tx_yYYYYmMM, date-windowed aggregations only scan the partitions of their window
+        ## and old partitions can be detached (see detach_tx_partitions) and moved to cold storage.
+        ## Both the heap and the partitioned layout are supported by upsert_table and get_max_block, so chains can be migrated one by one.
+        def get_partition_name(self, table_name:str, month) -> str:
+                return f"{table_name}_y{month.year}m{month.month:02d}"
+
+        ## dict partitioned table -> set of partition names
+        def load_partitions(self):
+                exec_string = """
+                        SELECT parent.relname AS table_name, child.relname AS partition_name
+                        FROM pg_partitioned_table pt
+                        JOIN pg_class parent ON parent.oid = pt.partrelid
+                        LEFT JOIN pg_inherits i ON i.inhparent = pt.partrelid
+                        LEFT JOIN pg_class child ON child.oid = i.inhrelid;
+                """
+                with self.engine.connect() as connection:
+                        result = connection.execute(exec_string)
+                        partitions = {}
+                        for row in result:
+                                partitions.setdefault(row['table_name'], set())
+                                if row['partition_name'] is not None:
+                                        partitions[row['table_name']].add(row['partition_name'])
+                return partitions
+
+        def get_partitions(self, table_name:str) -> set:
+                with self.partition_lock:
+                        if self.partitions is None:
+                                self.partitions = self.load_partitions()
+                        return set(self.partitions.get(table_name, set()))
+
+        ## answered from the cached partitions (tables that are not partitioned included), so upserts don't query the catalog.
+        ## The cache is loaded once per DbConnector (i.e. per task) and only reloaded by migrate_tx_table (refresh=True) and
+        ## kept up to date by create_tx_partitions and detach_tx_partitions
+        def is_partitioned(self, table_name:str, refresh:bool=False) -> bool:
+                with self.partition_lock:
+                        if self.partitions is None or refresh:
+                                self.partitions = self.load_partitions()
+                        return table_name in self.partitions
+
+        ## creates the monthly partitions from the month of start_date up to and including the month of end_date
+        def create_tx_partitions(self, table_name:str, start_date, end_date):
+                existing = self.get_partitions(table_name)
+                month = pd.Timestamp(start_date).to_period('M')
+                created = []
+                while month <= pd.Timestamp(end_date).to_period('M'):
+                        partition_name = self.get_partition_name(table_name, month.start_time.date())
+                        if partition_name not in existing:
+                                exec_string = f"""
+                                        CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name}
+                                        FOR VALUES FROM ('{month.start_time.date()}') TO ('{(month + 1).start_time.date()}');
+                                """
+                                with self.engine.connect() as connection:
+                                        connection.execute(exec_string)
+                                created.append(partition_name)
+                        month += 1
+
+                if len(created) > 0:
+                        with self.partition_lock:
+                                self.partitions.setdefault(table_name, set()).update(created)
+                        print(f"...created partitions {created}")
+                return created
+
+        ## Migrates a heap {chain}_tx table to monthly partitions:
+        ## the heap is renamed to {table_name}_heap, a partitioned table with the same columns is created (PK on tx_hash and block_timestamp,
+        ## the non-unique indexes of the heap recreated as partitioned indexes, a btree index on block_number and BRIN indexes on block_number
+        ## and block_timestamp, all inherited by the partitions) and the rows are copied month by month.
+        ## Loaders that run during the migration already write into the new table. The heap is only dropped if drop_heap is True.
+        def migrate_tx_table(self, table_name:str, drop_heap:bool=False):
+                if self.is_partitioned(table_name, refresh=True):
+                        print(f"{table_name} is already partitioned")
+                        return
+
+                exec_string = f"SELECT MIN(block_timestamp) AS min_ts, MAX(block_timestamp) AS max_ts FROM {table_name};"
+                with self.engine.connect() as connection:
+                        row = connection.execute(exec_string).fetchone()
+                if row['min_ts'] is None:
+                        start_date = end_date = pd.Timestamp.today().date()
                 else:
-                        additional_cte = ''
-                        tx_fee_eth_string = 'tx_fee'
-                        tx_fee_usd_string = 'tx_fee * p.value'                        
-                        additional_join = ''
+                        start_date, end_date = row['min_ts'].date(), row['max_ts'].date()
+                ## also create the partition for next month so that loaders don't have to create it at the turn of the month
+                end_date = (pd.Timestamp(end_date).to_period('M') + 1).start_time.date()
 
-                exec_string = f'''
-                        with eth_price as (
-                                SELECT "date", value
-                                FROM fact_kpis
-                                WHERE metric_key = 'price_usd' and origin_key = 'ethereum'
-                        )
+                ## unique indexes (other than the PK) can't be created on a partitioned table without the partition key, they are not carried over
+                exec_string = f"""
+                        SELECT c.relname AS index_name, pg_get_indexdef(i.indexrelid) AS index_def
+                        FROM pg_index i
+                        JOIN pg_class c ON c.oid = i.indexrelid
+                        WHERE i.indrelid = '{table_name}'::regclass AND NOT i.indisunique;
+                """
+                with self.engine.connect() as connection:
+                        heap_indexes = {row['index_name']: row['index_def'] for row in connection.execute(exec_string)}
+                index_strings = []
+                for index_name, index_def in heap_indexes.items():
+                        ## CREATE INDEX {index_name} ON public.{table_name} USING ... -> same definition on the partitioned table
+                        definition = index_def.split(' USING ', 1)[1]
+                        index_strings.append(f"CREATE INDEX {index_name}_part ON {table_name} USING {definition};")
+                if not any(index_def.endswith('USING btree (block_number)') for index_def in heap_indexes.values()):
+                        index_strings.append(f"CREATE INDEX {table_name}_block_number_part ON {table_name} USING btree (block_number);")
+                index_string = '\n                        '.join(index_strings)
 
-                        {additional_cte}
+                exec_string = f"""
+                        ALTER TABLE {table_name} RENAME TO {table_name}_heap;
+                        CREATE TABLE {table_name} (LIKE {table_name}_heap INCLUDING DEFAULTS) PARTITION BY RANGE (block_timestamp);
+                        ALTER TABLE {table_name} ADD CONSTRAINT {table_name}_part_pkey PRIMARY KEY (tx_hash, block_timestamp);
+                        {index_string}
+                        CREATE INDEX {table_name}_block_number_brin ON {table_name} USING brin (block_number);
+                        CREATE INDEX {table_name}_block_timestamp_brin ON {table_name} USING brin (block_timestamp);
+                """
+                with self.engine.begin() as connection:
+                        connection.execute(exec_string)
+                print(f"...created {len(index_strings)} partitioned indexes (from the indexes of the heap)")
+                with self.partition_lock:
+                        self.partitions = None
+                print(f"...created partitioned table {table_name}")
+                self.create_tx_partitions(table_name, start_date, end_date)
 
-                        select
-                                to_address as address,
-                                date_trunc('day', block_timestamp) as date,
-                                sum({tx_fee_eth_string}) as gas_fees_eth,
-                                sum({tx_fee_usd_string}) as gas_fees_usd,
-                                count(*) as txcount,
-                                count(distinct from_address) as daa,
-                                '{chain}' as origin_key
-                        from {chain}_tx tx 
-                        LEFT JOIN eth_price p on date_trunc('day', tx.block_timestamp) = p."date"
-                        {additional_join}
-                        where block_timestamp < DATE_TRUNC('day', NOW())
-                                and block_timestamp >= DATE_TRUNC('day', NOW() - INTERVAL '{days} days')
-                                and empty_input = false -- we don't have to store addresses that received native transfers
-                                and tx_fee > 0 -- no point in counting txs with 0 fees (most likely system tx)
-                                and to_address <> '' 
-                                and to_address is not null -- filter out contract creations arbitrum, optimism
-                                and to_address <> '\\x0000000000000000000000000000000000008006' -- filter out contract creations zksync
-                                and to_address <> 'None' -- filter out zora and pgn contract creation
-                        group by 1,2
-                        having count(*) > 1
-                '''
-                df = pd.read_sql(exec_string, self.engine.connect())
-                return df
-        
-        def get_blockspace_native_transfers(self, chain, days):
-                ## Mantle stores fees in MNT: hence different logic for gas_fees_eth and gas_fees_usd
-                if chain == 'mantle':
-                        additional_cte = """
-                                , mnt_price AS (
-                                        SELECT "date", price_usd as value
-                                        FROM public.prices_daily
-                                        WHERE token_symbol = 'MNT'
-                                )
+                for month in pd.period_range(start_date, end_date, freq='M'):
+                        exec_string = f"""
+                                INSERT INTO {table_name}
+                                SELECT * FROM {table_name}_heap
+                                WHERE block_timestamp >= '{month.start_time.date()}' AND block_timestamp < '{(month + 1).start_time.date()}'
+                                ON CONFLICT DO NOTHING;
                         """
-                        tx_fee_eth_string = 'tx_fee * mp.value / p.value'
-                        tx_fee_usd_string = 'tx_fee * mp.value'                        
-                        additional_join = """LEFT JOIN mnt_price mp on date_trunc('day', tx.block_timestamp) = mp."date" """
-                else:
-                        additional_cte = ''
-                        tx_fee_eth_string = 'tx_fee'
-                        tx_fee_usd_string = 'tx_fee * p.value'                        
-                        additional_join = ''
+                        with self.engine.begin() as connection:
+                                result = connection.execute(exec_string)
+                        print(f"...copied {result.rowcount} rows of {month} to {self.get_partition_name(table_name, month.start_time.date())}")
 
+                with self.engine.connect() as connection:
+                        connection.execute(f"ANALYZE {table_name};")
+                if drop_heap:
+                        with self.engine.connect() as connection:
+                                connection.execute(f"DROP TABLE {table_name}_heap;")
+                        print(f"...dropped {table_name}_heap")
+                print(f"Migration of {table_name} done")
 
-                ## native transfers: all transactions that have no input data
-                exec_string = f'''
-                        with eth_price as (
-                                SELECT "date", value
-                                FROM fact_kpis
-                                WHERE metric_key = 'price_usd' and origin_key = 'ethereum'
+        ## detaches all partitions that only contain data before the month of before_date, returns the detached partitions
+        ## (they stay available as regular tables and can be dumped or moved to a cheaper tablespace)
+        def detach_tx_partitions(self, table_name:str, before_date):
+                if not self.is_partitioned(table_name):
+                        print(f"{table_name} is not partitioned")
+                        raise ValueError(f"{table_name} is not partitioned")
+
+                first_kept = self.get_partition_name(table_name, pd.Timestamp(before_date).to_period('M').start_time.date())
+                detached = []
+                for partition_name in sorted(self.get_partitions(table_name)):
+                        if partition_name < first_kept:
+                                with self.engine.connect() as connection:
+                                        connection.execute(f"ALTER TABLE {table_name} DETACH PARTITION {partition_name};")
+                                detached.append(partition_name)
+
+                with self.partition_lock:
+                        self.partitions[table_name].difference_update(detached)
+                print(f"...detached partitions {detached}")
+                return detached
+
+# ------------------------- chain daily rollup -------------------------
+        ## chain_daily_rollup holds one row per chain and day with all aggregates that the KPI queries need.
+        ## It is maintained incrementally: only days that received new blocks since the last refresh are recomputed,
+        ## so every tx row is only read once per run no matter how many metrics are derived from it.
+        def create_chain_daily_rollup(self):
+                exec_string = """
+                        CREATE TABLE IF NOT EXISTS chain_daily_rollup (
+                                "date" date NOT NULL,
+                                origin_key varchar NOT NULL,
+                                txcount_raw int8 NULL, -- all txs (arbitrum: only txs with gas_used > 0)
+                                txcount int8 NULL, -- txs with gas_price <> 0
+                                daa int8 NULL, -- distinct senders of txs with gas_price <> 0
+                                fees_paid numeric NULL, -- sum of tx_fee in the native gas token
+                                txcosts_median numeric NULL, -- median tx_fee of txs with gas_price <> 0 in the native gas token (from fee_digest)
+                                txcosts_p10 numeric NULL,
+                                txcosts_p90 numeric NULL,
+                                fee_digest bytea NULL, -- t-digest of tx_fee of txs with gas_price <> 0 (see src/misc/sketches.py)
+                                max_block int8 NULL,
+                                updated_at timestamp NULL,
+                                CONSTRAINT chain_daily_rollup_pkey PRIMARY KEY ("date", origin_key)
+                        );
+
+                        ALTER TABLE chain_daily_rollup ADD COLUMN IF NOT EXISTS txcosts_p10 numeric NULL;
+                        ALTER TABLE chain_daily_rollup ADD COLUMN IF NOT EXISTS txcosts_p90 numeric NULL;
+                        ALTER TABLE chain_daily_rollup ADD COLUMN IF NOT EXISTS fee_digest bytea NULL;
+                """
+                with self.engine.connect() as connection:
+                        connection.execute(exec_string)
+
+        def get_rollup_max_block(self, origin_key:str):
+                exec_string = "SELECT MAX(max_block) as val FROM chain_daily_rollup WHERE origin_key = '{{origin_key}}';"
+
+                with self.engine.connect() as connection:
+                        result = register_template(exec_string, 'rollup_max_block').execute(connection, {'origin_key': origin_key})
+                for row in result:
+                        val = row['val']
+                return val
+
+        ## recomputes all days of a chain that contain blocks newer than the last refresh (all days on the first run), returns the refreshed dates
+        ## the fee quantiles of these dates are set afterwards from the fee digests (see update_rollup_fee_digests)
+        ## recomputes all days that received blocks above the stored max_block plus always the last recompute_days days of the rollup,
+        ## blocks that arrive late with lower block numbers (gap filler, concurrent batch upserts of the raw loaders) are picked up by the trailing window
+        def refresh_chain_daily_rollup(self, origin_key:str, recompute_days:int=5):
+                max_block = self.get_rollup_max_block(origin_key)
+                if max_block is None:
+                        max_block = -1
+                raw_filter = 'gas_used > 0' if origin_key == 'arbitrum' else 'true'
+
+                exec_string = f"""
+                        WITH touched_days AS (
+                                SELECT DISTINCT date_trunc('day', block_timestamp) AS day
+                                FROM {origin_key}_tx
+                                WHERE block_number > {max_block}
+                                UNION
+                                SELECT generate_series(CAST(MAX("date") - {int(recompute_days)} AS timestamp), CAST(MAX("date") AS timestamp), interval '1 day') AS day
+                                FROM chain_daily_rollup
+                                WHERE origin_key = '{origin_key}'
                         )
-                        {additional_cte}
+                        INSERT INTO chain_daily_rollup ("date", origin_key, txcount_raw, txcount, daa, fees_paid, max_block, updated_at)
+                        SELECT
+                                date_trunc('day', block_timestamp)::date AS "date",
+                                '{origin_key}' AS origin_key,
+                                COUNT(*) FILTER (WHERE {raw_filter}) AS txcount_raw,
+                                COUNT(*) FILTER (WHERE gas_price <> 0) AS txcount,
+                                COUNT(DISTINCT from_address) FILTER (WHERE gas_price <> 0) AS daa,
+                                SUM(tx_fee) AS fees_paid,
+                                MAX(block_number) AS max_block,
+                                NOW() AS updated_at
+                        FROM {origin_key}_tx
+                        WHERE block_timestamp >= (SELECT MIN(day) FROM touched_days)
+                                AND date_trunc('day', block_timestamp) IN (SELECT day FROM touched_days)
+                        GROUP BY 1
+                        ON CONFLICT ("date", origin_key) DO UPDATE SET
+                                txcount_raw = EXCLUDED.txcount_raw,
+                                txcount = EXCLUDED.txcount,
+                                daa = EXCLUDED.daa,
+                                fees_paid = EXCLUDED.fees_paid,
+                                max_block = EXCLUDED.max_block,
+                                updated_at = EXCLUDED.updated_at
+                        RETURNING "date";
+                """
+                ## WITH ... INSERT isn't detected as a write statement by sqlalchemy's autocommit, hence the explicit transaction
+                with self.engine.begin() as connection:
+                        result = connection.execute(exec_string)
+                        dates = [row['date'] for row in result]
+                return dates
 
+        ## dates in chain_daily_rollup starting from start_date (all dates if start_date is None)
+        def get_rollup_dates(self, origin_key:str, start_date=None):
+                exec_string = "SELECT \"date\" FROM chain_daily_rollup WHERE origin_key = '{{origin_key}}' AND \"date\" >= CAST('{{start_date}}' AS date);"
+                if start_date is None:
+                        start_date = '1970-01-01'
+
+                with self.engine.connect() as connection:
+                        result = register_template(exec_string, 'rollup_dates').execute(connection, {'origin_key': origin_key, 'start_date': start_date})
+                        dates = [row['date'] for row in result]
+                return dates
+
+        ## tx fees of the given dates pre-aggregated into log-spaced buckets of ~1% width, used as centroids for the fee t-digests
+        def get_fee_buckets(self, origin_key:str, dates:list):
+                date_string = "'" + "', '".join([str(d) for d in dates]) + "'"
+                exec_string = f"""
                         SELECT 
-                                date_trunc('day', block_timestamp) as date,
-                                'native_transfer' as sub_category_key,
-                                '{chain}' as origin_key,
-                                sum({tx_fee_eth_string}) as gas_fees_eth,
-                                sum({tx_fee_usd_string}) as gas_fees_usd,
-                                count(*) as txcount,
-                                count(distinct from_address) as daa
-                        FROM {chain}_tx tx 
-                        LEFT JOIN eth_price p on date_trunc('day', tx.block_timestamp) = p."date"
-                        {additional_join}
-                        where block_timestamp < DATE_TRUNC('day', NOW())
-                                and block_timestamp >= DATE_TRUNC('day', NOW() - INTERVAL '{days} days')
-                                and empty_input = true
-                        group by 1
-                '''
-                df = pd.read_sql(exec_string, self.engine.connect())
+                                date_trunc('day', block_timestamp)::date AS day,
+                                CASE WHEN tx_fee > 0 THEN round(ln(tx_fee) * 100) ELSE NULL END AS bucket,
+                                AVG(tx_fee)::float8 AS mean,
+                                COUNT(*) AS count
+                        FROM {origin_key}_tx
+                        WHERE gas_price <> 0
+                                AND block_timestamp >= '{min(dates)}'
+                                AND date_trunc('day', block_timestamp)::date IN ({date_string})
+                        GROUP BY 1,2
+                """
+                with self.engine.connect() as connection:
+                        df = pd.read_sql(exec_string, connection)
                 return df
-        
-        def get_blockspace_contract_deplyments(self, chain, days):
+
+        ## df with columns date, fee_digest, txcosts_median, txcosts_p10, txcosts_p90
+        def update_rollup_fee_digests(self, origin_key:str, df:pd.DataFrame):
+                exec_string = sqlalchemy.text("""
+                        UPDATE chain_daily_rollup SET
+                                fee_digest = :fee_digest,
+                                txcosts_median = :txcosts_median,
+                                txcosts_p10 = :txcosts_p10,
+                                txcosts_p90 = :txcosts_p90
+                        WHERE "date" = :date AND origin_key = :origin_key;
+                """)
+                if df.shape[0] > 0:
+                        records = df.assign(origin_key=origin_key).to_dict('records')
+                        with self.engine.begin() as connection:
+                                connection.execute(exec_string, records)
+                return df.shape[0]
+
+        ## fee digests of all chains incl. the usd price of their gas token (MNT for mantle, ETH for all others)
+        def get_fee_digests(self, start_date, end_date):
+                exec_string = """
+                        SELECT r."date", r.origin_key, r.fee_digest, p.price_usd
+                        FROM chain_daily_rollup r
+                        LEFT JOIN prices_daily p ON r."date" = p."date" 
+                                AND p.token_symbol = CASE WHEN r.origin_key = 'mantle' THEN 'MNT' ELSE 'ETH' END
+                        WHERE r.fee_digest IS NOT NULL
+                                AND r."date" >= '{{start_date}}' AND r."date" < '{{end_date}}'
+                """
+                with self.engine.connect() as connection:
+                        df = register_template(exec_string, 'fee_digests').read_df(connection, {'start_date': start_date, 'end_date': end_date})
+                df['fee_digest'] = df['fee_digest'].apply(bytes)
+                return df
+
+        ## HyperLogLog sketches of the active addresses per chain and day (see src/misc/sketches.py)
+        def create_chain_daily_hll(self):
+                exec_string = """
+                        CREATE TABLE IF NOT EXISTS chain_daily_hll (
+                                "date" date NOT NULL,
+                                origin_key varchar NOT NULL,
+                                hll bytea NOT NULL, -- zlib compressed HLL registers (p=14)
+                                updated_at timestamp NULL,
+                                CONSTRAINT chain_daily_hll_pkey PRIMARY KEY ("date", origin_key)
+                        );
+                """
+                with self.engine.connect() as connection:
+                        connection.execute(exec_string)
+
+        ## hll registers (day, idx, rho) of the senders: first 14 bits of md5(address) select the register, rho is the position of the first 1-bit in the next 50 bits
+        def get_hll_registers(self, address_sql:str):
+                exec_string = f"""
+                        WITH hashed AS (
+                                SELECT day, ('x' || substr(md5(address), 1, 16))::bit(64) AS h
+                                FROM ({address_sql}) a
+                        )
+                        SELECT 
+                                day,
+                                substring(h from 1 for 14)::bit(14)::int AS idx,
+                                MAX(COALESCE(NULLIF(position(B'1' in substring(h from 15 for 50)), 0), 51)) AS rho
+                        FROM hashed
+                        GROUP BY 1,2
+                """
+                with self.engine.connect() as connection:
+                        df = pd.read_sql(exec_string, connection)
+                return df
+
+        ## active addresses (day, address) of a chain on the given dates
+        def get_chain_address_sql(self, origin_key:str, dates:list):
+                date_string = "'" + "', '".join([str(d) for d in dates]) + "'"
+                address_sql = f"""
+                        SELECT date_trunc('day', block_timestamp)::date AS day, from_address AS address
+                        FROM {origin_key}_tx
+                        WHERE block_timestamp >= '{min(dates)}'
+                                AND date_trunc('day', block_timestamp)::date IN ({date_string})
+                """
+                return address_sql
+
+        ## imx has no tx table, active addresses are collected from deposits, withdrawals, orders and transfers (same as user_base)
+        ## from start_date until end_date (exclusive, open ended if None)
+        def get_imx_address_sql(self, start_date, end_date=None):
+                end_filter = f"AND {{col}} < '{end_date}'" if end_date is not None else ""
+                address_sql = f"""
+                        SELECT date_trunc('day', "timestamp")::date AS day, "user" AS address FROM imx_deposits
+                        WHERE "timestamp" >= '{start_date}' {end_filter.format(col='"timestamp"')}
+                        UNION ALL
+                        SELECT date_trunc('day', "timestamp")::date AS day, "sender" AS address FROM imx_withdrawals
+                        WHERE "timestamp" >= '{start_date}' {end_filter.format(col='"timestamp"')}
+                        UNION ALL
+                        SELECT date_trunc('day', updated_timestamp)::date AS day, "user" AS address FROM imx_orders
+                        WHERE updated_timestamp >= '{start_date}' {end_filter.format(col='updated_timestamp')}
+                        UNION ALL
+                        SELECT date_trunc('day', "timestamp")::date AS day, "user" AS address FROM imx_transfers
+                        WHERE "timestamp" >= '{start_date}' {end_filter.format(col='"timestamp"')}
+                """
+                return address_sql
+
+        def get_hll_max_date(self, origin_key:str):
+                exec_string = "SELECT MAX(date) as val FROM chain_daily_hll WHERE origin_key = '{{origin_key}}';"
+
+                with self.engine.connect() as connection:
+                        result = register_template(exec_string, 'hll_max_date').execute(connection, {'origin_key': origin_key})
+                for row in result:
+                        val = row['val']
+                return val
+
+        ## df with columns date, origin_key, hll (bytes)
+        def upsert_hll_sketches(self, df:pd.DataFrame):
+                exec_string = sqlalchemy.text("""
+                        INSERT INTO chain_daily_hll ("date", origin_key, hll, updated_at)
+                        VALUES (:date, :origin_key, :hll, NOW())
+                        ON CONFLICT ("date", origin_key) DO UPDATE SET
+                                hll = EXCLUDED.hll,
+                                updated_at = EXCLUDED.updated_at;
+                """)
+                if df.shape[0] > 0:
+                        with self.engine.begin() as connection:
+                                connection.execute(exec_string, df[['date', 'origin_key', 'hll']].to_dict('records'))
+                return df.shape[0]
+
+        def get_hll_sketches(self, start_date, end_date):
+                exec_string = """
+                        SELECT "date", origin_key, hll
+                        FROM chain_daily_hll
+                        WHERE "date" >= '{{start_date}}' AND "date" < '{{end_date}}'
+                """
+                with self.engine.connect() as connection:
+                        df = register_template(exec_string, 'hll_sketches').read_df(connection, {'start_date': start_date, 'end_date': end_date})
+                df['hll'] = df['hll'].apply(bytes)
+                return df
+
+        ## Exact active addresses: every address gets a dense integer id in address_dictionary,
+        ## chain_daily_bitmap stores the ids that were active per chain and day as serialized roaring bitmaps (see src/misc/address_bitmaps.py)
+        def create_address_bitmap_tables(self):
+                exec_string = """
+                        CREATE TABLE IF NOT EXISTS address_dictionary (
+                                address_id serial4 NOT NULL,
+                                address bytea NOT NULL,
+                                CONSTRAINT address_dictionary_pkey PRIMARY KEY (address),
+                                CONSTRAINT address_dictionary_address_id_key UNIQUE (address_id)
+                        );
+
+                        CREATE TABLE IF NOT EXISTS chain_daily_bitmap (
+                                "date" date NOT NULL,
+                                origin_key varchar NOT NULL,
+                                bitmap bytea NOT NULL, -- serialized roaring bitmap of address_ids
+                                updated_at timestamp NULL,
+                                CONSTRAINT chain_daily_bitmap_pkey PRIMARY KEY ("date", origin_key)
+                        );
+                """
+                with self.engine.connect() as connection:
+                        connection.execute(exec_string)
+
+        ## adds new addresses to the dictionary and returns (day, address_id) of all active addresses
+        ## address_sql is scanned once into a temp table. The dictionary inserts of concurrent chains (run_rollup) are serialized with an advisory lock
+        ## and sorted by address, so they can't deadlock on each other's duplicate keys and no serial values are burned by conflicts (ids stay dense)
+        def get_active_address_ids(self, address_sql:str):
+                with self.engine.connect() as connection:
+                        with connection.begin():
+                                ## a pooled connection may still hold the temp table of a failed earlier run
+                                connection.execute("DROP TABLE IF EXISTS tmp_active_addresses;")
+                                connection.execute(f"""
+                                        CREATE TEMP TABLE tmp_active_addresses AS
+                                        SELECT DISTINCT day, address FROM ({address_sql}) x;
+                                """)
+                                connection.execute("SELECT pg_advisory_xact_lock(hashtext('address_dictionary'));")
+                                connection.execute("""
+                                        INSERT INTO address_dictionary (address)
+                                        SELECT DISTINCT a.address
+                                        FROM tmp_active_addresses a
+                                        WHERE NOT EXISTS (SELECT 1 FROM address_dictionary d WHERE d.address = a.address)
+                                        ORDER BY a.address
+                                        ON CONFLICT (address) DO NOTHING;
+                                """)
+                        ## the lock is released with the commit above, the lookup of the ids doesn't need it
+                        df = pd.read_sql("""
+                                SELECT a.day, d.address_id
+                                FROM tmp_active_addresses a
+                                JOIN address_dictionary d ON d.address = a.address
+                        """, connection)
+                        connection.execute("DROP TABLE tmp_active_addresses;")
+                return df
+
+        def get_bitmap_max_date(self, origin_key:str):
+                exec_string = "SELECT MAX(date) as val FROM chain_daily_bitmap WHERE origin_key = '{{origin_key}}';"
+
+                with self.engine.connect() as connection:
+                        result = register_template(exec_string, 'bitmap_max_date').execute(connection, {'origin_key': origin_key})
+                for row in result:
+                        val = row['val']
+                return val
+
+        ## df with columns date, origin_key, bitmap (bytes)
+        def upsert_bitmaps(self, df:pd.DataFrame):
+                exec_string = sqlalchemy.text("""
+                        INSERT INTO chain_daily_bitmap ("date", origin_key, bitmap, updated_at)
+                        VALUES (:date, :origin_key, :bitmap, NOW())
+                        ON CONFLICT ("date", origin_key) DO UPDATE SET
+                                bitmap = EXCLUDED.bitmap,
+                                updated_at = EXCLUDED.updated_at;
+                """)
+                if df.shape[0] > 0:
+                        with self.engine.begin() as connection:
+                                connection.execute(exec_string, df[['date', 'origin_key', 'bitmap']].to_dict('records'))
+                return df.shape[0]
+
+        def get_bitmaps(self, start_date, end_date):
+                exec_string = """
+                        SELECT "date", origin_key, bitmap
+                        FROM chain_daily_bitmap
+                        WHERE "date" >= '{{start_date}}' AND "date" < '{{end_date}}'
+                """
+                with self.engine.connect() as connection:
+                        df = register_template(exec_string, 'bitmaps').read_df(connection, {'start_date': start_date, 'end_date': end_date})
+                df['bitmap'] = df['bitmap'].apply(bytes)
+                return df
+
+        ## Aggregates contract level usage, total usage, native transfers and smart contract deployments of a chain in one scan of {chain}_tx.
+        ## Every tx is expanded (lateral values) into one row per group that it counts for, groups that don't apply are null and dropped.
+        ## Returns one df with columns address (only set for contract rows), date, sub_category_key ('contract' for contract rows), origin_key, gas_fees_eth, gas_fees_usd, txcount, daa
+        def get_blockspace_usage(self, chain, days):
                 ## Mantle stores fees in MNT: hence different logic for gas_fees_eth and gas_fees_usd
                 if chain == 'mantle':
                         additional_cte = """
@@ -269,11 +783,11 @@ class DbConnector:
                         additional_join = ''
 
                 if chain == 'zksync_era':
-                        filter_string = "and to_address = '\\x0000000000000000000000000000000000008006'"
+                        deployment_filter = "to_address = '\\x0000000000000000000000000000000000008006'"
                 elif chain == 'polygon_zkevm':
-                        filter_string = "and receipt_contract_address is not null"
+                        deployment_filter = "receipt_contract_address is not null"
                 else:
-                        filter_string = "and to_address = '' or to_address is null"
+                        deployment_filter = "(to_address = '' or to_address is null)"
 
                 exec_string = f'''
                         with eth_price as (
@@ -283,69 +797,52 @@ class DbConnector:
                         )
                         {additional_cte}
 
-                        SELECT 
-                                date_trunc('day', block_timestamp) as date,
-                                'smart_contract_deployment' as sub_category_key,
-                                '{chain}' as origin_key,
-                                sum({tx_fee_eth_string}) as gas_fees_eth,
-                                sum({tx_fee_usd_string}) as gas_fees_usd,
-                                count(*) as txcount,
-                                count(distinct from_address) as daa
-                        FROM {chain}_tx tx 
-                        LEFT JOIN eth_price p on date_trunc('day', tx.block_timestamp) = p."date"
-                        {additional_join}
-                        where block_timestamp < DATE_TRUNC('day', NOW())
-                                and block_timestamp >= DATE_TRUNC('day', NOW() - INTERVAL '{days} days')
-                                {filter_string}
-                        group by 1
-                '''
-                df = pd.read_sql(exec_string, self.engine.connect())
-                return df
-        
-        def get_blockspace_total(self, chain, days):
-                ## Mantle stores fees in MNT: hence different logic for gas_fees_eth and gas_fees_usd
-                if chain == 'mantle':
-                        additional_cte = """
-                                , mnt_price AS (
-                                        SELECT "date", price_usd as value
-                                        FROM public.prices_daily
-                                        WHERE token_symbol = 'MNT'
-                                )
-                        """
-                        tx_fee_eth_string = 'tx_fee * mp.value / p.value'
-                        tx_fee_usd_string = 'tx_fee * mp.value'                        
-                        additional_join = """LEFT JOIN mnt_price mp on date_trunc('day', tx.block_timestamp) = mp."date" """
-                else:
-                        additional_cte = ''
-                        tx_fee_eth_string = 'tx_fee'
-                        tx_fee_usd_string = 'tx_fee * p.value'                        
-                        additional_join = ''
-
-                exec_string = f'''
-                        with eth_price as (
-                                SELECT "date", value
-                                FROM fact_kpis
-                                WHERE metric_key = 'price_usd' and origin_key = 'ethereum'
+                        , tx_window as (
+                                select
+                                        date_trunc('day', block_timestamp) as date,
+                                        to_address,
+                                        from_address,
+                                        {tx_fee_eth_string} as gas_fees_eth,
+                                        {tx_fee_usd_string} as gas_fees_usd,
+                                        empty_input = false -- we don't have to store addresses that received native transfers
+                                                and tx_fee > 0 -- no point in counting txs with 0 fees (most likely system tx)
+                                                and to_address <> '' 
+                                                and to_address is not null -- filter out contract creations arbitrum, optimism
+                                                and to_address <> '\\x0000000000000000000000000000000000008006' -- filter out contract creations zksync
+                                                and to_address <> 'None' -- filter out zora and pgn contract creation
+                                                as is_contract_call,
+                                        tx_fee > 0 as is_total_usage,
+                                        empty_input = true as is_native_transfer,
+                                        coalesce({deployment_filter}, false) as is_deployment
+                                from {chain}_tx tx 
+                                LEFT JOIN eth_price p on date_trunc('day', tx.block_timestamp) = p."date"
+                                {additional_join}
+                                where block_timestamp < DATE_TRUNC('day', NOW())
+                                        and block_timestamp >= DATE_TRUNC('day', NOW() - INTERVAL '{days} days')
                         )
-                        {additional_cte}
 
-                        select 
-                                date_trunc('day', block_timestamp) as date,
-                                'total_usage' as sub_category_key,
+                        select
+                                g.address,
+                                tx.date,
+                                g.sub_category_key,
                                 '{chain}' as origin_key,
-                                sum({tx_fee_eth_string}) as gas_fees_eth,
-                                sum({tx_fee_usd_string}) as gas_fees_usd, 
+                                sum(tx.gas_fees_eth) as gas_fees_eth,
+                                sum(tx.gas_fees_usd) as gas_fees_usd,
                                 count(*) as txcount,
-                                count(distinct from_address) as daa
-                        from {chain}_tx tx
-                        left join eth_price p on date_trunc('day', tx.block_timestamp) = p."date"
-                        {additional_join}
-                        where block_timestamp < DATE_TRUNC('day', NOW())
-                                and block_timestamp >= DATE_TRUNC('day', NOW() - INTERVAL '{days} days')
-                                and tx_fee > 0 -- no point in counting txs with 0 fees (most likely system tx)
-                        group by 1
-                        '''
-                df = pd.read_sql(exec_string, self.engine.connect())
+                                count(distinct tx.from_address) as daa
+                        from tx_window tx,
+                        lateral (values
+                                (case when tx.is_contract_call then 'contract' end, tx.to_address),
+                                (case when tx.is_total_usage then 'total_usage' end, null),
+                                (case when tx.is_native_transfer then 'native_transfer' end, null),
+                                (case when tx.is_deployment then 'smart_contract_deployment' end, null)
+                        ) as g(sub_category_key, address)
+                        where g.sub_category_key is not null
+                        group by 1,2,3
+                        having count(*) > 1 or g.sub_category_key <> 'contract'
+                '''
+                with self.engine.connect() as connection:
+                        df = pd.read_sql(exec_string, connection)
                 return df
         
         def get_blockspace_sub_categories(self, chain, days):
@@ -411,6 +908,124 @@ class DbConnector:
                 df = pd.read_sql(exec_string, self.engine.connect())
                 return df
         
+# ------------------------- blockspace label changes -------------------------
+        ## etl_state is a small key-value table for the state of incremental jobs (e.g. the last label sync per chain)
+        ## blockspace_labels_applied is a copy of the labels as they are reflected in blockspace_fact_sub_category_level,
+        ## diffing it against blockspace_labels gives the old and the new sub category of every contract whose label changed
+        ## (added_on_time of blockspace_labels only tells when a label was written, not what it was before)
+        def create_blockspace_label_tracking(self):
+                exec_string = """
+                        CREATE TABLE IF NOT EXISTS etl_state (
+                                "key" varchar NOT NULL,
+                                value varchar NULL,
+                                updated_at timestamp NULL,
+                                CONSTRAINT etl_state_pkey PRIMARY KEY ("key")
+                        );
+
+                        CREATE TABLE IF NOT EXISTS blockspace_labels_applied (
+                                address bytea NOT NULL,
+                                origin_key varchar NOT NULL,
+                                sub_category_key varchar NULL,
+                                CONSTRAINT blockspace_labels_applied_pkey PRIMARY KEY (address, origin_key)
+                        );
+                """
+                ## concurrent CREATE TABLE IF NOT EXISTS of the same table can fail on the catalog, so concurrent callers are serialized
+                with self.engine.begin() as connection:
+                        connection.execute("SELECT pg_advisory_xact_lock(hashtext('blockspace_label_tracking'));")
+                        connection.execute(exec_string)
+
+        def get_etl_state(self, key:str):
+                exec_string = "SELECT value FROM etl_state WHERE \"key\" = '{{key}}';"
+
+                with self.engine.connect() as connection:
+                        result = register_template(exec_string, 'etl_state').execute(connection, {'key': key})
+                        val = None
+                        for row in result:
+                                val = row['value']
+                return val
+
+        def set_etl_state(self, key:str, value:str):
+                exec_string = """
+                        INSERT INTO etl_state ("key", value, updated_at) VALUES ('{{key}}', '{{value}}', NOW())
+                        ON CONFLICT ("key") DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+                """
+                with self.engine.begin() as connection:
+                        register_template(exec_string, 'set_etl_state').execute(connection, {'key': key, 'value': value})
+
+        ## sets the applied labels of a chain to the current labels (after a full recompute of the sub categories)
+        def reset_blockspace_labels_applied(self, chain:str):
+                exec_string = f"""
+                        DELETE FROM blockspace_labels_applied WHERE origin_key = '{chain}';
+                        INSERT INTO blockspace_labels_applied (address, origin_key, sub_category_key)
+                        SELECT address, origin_key, lower(sub_category_key) FROM blockspace_labels WHERE origin_key = '{chain}';
+                """
+                with self.engine.begin() as connection:
+                        connection.execute(exec_string)
+
+        ## Moves the historical contribution of all contracts whose label changed since the last run from their old to their new sub category
+        ## (txcount, fees and daa of the sub categories are sums over the contract level, so they can be adjusted by deltas)
+        ## and syncs blockspace_labels_applied in the same transaction. Returns the dates that were adjusted.
+        def apply_blockspace_label_changes(self, chain:str):
+                exec_string = f"""
+                        WITH changed AS (
+                                SELECT 
+                                        coalesce(l.address, a.address) AS address,
+                                        a.sub_category_key AS old_key,
+                                        lower(l.sub_category_key) AS new_key
+                                FROM (SELECT address, sub_category_key FROM blockspace_labels WHERE origin_key = '{chain}') l
+                                FULL OUTER JOIN (SELECT address, sub_category_key FROM blockspace_labels_applied WHERE origin_key = '{chain}') a ON l.address = a.address
+                                WHERE lower(l.sub_category_key) IS DISTINCT FROM a.sub_category_key
+                        ),
+                        contributions AS (
+                                SELECT 
+                                        c.old_key,
+                                        c.new_key,
+                                        cl.date,
+                                        sum(cl.gas_fees_eth) as gas_fees_eth,
+                                        sum(cl.gas_fees_usd) as gas_fees_usd,
+                                        sum(cl.txcount) as txcount,
+                                        sum(cl.daa) as daa
+                                FROM public.blockspace_fact_contract_level cl
+                                INNER JOIN changed c ON cl.address = c.address
+                                WHERE cl.origin_key = '{chain}'
+                                        AND cl.date < DATE_TRUNC('day', NOW())
+                                GROUP BY 1,2,3
+                        ),
+                        deltas AS (
+                                SELECT new_key AS sub_category_key, date, gas_fees_eth, gas_fees_usd, txcount, daa
+                                FROM contributions WHERE new_key IS NOT NULL
+                                UNION ALL
+                                SELECT old_key AS sub_category_key, date, -gas_fees_eth, -gas_fees_usd, -txcount, -daa
+                                FROM contributions WHERE old_key IS NOT NULL
+                        ),
+                        ## the applied labels are synced from the same snapshot of changed, labels committed while this runs are picked up next time
+                        applied_upsert AS (
+                                INSERT INTO blockspace_labels_applied (address, origin_key, sub_category_key)
+                                SELECT address, '{chain}', new_key FROM changed WHERE new_key IS NOT NULL
+                                ON CONFLICT (address, origin_key) DO UPDATE SET sub_category_key = EXCLUDED.sub_category_key
+                        ),
+                        applied_delete AS (
+                                DELETE FROM blockspace_labels_applied a
+                                USING changed c
+                                WHERE a.origin_key = '{chain}' AND a.address = c.address AND c.new_key IS NULL
+                        )
+                        INSERT INTO blockspace_fact_sub_category_level (date, sub_category_key, origin_key, gas_fees_eth, gas_fees_usd, txcount, daa)
+                        SELECT date, sub_category_key, '{chain}', sum(gas_fees_eth), sum(gas_fees_usd), sum(txcount), sum(daa)
+                        FROM deltas
+                        GROUP BY 1,2
+                        ON CONFLICT (date, sub_category_key, origin_key) DO UPDATE SET
+                                gas_fees_eth = coalesce(blockspace_fact_sub_category_level.gas_fees_eth, 0) + coalesce(EXCLUDED.gas_fees_eth, 0),
+                                gas_fees_usd = coalesce(blockspace_fact_sub_category_level.gas_fees_usd, 0) + coalesce(EXCLUDED.gas_fees_usd, 0),
+                                txcount = coalesce(blockspace_fact_sub_category_level.txcount, 0) + coalesce(EXCLUDED.txcount, 0),
+                                daa = coalesce(blockspace_fact_sub_category_level.daa, 0) + coalesce(EXCLUDED.daa, 0)
+                        RETURNING date;
+                """
+                ## WITH ... INSERT isn't detected as a write statement by sqlalchemy's autocommit, hence the explicit transaction
+                with self.engine.begin() as connection:
+                        result = connection.execute(exec_string)
+                        dates = sorted(set([row['date'] for row in result]))
+                return dates
+        
         # """
         # DEPRECATED (currently not used) - 10.11.23
         # This function is used to get the top contracts by category for the blockspace dashboard
@@ -0,0 +1,58 @@
+import pandas as pd
+from pyroaring import BitMap
+
+from src.misc.sketches import periods
+
+## Exact active address sets as roaring bitmaps
+## Every address has a dense integer id in address_dictionary, chain_daily_bitmap stores the ids that were active per (chain, day).
+## Period unions (weekly, monthly), multichain overlaps and "only on chain X" counts are bitmap ORs, ANDs and differences in memory,
+## so exact user base numbers don't need to rescan the tx tables. Use the HLL sketches in src/misc/sketches.py if an estimate is good enough.
+
+def union(bitmaps) -> BitMap:
+    bitmaps = list(bitmaps)
+    return BitMap.union(*bitmaps) if len(bitmaps) > 0 else BitMap()
+
+## df with columns day, address_id (see DbConnector.get_active_address_ids) -> df with columns date, origin_key, bitmap (serialized)
+def get_bitmaps_df(df:pd.DataFrame, origin_key:str) -> pd.DataFrame:
+    rows = []
+    for day, df_day in df.groupby('day'):
+        rows.append({'date': day, 'origin_key': origin_key, 'bitmap': BitMap(df_day['address_id'].to_numpy()).serialize()})
+    return pd.DataFrame(rows, columns=['date', 'origin_key', 'bitmap'])
+
+## df with columns date, origin_key, bitmap (serialized) -> dict period start -> {origin_key: BitMap of all addresses active in that period}
+def get_period_bitmaps(df:pd.DataFrame, aggregation:str) -> dict:
+    df = df.copy()
+    df['day'] = pd.to_datetime(df['date']).dt.to_period(periods[aggregation]).dt.start_time
+    df['bitmap'] = [BitMap.deserialize(x) for x in df['bitmap']]
+
+    period_bitmaps = {}
+    for day, df_period in df.groupby('day'):
+        period_bitmaps[day] = {chain: union(df_chain['bitmap']) for chain, df_chain in df_period.groupby('origin_key')}
+    return period_bitmaps
+
+## exact multichain user base: addresses that were only active on one chain count for that chain, all others for 'multiple'
+def get_user_base(bitmaps:dict) -> dict:
+    user_base = {}
+    for chain, bitmap in bitmaps.items():
+        others = union([b for c, b in bitmaps.items() if c != chain])
+        user_base[chain] = len(bitmap - others)
+    user_base['multiple'] = len(union(bitmaps.values())) - sum(user_base.values())
+    return user_base
+
+## df with columns date, origin_key, bitmap -> df with columns day, origin_key, val for the given aggregation (day, week, month)
+def get_user_base_df(df:pd.DataFrame, aggregation:str) -> pd.DataFrame:
+    rows = []
+    for day, bitmaps in get_period_bitmaps(df, aggregation).items():
+        for origin_key, val in get_user_base(bitmaps).items():
+            rows.append({'day': day, 'origin_key': origin_key, 'val': val})
+    return pd.DataFrame(rows, columns=['day', 'origin_key', 'val'])
+
+## df with columns date, origin_key, bitmap -> df with the number of shared addresses per period and pair of chains
+def get_overlap_df(df:pd.DataFrame, aggregation:str) -> pd.DataFrame:
+    rows = []
+    for day, bitmaps in get_period_bitmaps(df, aggregation).items():
+        chains = sorted(bitmaps.keys())
+        for i, chain_a in enumerate(chains):
+            for chain_b in chains[i+1:]:
+                rows.append({'day': day, 'origin_key_a': chain_a, 'origin_key_b': chain_b, 'val': bitmaps[chain_a].intersection_cardinality(bitmaps[chain_b])})
+    return pd.DataFrame(rows, columns=['day', 'origin_key_a', 'origin_key_b', 'val'])
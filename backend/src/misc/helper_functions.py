@@ -1,24 +1,59 @@
 import requests
 import time
 import sys
+import threading
 import json
 import pandas as pd
 import unicodedata
 from datetime import datetime
-import boto3
 import os
 import eth_utils
 
+from src.misc.http_cache import get_http_cache
+from src.misc.json_publisher import JSONPublisher
+
 ## API interaction functions
-def api_get_call(url, sleeper=0.5, retries=15, header=None, _remove_control_characters=False, as_json=True, proxy=None):
+## simple thread-safe rate limiter that spaces out calls evenly, shared by all threads of an adapter
+class RateLimiter():
+    def __init__(self, calls_per_minute:int):
+        self.interval = 60 / calls_per_minute
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            waiting_time = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if waiting_time > 0:
+            time.sleep(waiting_time)
+
+def api_get_call(url, sleeper=0.5, retries=15, header=None, _remove_control_characters=False, as_json=True, proxy=None, use_cache=True, rate_limiter=None):
     retry_counter = 0
     interupt = False
 
+    ## serve from the http cache if possible, otherwise revalidate the cached response with a conditional request
+    http_cache = get_http_cache() if use_cache else None
+    cache_entry = None
+    if http_cache is not None:
+        cache_entry = http_cache.lookup(url)
+        if cache_entry is not None:
+            if http_cache.is_fresh(cache_entry):
+                print(f"...served from http cache: {url}")
+                return parse_response_text(cache_entry['body'], as_json, _remove_control_characters)
+            header = {**(header or {}), **http_cache.conditional_headers(cache_entry)}
+
     while True:
         try:
+            if rate_limiter is not None:
+                rate_limiter.wait()
             response = requests.request("GET", url, headers=header, proxies=proxy)
             if response.status_code == 200:
                 break
+            elif response.status_code == 304 and cache_entry is not None:
+                print(f"...not modified, served from http cache: {url}")
+                http_cache.refresh(cache_entry)
+                return parse_response_text(cache_entry['body'], as_json, _remove_control_characters)
             elif response.status_code == 400:
                 print(f"400 error, Bad Request with: {url} and response: {response.text}") 
                 return "400"
@@ -44,16 +79,17 @@ def api_get_call(url, sleeper=0.5, retries=15, header=None, _remove_control_char
         print("Execution ended successfully in api_get_call")
         sys.exit()
     else:
-        if _remove_control_characters == True:
-            if as_json == True:
-                return json.loads(remove_control_characters(response.text))
-            else:
-                return remove_control_characters(response.text)
-        else:
-            if as_json == True:
-                return json.loads(response.text)
-            else:
-                return response.text
+        if http_cache is not None:
+            http_cache.store(url, response)
+        return parse_response_text(response.text, as_json, _remove_control_characters)
+
+def parse_response_text(text, as_json=True, _remove_control_characters=False):
+    if _remove_control_characters == True:
+        text = remove_control_characters(text)
+    if as_json == True:
+        return json.loads(text)
+    else:
+        return text
 
 def api_post_call(url, payload, sleeper=0.5, retries=15, header=None, _remove_control_characters=False):
     retry_counter = 0
@@ -214,47 +250,24 @@ def print_orchestration_raw_end(name:str):
 
 
 ## S3 functions
-def empty_cloudfront_cache(distrubution_id, path):
-        cf = boto3.client('cloudfront')
-        # print("Creating invalidation for path: " + path)
-        res = cf.create_invalidation(
-            DistributionId=distrubution_id,
-            InvalidationBatch={
-                'Paths': {
-                    'Quantity': 1,
-                    'Items': [
-                        path
-                    ]
-                },
-                'CallerReference': str(time.time()).replace(".", "")
-            }
-        )
-        invalidation_id = res['Invalidation']['Id']
-        time.sleep(2)
-        #print("Invalidation created successfully with Id: " + invalidation_id)
-        return invalidation_id
-
-def upload_json_to_cf_s3(bucket, path_name, details_dict, cf_distribution_id):
-    # Convert Dictionary to JSON String
-    details_json = json.dumps(details_dict)
-
-    # Upload JSON String to an S3 Object
-    s3 = boto3.client('s3')
-    s3.put_object(
-        Bucket=bucket, 
-        Key=f'{path_name}.json',
-        Body=details_json,
-        ContentType='application/json'
-    )
-
-    print(f'... uploaded to {path_name}')
-    empty_cloudfront_cache(cf_distribution_id, f'/{path_name}.json')
-
+## The raw adapters share one publisher for the S3 longterm bucket: the parquet uploads run on its thread pool while the adapter
+## extracts the next batch (max 16 queued uploads). flush_dataframes_to_s3 waits for them and raises failed uploads, the raw adapters
+## call it at the end of extract_raw.
+_long_term_publisher = None
+_long_term_publisher_lock = threading.Lock()
+def get_long_term_publisher() -> JSONPublisher:
+    global _long_term_publisher
+    with _long_term_publisher_lock:
+        if _long_term_publisher is None:
+            _long_term_publisher = JSONPublisher(os.getenv('S3_LONG_TERM_BUCKET'), None, max_workers=4, max_pending=16)
+        return _long_term_publisher
 
 ## This function uploads a dataframe to S3 longterm bucket as parquet file
 def dataframe_to_s3(path_name, df):
-    s3_url = f"s3://{os.getenv('S3_LONG_TERM_BUCKET')}/{path_name}.parquet"
-    df.to_parquet(s3_url)
+    get_long_term_publisher().publish_parquet(path_name, df)
+    print(f'...queued upload to S3 longterm in {path_name}')
 
-    print(f'...uploaded to S3 longterm in {path_name}')
+def flush_dataframes_to_s3():
+    if _long_term_publisher is not None:
+        _long_term_publisher.flush()
 
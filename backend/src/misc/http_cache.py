@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+## On-disk HTTP response cache for the external KPI sources (Coingecko, L2Beat, DefiLlama, block explorers)
+## Every cached response is stored as two files: <key>.body (raw response text) and <key>.meta (json with url, ETag, Last-Modified, timestamps)
+## - responses younger than the TTL of their endpoint are served without touching the network
+## - older responses are revalidated with If-None-Match / If-Modified-Since, so unchanged data only costs a 304
+## - when the cache grows above max_size_mb, the least recently used entries are evicted (the size is tracked on writes,
+##   the cache dir is only scanned once at startup and when an eviction is due)
+## - files are written to a tmp file and moved into place, so readers never see a half written body
+## - in offline mode every cached response is served regardless of its age (useful for dev reruns)
+##
+## The cache is switched on by setting HTTP_CACHE_DIR. HTTP_CACHE_MAX_MB and HTTP_CACHE_OFFLINE are optional.
+
+## TTLs in seconds per url prefix, the longest matching prefix wins. Endpoints that are not listed use default_ttl.
+endpoint_ttls = {
+    'https://api.coingecko.com/api/v3/coins/': 60*60*6, ## daily market charts, refreshed a few times per day
+    'https://l2beat.com/api/': 60*60*6, ## daily tvl and activity charts
+    'https://api.llama.fi': 60*60*6,
+    'https://stablecoins.llama.fi': 60*60*6,
+    'https://coins.llama.fi/batchHistorical': 60*60*24*30, ## historical prices don't change anymore
+    'https://coins.llama.fi': 60*60,
+}
+
+class HttpCache():
+    def __init__(self, cache_dir:str, ttls:dict=None, default_ttl:int=60*60, max_size_mb:int=500, offline:bool=False):
+        self.cache_dir = cache_dir
+        self.ttls = endpoint_ttls if ttls is None else ttls
+        self.default_ttl = default_ttl
+        self.max_size = max_size_mb * 1024 * 1024
+        self.offline = offline
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        ## current size of the cache in bytes, None until the first write scanned the cache dir
+        self.size = None
+
+    def get_key(self, url:str, params=None) -> str:
+        if params is not None:
+            url = f"{url}?{params}" if isinstance(params, str) else f"{url}?{json.dumps(params, sort_keys=True)}"
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get_ttl(self, url:str) -> int:
+        ttl = self.default_ttl
+        match_length = 0
+        for prefix, prefix_ttl in self.ttls.items():
+            if url.startswith(prefix) and len(prefix) > match_length:
+                ttl = prefix_ttl
+                match_length = len(prefix)
+        return ttl
+
+    def _paths(self, key:str):
+        return os.path.join(self.cache_dir, f"{key}.meta"), os.path.join(self.cache_dir, f"{key}.body")
+
+    ## atomic write: concurrent readers either see the old or the new file
+    def _write(self, path:str, content:str):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _file_size(self, path:str) -> int:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    ## returns the cached entry (meta dict incl. body) or None if nothing is cached
+    def lookup(self, url:str, params=None):
+        key = self.get_key(url, params)
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            with open(body_path, 'r', encoding='utf-8') as f:
+                meta['body'] = f.read()
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        ## mark entry as recently used for the LRU eviction
+        os.utime(meta_path)
+        return meta
+
+    def is_fresh(self, entry:dict) -> bool:
+        if self.offline:
+            return True
+        return time.time() - entry['fetched_at'] < self.get_ttl(entry['url'])
+
+    ## headers for a conditional request, so that the server can answer with 304 if nothing changed
+    def conditional_headers(self, entry:dict) -> dict:
+        headers = {}
+        if entry.get('etag') is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified') is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url:str, response, params=None):
+        key = self.get_key(url, params)
+        meta_path, body_path = self._paths(key)
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+        }
+        with self.lock:
+            if self.size is None:
+                self.size = self.get_size()
+            old_size = self._file_size(body_path) + self._file_size(meta_path)
+            ## write body first so that a meta file never points to a missing body
+            self._write(body_path, response.text)
+            self._write(meta_path, json.dumps(meta))
+            self.size += self._file_size(body_path) + self._file_size(meta_path) - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    ## called after a 304: the cached body is still valid, restart its TTL
+    def refresh(self, entry:dict, params=None):
+        key = self.get_key(entry['url'], params)
+        meta_path, _ = self._paths(key)
+        meta = {k: v for k, v in entry.items() if k != 'body'}
+        meta['fetched_at'] = time.time()
+        with self.lock:
+            self._write(meta_path, json.dumps(meta))
+
+    def get_size(self) -> int:
+        total_size = 0
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.meta') or file_name.endswith('.body'):
+                total_size += self._file_size(os.path.join(self.cache_dir, file_name))
+        return total_size
+
+    ## drop least recently used entries until the cache is well below max_size (called with the lock held, only when the tracked size is above max_size)
+    def evict(self):
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.meta'):
+                continue
+            key = file_name[:-len('.meta')]
+            meta_path, body_path = self._paths(key)
+            try:
+                size = os.path.getsize(body_path) + os.path.getsize(meta_path)
+                last_used = os.path.getmtime(meta_path)
+            except FileNotFoundError:
+                continue
+            entries.append((last_used, size, meta_path, body_path))
+            total_size += size
+
+        self.size = total_size
+        if total_size <= self.max_size:
+            return
+
+        ## evict down to 90% of max_size, so that a full cache doesn't rescan the cache dir on every write
+        entries.sort()
+        for last_used, size, meta_path, body_path in entries:
+            if total_size <= self.max_size * 0.9:
+                break
+            for path in [meta_path, body_path]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+        self.size = total_size
+        print(f"...http cache evicted entries, new size: {round(total_size / 1024 / 1024, 2)} MB")
+
+## returns the process wide cache or None if caching is not configured
+_http_cache = None
+def get_http_cache():
+    global _http_cache
+    cache_dir = os.getenv("HTTP_CACHE_DIR")
+    if cache_dir is None:
+        return None
+    if _http_cache is None:
+        _http_cache = HttpCache(
+            cache_dir,
+            max_size_mb=int(os.getenv("HTTP_CACHE_MAX_MB", 500)),
+            offline=os.getenv("HTTP_CACHE_OFFLINE", 'false').lower() == 'true'
+        )
+    return _http_cache
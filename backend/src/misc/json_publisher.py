@@ -0,0 +1,193 @@
+import os
+import io
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+
+from src.misc.json_serializer import dumps, compress, decompress, encoding_extensions
+
+## Publishing of the frontend jsons to S3 + CloudFront
+## Every payload is serialized and hashed (md5) before the upload. If the object in the bucket already has the same hash
+## (md5 metadata of our uploads, or the ETag which is the md5 of single part uploads) the upload is skipped.
+## Changed paths are collected and flush() creates one CloudFront invalidation for all of them instead of one invalidation per file.
+##
+## Uploads run concurrently on a bounded thread pool and share one process wide S3 client (boto3 clients are thread-safe),
+## objects above the multipart threshold are uploaded in parts. flush() waits for all pending uploads and reports the throughput.
+## S3_ENDPOINT_URL points the client to an S3 compatible stand-in (e.g. MinIO or moto server) instead of AWS.
+##
+## JSON_CONTENT_ENCODING (gzip or br) uploads the jsons compressed with the matching Content-Encoding, JSON_COMPRESSED_VARIANTS
+## (e.g. gzip,br) additionally uploads encoded variants next to the json ({path}.json.gz, {path}.json.br). The hashes are always taken
+## from the uncompressed payload, so compression doesn't interfere with skipping unchanged files. Every variant is checked on its own,
+## so missing or outdated variants are uploaded (and invalidated) even if the json itself didn't change.
+##
+## max_pending bounds the queued uploads: submit() blocks while max_pending uploads are queued or running, so a producer that is
+## faster than the uploads doesn't hold all payloads in memory.
+##
+## With local_dir set, the files are written to that directory instead of S3 and the invalidations are only recorded
+## (self.invalidations), which is handy for dry runs of the exports.
+
+transfer_config = TransferConfig(multipart_threshold=16 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024, max_concurrency=4)
+
+_clients = {}
+_clients_lock = threading.Lock()
+def get_client(service:str):
+    with _clients_lock:
+        if service not in _clients:
+            endpoint_url = os.getenv("S3_ENDPOINT_URL") if service == 's3' else None
+            _clients[service] = boto3.client(service, endpoint_url=endpoint_url, config=Config(max_pool_connections=50))
+        return _clients[service]
+
+## uploads bytes to S3 (multipart above the threshold of transfer_config) and returns the number of bytes
+def upload_bytes(bucket:str, key:str, body:bytes, content_type:str, metadata:dict=None, content_encoding:str=None) -> int:
+    extra_args = {'ContentType': content_type}
+    if content_encoding is not None:
+        extra_args['ContentEncoding'] = content_encoding
+    if metadata is not None:
+        extra_args['Metadata'] = metadata
+    get_client('s3').upload_fileobj(io.BytesIO(body), bucket, key, ExtraArgs=extra_args, Config=transfer_config)
+    return len(body)
+
+class JSONPublisher():
+    def __init__(self, bucket:str, cf_distribution_id:str, local_dir:str=None, max_workers:int=8, content_encoding:str=None, variants:list=None, max_pending:int=None):
+        self.bucket = bucket
+        self.cf_distribution_id = cf_distribution_id
+        self.local_dir = local_dir
+        self.content_encoding = content_encoding if content_encoding is not None else os.getenv("JSON_CONTENT_ENCODING")
+        if variants is None:
+            variants = [v.strip() for v in os.getenv("JSON_COMPRESSED_VARIANTS", '').split(',') if v.strip() != '']
+        for encoding in [self.content_encoding] + variants:
+            if encoding is not None and encoding not in encoding_extensions:
+                print(f"ERROR: unknown content encoding {encoding}")
+                raise ValueError(f"unknown content encoding {encoding}")
+        self.variants = variants
+        self.changed_paths = []
+        self.skipped = 0
+        self.uploaded_bytes = 0
+        self.started = None
+        self.invalidations = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.pending = threading.BoundedSemaphore(max_pending) if max_pending is not None else None
+
+    def get_stored_hash(self, bucket:str, key:str, content_encoding:str=None):
+        if self.local_dir is not None:
+            path = os.path.join(self.local_dir, key)
+            if not os.path.exists(path):
+                return None
+            with open(path, 'rb') as f:
+                body = f.read()
+            try:
+                return hashlib.md5(decompress(body, content_encoding) if content_encoding is not None else body).hexdigest()
+            except Exception:
+                ## stored with a different encoding
+                return None
+
+        try:
+            res = get_client('s3').head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise e
+        ## objects stored with a different encoding are uploaded again, even if their content didn't change
+        if res.get('ContentEncoding') != content_encoding:
+            return None
+        return res.get('Metadata', {}).get('md5', res['ETag'].strip('"'))
+
+    def put(self, bucket:str, key:str, body:bytes, md5:str, content_type:str, content_encoding:str=None):
+        if self.local_dir is not None:
+            path = os.path.join(self.local_dir, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(body)
+        else:
+            upload_bytes(bucket, key, body, content_type, metadata={'md5': md5}, content_encoding=content_encoding)
+
+    ## runs on the thread pool: uploads the object and each of its encoded variants whose hash changed (or that is missing),
+    ## returns True if anything was uploaded
+    def upload_if_changed(self, bucket:str, key:str, body:bytes, content_type:str, invalidate:bool, content_encoding:str=None, variants:list=None) -> bool:
+        md5 = hashlib.md5(body).hexdigest()
+        objects = [(key, content_encoding)] + [(f'{key}.{encoding_extensions[encoding]}', encoding) for encoding in variants or []]
+        changed = [(object_key, encoding) for object_key, encoding in objects if self.get_stored_hash(bucket, object_key, encoding) != md5]
+        if len(changed) == 0:
+            print(f'... {key} unchanged, skipped upload')
+            with self.lock:
+                self.skipped += 1
+            return False
+
+        for object_key, encoding in changed:
+            object_body = compress(body, encoding) if encoding is not None else body
+            self.put(bucket, object_key, object_body, md5, content_type, encoding)
+            with self.lock:
+                self.uploaded_bytes += len(object_body)
+                if invalidate:
+                    self.changed_paths.append(f'/{object_key}')
+        print(f'... uploaded to {", ".join([object_key for object_key, _ in changed])}')
+        return True
+
+    def submit(self, bucket:str, key:str, body:bytes, content_type:str, invalidate:bool, content_encoding:str=None, variants:list=None):
+        if self.pending is not None:
+            self.pending.acquire()
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            future = self.executor.submit(self.upload_if_changed, bucket, key, body, content_type, invalidate, content_encoding, variants)
+            self.futures.append(future)
+        if self.pending is not None:
+            future.add_done_callback(lambda f: self.pending.release())
+        return future
+
+    ## queues the upload of {path_name}.json (serialized right away, so the dict can be reused by the caller, compressed on the thread pool)
+    def publish(self, path_name:str, details_dict):
+        body = dumps(details_dict)
+        return self.submit(self.bucket, f'{path_name}.json', body, 'application/json', invalidate=True, content_encoding=self.content_encoding, variants=self.variants)
+
+    ## queues the upload of {path_name}.parquet (serialized right away, the parquet files are not served by CloudFront and never invalidated)
+    def publish_parquet(self, path_name:str, df):
+        return self.submit(self.bucket, f'{path_name}.parquet', df.to_parquet(), 'application/octet-stream', invalidate=False)
+
+    ## waits for all queued uploads and creates one invalidation for all paths that changed since the last flush
+    ## (CloudFront accepts max 3000 paths per invalidation)
+    def flush(self) -> list:
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        ## raises the first failed upload
+        for future in futures:
+            future.result()
+
+        with self.lock:
+            paths = list(dict.fromkeys(self.changed_paths))
+            self.changed_paths = []
+            skipped, uploaded_bytes = self.skipped, self.uploaded_bytes
+            self.skipped, self.uploaded_bytes = 0, 0
+            runtime = time.time() - self.started if self.started is not None else 0
+            self.started = None
+
+        invalidation_ids = []
+        for i in range(0, len(paths), 3000):
+            batch = paths[i:i + 3000]
+            if self.local_dir is not None:
+                self.invalidations.append(batch)
+                continue
+            res = get_client('cloudfront').create_invalidation(
+                DistributionId=self.cf_distribution_id,
+                InvalidationBatch={
+                    'Paths': {
+                        'Quantity': len(batch),
+                        'Items': batch
+                    },
+                    'CallerReference': str(time.time()).replace(".", "")
+                }
+            )
+            invalidation_ids.append(res['Invalidation']['Id'])
+
+        mb_per_s = uploaded_bytes / 1024 / 1024 / runtime if runtime > 0 else 0
+        print(f"...published {len(futures) - skipped} changed files ({skipped} unchanged), {uploaded_bytes / 1024 / 1024:.2f} MB in {runtime:.1f}s ({mb_per_s:.2f} MB/s), {(len(paths) + 2999) // 3000} invalidation(s) created")
+        return invalidation_ids
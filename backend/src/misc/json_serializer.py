@@ -0,0 +1,52 @@
+import gzip
+import datetime
+from decimal import Decimal
+
+import brotli
+import orjson
+import numpy as np
+import pandas as pd
+
+## JSON serialization of the api outputs
+## orjson writes NumPy arrays and scalars natively, so the json creation can hand over DataFrame values (to_numpy())
+## instead of building python lists with .tolist() first. NaN and inf are written as null (same as simplejson with ignore_nan=True).
+## compress() creates the gzip / brotli encoded variants of a payload, they are uploaded with the matching Content-Encoding.
+
+options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+## file extensions of the encoded variants
+encoding_extensions = {'gzip': 'gz', 'br': 'br'}
+
+## everything orjson can't serialize natively ends up here (non C-contiguous and object arrays, DataFrames, Timestamps, Decimals)
+def default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist() if obj.dtype == object else np.ascontiguousarray(obj)
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return obj.to_numpy()
+    if isinstance(obj, (pd.Timestamp, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type {type(obj)} is not JSON serializable")
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=default, option=options)
+
+## mtime=0 keeps the gzip output deterministic, so unchanged payloads still compress to the same bytes
+def compress(body:bytes, encoding:str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    elif encoding == 'br':
+        return brotli.compress(body, quality=9)
+    else:
+        print(f"ERROR: unknown content encoding {encoding}")
+        raise ValueError(f"unknown content encoding {encoding}")
+
+def decompress(body:bytes, encoding:str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    elif encoding == 'br':
+        return brotli.decompress(body)
+    else:
+        print(f"ERROR: unknown content encoding {encoding}")
+        raise ValueError(f"unknown content encoding {encoding}")
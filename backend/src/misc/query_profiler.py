@@ -0,0 +1,239 @@
+import os
+import re
+import sys
+import atexit
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import event
+
+## Opt-in profiling of all queries that run on a DbConnector engine
+## Every statement is recorded with its name, wall time and rows. The name is the innermost query_name() context
+## (AdapterSQL uses metric_key.origin_key, query templates append their template name to it), otherwise the calling DbConnector / adapter function.
+## With explain switched on, every read-only query is run a second time with EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and the plan,
+## the buffer usage and the result size (actual rows * plan width) are recorded as well. This doubles the load, so only use it for profiling runs.
+##
+## At the end of a task (profile_report(), Airflow ends its forked task processes with os._exit, so atexit only covers local runs)
+## a json report is written to the profile dir. Reports are keyed by DAG and task (AIRFLOW_CTX_DAG_ID / AIRFLOW_CTX_TASK_ID, plus an
+## optional name e.g. of mapped tasks) and every query name is compared with the last report of the same key that contains it:
+## queries whose total time grew by more than regression_factor (and at least min_seconds) are listed as regressions.
+##
+## Profiling is switched on by setting QUERY_PROFILE_DIR. QUERY_PROFILE_EXPLAIN (true/false) is optional.
+
+local = threading.local()
+
+## statements that write or take locks are never explained, EXPLAIN ANALYZE would execute them a second time
+write_pattern = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|CREATE|DROP|ALTER|TRUNCATE|COPY|CALL|NEXTVAL|SETVAL|PG_ADVISORY_\w+)\b|\bFOR\s+(UPDATE|SHARE)\b", re.IGNORECASE)
+
+## names all queries that run inside of the context (innermost name wins)
+@contextmanager
+def query_name(name:str):
+    names = local.__dict__.setdefault('names', [])
+    names.append(name)
+    try:
+        yield
+    finally:
+        names.pop()
+
+## innermost query_name() context of this thread or None
+def get_active_query_name():
+    names = local.__dict__.get('names', [])
+    return names[-1] if len(names) > 0 else None
+
+def get_query_name(statement:str) -> str:
+    name = get_active_query_name()
+    if name is not None:
+        return name
+    ## fall back to the first function in our own db or adapter code that triggered the query
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.endswith('db_connector.py') or os.path.basename(filename).startswith('adapter_'):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return 'sql_' + hashlib.md5(statement.encode()).hexdigest()[:8]
+
+class QueryProfiler():
+    def __init__(self, profile_dir:str, explain:bool=False, regression_factor:float=1.5, min_seconds:float=1.0):
+        self.profile_dir = profile_dir
+        self.explain = explain
+        self.regression_factor = regression_factor
+        self.min_seconds = min_seconds
+        self.records = []
+        self.lock = threading.Lock()
+        self.started = datetime.now()
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        runtime = time.time() - conn.info['query_start'].pop()
+        if statement.lstrip().upper().startswith('EXPLAIN'):
+            return
+
+        record = {
+            'name': get_query_name(statement),
+            'statement_hash': hashlib.md5(statement.encode()).hexdigest()[:12],
+            'started_at': datetime.now().isoformat(),
+            'runtime_s': runtime,
+            'rows': cursor.rowcount if cursor.rowcount >= 0 else None,
+            'bytes': None,
+            'shared_hit_blocks': None,
+            'shared_read_blocks': None,
+            'plan': None,
+        }
+        if self.explain and not executemany and self.is_read_only(cursor, statement):
+            record.update(self.get_plan(cursor, statement, parameters))
+
+        with self.lock:
+            self.records.append(record)
+
+    ## SELECT / WITH statements without writes, EXECUTE of prepared templates is resolved to the prepared statement first
+    def is_read_only(self, cursor, statement:str) -> bool:
+        sql = statement.lstrip()
+        if sql.upper().startswith('EXECUTE'):
+            try:
+                with cursor.connection.cursor() as prepared_cursor:
+                    prepared_cursor.execute("SELECT statement FROM pg_prepared_statements WHERE name = %s", (sql.split()[1].split('(')[0].lower(),))
+                    row = prepared_cursor.fetchone()
+            except Exception as e:
+                print(f"...could not look up prepared statement: {e}")
+                return False
+            if row is None:
+                return False
+            sql = re.sub(r"^\s*PREPARE\s+\w+(\s*\([^)]*\))?\s+AS\s+", '', row[0], flags=re.IGNORECASE)
+        return sql.upper().startswith(('SELECT', 'WITH')) and write_pattern.search(sql) is None
+
+    ## EXPLAIN ANALYZE executes the statement, so it only runs for read-only statements (see is_read_only) and inside of a savepoint
+    ## that is always rolled back, a failing explain doesn't abort the transaction of the profiled query either
+    def get_plan(self, cursor, statement, parameters) -> dict:
+        try:
+            with cursor.connection.cursor() as explain_cursor:
+                explain_cursor.execute("SAVEPOINT query_profiler_explain")
+                try:
+                    explain_cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters)
+                    plan = explain_cursor.fetchone()[0]
+                finally:
+                    explain_cursor.execute("ROLLBACK TO SAVEPOINT query_profiler_explain")
+                    explain_cursor.execute("RELEASE SAVEPOINT query_profiler_explain")
+            plan = plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+            root = plan['Plan']
+            return {
+                'bytes': int(root.get('Actual Rows', 0) * root.get('Plan Width', 0)),
+                'shared_hit_blocks': root.get('Shared Hit Blocks'),
+                'shared_read_blocks': root.get('Shared Read Blocks'),
+                'plan': plan,
+            }
+        except Exception as e:
+            print(f"...could not explain query: {e}")
+            return {}
+
+    ## total time, executions, rows and bytes per query name, slowest first
+    def get_summary(self, records:list=None) -> pd.DataFrame:
+        df = pd.DataFrame(self.records if records is None else records, columns=['name', 'runtime_s', 'rows', 'bytes'])
+        if df.empty:
+            return pd.DataFrame(columns=['name', 'executions', 'runtime_s', 'max_runtime_s', 'rows', 'bytes'])
+        df = df.groupby('name').agg(
+            executions=('runtime_s', 'count'),
+            runtime_s=('runtime_s', 'sum'),
+            max_runtime_s=('runtime_s', 'max'),
+            rows=('rows', lambda x: x.sum(min_count=1)),
+            bytes=('bytes', lambda x: x.sum(min_count=1)),
+        ).reset_index()
+        return df.sort_values('runtime_s', ascending=False)
+
+    ## reports of the same key, oldest first (the timestamp in the file name sorts them)
+    def get_report_paths(self, key:str) -> list:
+        prefix = f"query_profile_{key}_"
+        return sorted([os.path.join(self.profile_dir, f) for f in os.listdir(self.profile_dir) if f.startswith(prefix) and f[len(prefix):][:1].isdigit() and f.endswith('.json')])
+
+    def write_report(self, key:str, records:list, started:datetime) -> str:
+        path = os.path.join(self.profile_dir, f"query_profile_{key}_{started.strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}.json")
+        with open(path, 'w') as f:
+            json.dump({'key': key, 'started': started.isoformat(), 'explain': self.explain, 'records': records}, f, default=str)
+        return path
+
+    ## records of the last report (of max_reports) that contains the query name, for every name
+    def get_previous_records(self, previous_paths:list, max_reports:int=20) -> list:
+        previous_records = []
+        seen = set()
+        for path in reversed(previous_paths[-max_reports:]):
+            with open(path, 'r') as f:
+                records = json.load(f)['records']
+            names = set([record['name'] for record in records]) - seen
+            previous_records += [record for record in records if record['name'] in names]
+            seen.update(names)
+        return previous_records
+
+    ## queries whose total runtime grew by more than regression_factor compared to the previous report
+    def get_regressions(self, records:list, previous_records:list) -> pd.DataFrame:
+        df = self.get_summary(records).merge(self.get_summary(previous_records)[['name', 'runtime_s']], on='name', how='inner', suffixes=('', '_previous'))
+        df['factor'] = df['runtime_s'] / df['runtime_s_previous']
+        df = df[(df['factor'] > self.regression_factor) & (df['runtime_s'] - df['runtime_s_previous'] > self.min_seconds)]
+        return df[['name', 'runtime_s_previous', 'runtime_s', 'factor']].sort_values('factor', ascending=False)
+
+    ## writes the report of the queries recorded since the last report and prints the slowest queries and the regressions
+    def finish(self, name:str=None):
+        with self.lock:
+            records, self.records = self.records, []
+            started, self.started = self.started, datetime.now()
+        if len(records) == 0:
+            return
+        key = get_report_key(name)
+        previous_paths = self.get_report_paths(key)
+        path = self.write_report(key, records, started)
+
+        print(f"Query profile written to {path}. Slowest queries:")
+        print(self.get_summary(records).head(15).to_string(index=False))
+
+        if len(previous_paths) > 0:
+            regressions = self.get_regressions(records, self.get_previous_records(previous_paths))
+            if regressions.empty:
+                print(f"...no regressions compared to the previous {key} reports")
+            else:
+                print(f"Regressions compared to the previous {key} reports:")
+                print(regressions.to_string(index=False))
+
+## dag_id.task_id of the running Airflow task (or local), name is appended (e.g. the origin_key of mapped tasks)
+def get_report_key(name:str=None) -> str:
+    if os.getenv("AIRFLOW_CTX_DAG_ID") is not None:
+        key = f"{os.getenv('AIRFLOW_CTX_DAG_ID')}.{os.getenv('AIRFLOW_CTX_TASK_ID')}"
+    else:
+        key = 'local'
+    if name is not None:
+        key = f"{key}.{name}"
+    return re.sub(r"[^\w.-]", '_', key)
+
+## writes the profile report of everything that ran inside of the context (no-op if profiling is not configured)
+@contextmanager
+def profile_report(name:str=None):
+    try:
+        yield
+    finally:
+        if _query_profiler is not None:
+            _query_profiler.finish(name)
+
+## returns the process wide profiler or None if profiling is not configured, the remaining records are written when the process exits
+_query_profiler = None
+def get_query_profiler():
+    global _query_profiler
+    profile_dir = os.getenv("QUERY_PROFILE_DIR")
+    if profile_dir is None:
+        return None
+    if _query_profiler is None:
+        _query_profiler = QueryProfiler(
+            profile_dir,
+            explain=os.getenv("QUERY_PROFILE_EXPLAIN", 'false').lower() == 'true'
+        )
+        atexit.register(_query_profiler.finish)
+    return _query_profiler
@@ -0,0 +1,213 @@
+import zlib
+import numpy as np
+import pandas as pd
+
+## HyperLogLog sketches for distinct address counts (daa, user_base)
+## The registers are computed in Postgres (see DbConnector.get_hll_registers): every address is hashed with md5,
+## the first p bits of the hash select the register and the register keeps the max position of the first 1-bit in the remaining bits.
+## Sketches of the same precision can be merged (register-wise max), so per (chain, day) sketches answer
+## weekly/monthly and cross-chain distinct counts without touching the tx tables again.
+##
+## Error bound: the standard error of a count is 1.04 / sqrt(2^p), with p=14 that is ~0.81% (~2.4% at 3 sigma).
+## Counts that are derived via inclusion-exclusion (e.g. users that are only active on one chain) are differences of two estimates,
+## so their absolute error is in the order of 0.81% of the union they are derived from, not of the derived count itself.
+
+HLL_PRECISION = 14
+
+class HyperLogLog():
+    def __init__(self, p:int=HLL_PRECISION, registers:np.ndarray=None):
+        self.p = p
+        self.m = 2 ** p
+        if registers is None:
+            registers = np.zeros(self.m, dtype=np.uint8)
+        self.registers = registers
+
+    ## idx and rho as returned by the register query (register index and max rank per register)
+    @classmethod
+    def from_registers(cls, idx, rho, p:int=HLL_PRECISION):
+        hll = cls(p)
+        np.maximum.at(hll.registers, np.asarray(idx, dtype=np.int64), np.asarray(rho, dtype=np.uint8))
+        return hll
+
+    @classmethod
+    def from_bytes(cls, data:bytes, p:int=HLL_PRECISION):
+        return cls(p, np.frombuffer(zlib.decompress(data), dtype=np.uint8).copy())
+
+    ## registers are mostly small numbers (and zeros for sparse days), so they compress well
+    def to_bytes(self) -> bytes:
+        return zlib.compress(self.registers.tobytes())
+
+    def merge(self, other):
+        if self.p != other.p:
+            raise ValueError(f"Cannot merge HyperLogLog sketches with different precision ({self.p} and {other.p})")
+        return HyperLogLog(self.p, np.maximum(self.registers, other.registers))
+
+    @staticmethod
+    def union(sketches:list):
+        sketches = list(sketches)
+        if len(sketches) == 0:
+            return HyperLogLog()
+        registers = np.maximum.reduce([s.registers for s in sketches])
+        return HyperLogLog(sketches[0].p, registers)
+
+    def count(self) -> float:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        ## small range correction (linear counting)
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            estimate = self.m * np.log(self.m / zeros)
+        return float(estimate)
+
+    def relative_error(self) -> float:
+        return 1.04 / np.sqrt(self.m)
+
+## Multichain user base: every address counts for its chain if it was only active on one chain, otherwise for 'multiple'.
+## Derived via inclusion-exclusion on merged sketches: only_on(chain) = |all chains| - |all chains except chain|
+## Returns a dict origin_key -> estimated number of addresses (incl. 'multiple')
+## The derived counts carry the absolute error of the union (relative_error() * total, see above), small chains therefore have a large
+## relative error. They are still published (negative differences clipped to 0), user_base_exact (exact address bitmaps) avoids the error.
+def get_user_base(sketches:dict) -> dict:
+    union = HyperLogLog.union(sketches.values())
+    total = union.count()
+    user_base = {}
+    for chain in sketches.keys():
+        others = HyperLogLog.union([s for c, s in sketches.items() if c != chain]).count()
+        user_base[chain] = max(total - others, 0)
+    user_base['multiple'] = max(total - sum(user_base.values()), 0)
+    return {k: round(v) for k, v in user_base.items()}
+
+## same period starts as date_trunc in Postgres (weeks start on Monday)
+periods = {'day': 'D', 'week': 'W-SUN', 'month': 'M'}
+
+def get_period_start(date, aggregation:str):
+    return pd.Timestamp(date).to_period(periods[aggregation]).start_time.date()
+
+## df with columns day, idx, rho (see DbConnector.get_hll_registers) -> df with columns date, origin_key, hll (compressed bytes)
+def get_sketches_df(df:pd.DataFrame, origin_key:str) -> pd.DataFrame:
+    rows = []
+    for day, df_day in df.groupby('day'):
+        rows.append({'date': day, 'origin_key': origin_key, 'hll': HyperLogLog.from_registers(df_day['idx'], df_day['rho']).to_bytes()})
+    return pd.DataFrame(rows, columns=['date', 'origin_key', 'hll'])
+
+## df with columns date, origin_key, hll (compressed bytes) -> df with columns day, origin_key, val for the given aggregation (day, week, month)
+def get_user_base_df(df:pd.DataFrame, aggregation:str) -> pd.DataFrame:
+    df = df.copy()
+    df['day'] = pd.to_datetime(df['date']).dt.to_period(periods[aggregation]).dt.start_time
+    df['sketch'] = [HyperLogLog.from_bytes(x) for x in df['hll']]
+
+    rows = []
+    for day, df_period in df.groupby('day'):
+        sketches = {chain: HyperLogLog.union(df_chain['sketch']) for chain, df_chain in df_period.groupby('origin_key')}
+        for origin_key, val in get_user_base(sketches).items():
+            rows.append({'day': day, 'origin_key': origin_key, 'val': val})
+    return pd.DataFrame(rows, columns=['day', 'origin_key', 'val'])
+
+## t-digest sketches for tx fee quantiles (txcosts_median, p10, p90)
+## The centroids are pre-aggregated in Postgres into log-spaced buckets of ~1% width (see DbConnector.get_fee_buckets) and then compressed
+## with the merging t-digest algorithm (k1 scale function). Digests can be merged (e.g. days to weeks or several chains) and scaled
+## (fees in native token -> usd), quantiles are interpolated between centroids and are most accurate at the tails.
+class TDigest():
+    def __init__(self, means:np.ndarray=None, counts:np.ndarray=None, compression:int=200):
+        self.compression = compression
+        self.means = np.array([], dtype=np.float64) if means is None else np.asarray(means, dtype=np.float64)
+        self.counts = np.array([], dtype=np.float64) if counts is None else np.asarray(counts, dtype=np.float64)
+        self.min = self.means.min() if len(self.means) > 0 else np.nan
+        self.max = self.means.max() if len(self.means) > 0 else np.nan
+
+    @classmethod
+    def from_centroids(cls, means, counts, compression:int=200):
+        digest = cls(means, counts, compression)
+        digest.compress()
+        return digest
+
+    @classmethod
+    def from_bytes(cls, data:bytes):
+        values = np.frombuffer(zlib.decompress(data), dtype=np.float64)
+        compression, digest_min, digest_max = values[:3]
+        means, counts = values[3:].reshape(2, -1)
+        digest = cls(means, counts, int(compression))
+        digest.min, digest.max = digest_min, digest_max
+        return digest
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(np.concatenate([[self.compression, self.min, self.max], self.means, self.counts]).astype(np.float64).tobytes())
+
+    def total(self) -> float:
+        return float(self.counts.sum())
+
+    ## merging t-digest: centroids are sorted and greedily merged as long as they stay within one unit of the k1 scale function
+    def compress(self):
+        if len(self.means) == 0:
+            return
+        order = np.argsort(self.means, kind='stable')
+        means, counts = self.means[order], self.counts[order]
+        total = counts.sum()
+
+        def k(q):
+            return self.compression / (2 * np.pi) * np.arcsin(2 * np.clip(q, 0, 1) - 1)
+
+        new_means, new_counts = [means[0]], [counts[0]]
+        q_left = 0.0
+        k_left = k(q_left)
+        for mean, count in zip(means[1:], counts[1:]):
+            q_right = q_left + (new_counts[-1] + count) / total
+            if k(q_right) - k_left <= 1:
+                new_means[-1] = (new_means[-1] * new_counts[-1] + mean * count) / (new_counts[-1] + count)
+                new_counts[-1] += count
+            else:
+                q_left += new_counts[-1] / total
+                k_left = k(q_left)
+                new_means.append(mean)
+                new_counts.append(count)
+        self.means, self.counts = np.array(new_means), np.array(new_counts)
+
+    @staticmethod
+    def merge(digests:list, compression:int=200):
+        digests = [d for d in digests if len(d.means) > 0]
+        if len(digests) == 0:
+            return TDigest(compression=compression)
+        digest = TDigest(np.concatenate([d.means for d in digests]), np.concatenate([d.counts for d in digests]), compression)
+        digest.min = min(d.min for d in digests)
+        digest.max = max(d.max for d in digests)
+        digest.compress()
+        return digest
+
+    ## e.g. converts a digest of fees in the native token into usd
+    def scale(self, factor:float):
+        digest = TDigest(self.means * factor, self.counts.copy(), self.compression)
+        digest.min, digest.max = self.min * factor, self.max * factor
+        return digest
+
+    def quantile(self, q:float) -> float:
+        if len(self.means) == 0:
+            return np.nan
+        if len(self.means) == 1:
+            return float(self.means[0])
+        ## every centroid represents its mean at the middle of its weight
+        positions = np.cumsum(self.counts) - self.counts / 2
+        positions = np.concatenate([[0], positions, [self.total()]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q * self.total(), positions, values))
+
+## df with columns day, mean, count (see DbConnector.get_fee_buckets) -> df with columns date, fee_digest (compressed bytes) and the quantile columns
+def get_fee_digests_df(df:pd.DataFrame, quantiles:dict) -> pd.DataFrame:
+    rows = []
+    for day, df_day in df.groupby('day'):
+        digest = TDigest.from_centroids(df_day['mean'], df_day['count'])
+        row = {'date': day, 'fee_digest': digest.to_bytes()}
+        for column, q in quantiles.items():
+            row[column] = digest.quantile(q)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['date', 'fee_digest'] + list(quantiles.keys()))
+
+## df with columns date, origin_key, fee_digest, price_usd (see DbConnector.get_fee_digests) -> df with columns day, metric_key, val
+## All chains are converted to usd and merged per day, so every tx has the same weight in the all-L2s quantiles.
+def get_merged_fee_quantiles_df(df:pd.DataFrame, quantiles:dict) -> pd.DataFrame:
+    df = df[df['price_usd'].notna()]
+    rows = []
+    for day, df_day in df.groupby('date'):
+        digest = TDigest.merge([TDigest.from_bytes(d).scale(p) for d, p in zip(df_day['fee_digest'], df_day['price_usd'])])
+        for metric_key, q in quantiles.items():
+            rows.append({'day': day, 'metric_key': metric_key, 'val': digest.quantile(q)})
+    return pd.DataFrame(rows, columns=['day', 'metric_key', 'val'])
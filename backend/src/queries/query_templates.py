@@ -0,0 +1,136 @@
+import re
+import hashlib
+import threading
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from src.misc.query_profiler import query_name, get_active_query_name
+
+## Query templates with bound parameters
+## The {{parameter}} placeholders of our SQL strings are compiled once into a sqlalchemy text() with bind params:
+##      '{{param}}'                 -> :param (string literal)
+##      interval '{{param}} days'   -> make_interval(days => CAST(:param AS int))
+##      {{param}}                   -> identifier (e.g. a column or table name), can't be bound and is substituted when the template is compiled.
+##                                     Only plain identifiers are accepted and every distinct value is its own compiled template.
+## Templates are executed as server-side prepared statements: the first execution on a pooled connection runs PREPARE,
+## all later executions on that connection only run EXECUTE and skip parse and plan. Statements the server lost (DISCARD, DEALLOCATE,
+## connection poolers) are prepared again on the first failed EXECUTE.
+
+literal_pattern = re.compile(r"'\{\{(\w+)\}\}'")
+interval_pattern = re.compile(r"interval '\{\{(\w+)\}\} days?'", re.IGNORECASE)
+identifier_pattern = re.compile(r"\{\{(\w+)\}\}")
+bind_pattern = re.compile(r"(?<![:\w]):(\w+)")
+
+class QueryTemplate():
+    def __init__(self, name:str, sql:str):
+        self.name = name
+        self.sql_raw = sql
+        self.compiled = {}
+        self.lock = threading.Lock()
+
+    ## returns (sql with :param binds, sql with $n placeholders for PREPARE, list of bind param names in $n order) for the given identifier values
+    def compile(self, identifiers:dict):
+        key = tuple(sorted(identifiers.items()))
+        with self.lock:
+            if key not in self.compiled:
+                sql = interval_pattern.sub(r"make_interval(days => CAST(:\1 AS int))", self.sql_raw)
+                sql = literal_pattern.sub(r":\1", sql)
+                for identifier, value in identifiers.items():
+                    if not re.fullmatch(r"\w+", str(value)):
+                        print(f"ERROR: {value} is not a valid identifier for {identifier} in template {self.name}")
+                        raise ValueError(f"{value} is not a valid identifier for {identifier} in template {self.name}")
+                    sql = sql.replace("{{" + identifier + "}}", str(value))
+                if identifier_pattern.search(sql):
+                    missing = identifier_pattern.findall(sql)
+                    print(f"ERROR: identifiers {missing} missing for template {self.name}")
+                    raise ValueError(f"identifiers {missing} missing for template {self.name}")
+
+                ## $n placeholders for PREPARE, quoted strings and casts (::date) are left alone
+                binds = []
+                def to_positional(match):
+                    if match.group(1) not in binds:
+                        binds.append(match.group(1))
+                    return f"${binds.index(match.group(1)) + 1}"
+                parts = re.split(r"('(?:[^']|'')*')", sql)
+                prepared_sql = ''.join(part if part.startswith("'") else bind_pattern.sub(to_positional, part) for part in parts)
+                self.compiled[key] = (sql, prepared_sql.strip().rstrip(';'), binds)
+            return self.compiled[key]
+
+    ## params that appear as {{param}} outside of quotes are treated as identifiers, all others are bound
+    def split_params(self, params:dict):
+        sql = interval_pattern.sub('', literal_pattern.sub('', self.sql_raw))
+        identifier_names = set(identifier_pattern.findall(sql))
+        identifiers = {k: v for k, v in params.items() if k in identifier_names}
+        binds = {k: v for k, v in params.items() if k not in identifier_names}
+        return identifiers, binds
+
+    ## the template name is appended to an outer query name (e.g. metric_key.origin_key of AdapterSQL) instead of replacing it
+    def execute(self, connection, params:dict=None, prepare:bool=True):
+        outer_name = get_active_query_name()
+        with query_name(self.name if outer_name is None else f"{outer_name}.{self.name}"):
+            return self._execute(connection, params, prepare)
+
+    def _execute(self, connection, params:dict=None, prepare:bool=True):
+        identifiers, binds = self.split_params(params or {})
+        sql, prepared_sql, bind_names = self.compile(identifiers)
+        if not prepare:
+            return connection.execute(text(sql), {k: binds[k] for k in bind_names})
+
+        ## prepared statements live as long as the DBAPI connection, the pool keeps the info dict of a connection across checkouts
+        statement_name = 'gtp_' + hashlib.md5(prepared_sql.encode()).hexdigest()[:16]
+        prepared = connection.connection.info.setdefault('prepared_statements', set())
+        try:
+            return self.execute_prepared(connection, statement_name, prepared_sql, bind_names, binds, prepared)
+        except DBAPIError as e:
+            ## invalid_sql_statement_name: the server doesn't know the statement anymore (DISCARD / DEALLOCATE or a pooler like pgbouncer
+            ## handed out another server connection), the bookkeeping is stale and the statement is prepared again
+            if getattr(e.orig, 'pgcode', None) != '26000':
+                raise e
+            print(f"...prepared statement of template {self.name} does not exist anymore, preparing it again")
+            prepared.discard(statement_name)
+            return self.execute_prepared(connection, statement_name, prepared_sql, bind_names, binds, prepared)
+
+    ## inside of an explicit transaction the EXECUTE runs in a savepoint, so a stale prepared statement doesn't abort the transaction
+    def execute_prepared(self, connection, statement_name:str, prepared_sql:str, bind_names:list, binds:dict, prepared:set):
+        if statement_name not in prepared:
+            connection.execution_options(no_parameters=True).exec_driver_sql(f"PREPARE {statement_name} AS {prepared_sql}")
+            prepared.add(statement_name)
+
+        if len(bind_names) == 0:
+            statement, params = text(f"EXECUTE {statement_name}"), {}
+        else:
+            args = ', '.join([f':{name}' for name in bind_names])
+            statement, params = text(f"EXECUTE {statement_name}({args})"), {name: binds[name] for name in bind_names}
+        if connection.in_transaction():
+            with connection.begin_nested():
+                return connection.execute(statement, params)
+        return connection.execute(statement, params)
+
+    def read_df(self, connection, params:dict=None, prepare:bool=True) -> pd.DataFrame:
+        result = self.execute(connection, params, prepare)
+        ## coerce_float: numeric columns come back as Decimal, pd.read_sql converted them to float64 as well
+        return pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()), coerce_float=True)
+
+## registry of named templates, registering the same name again returns the compiled template
+## templates without a name are looked up by their sql (e.g. the sql_q templates that SQLQuery objects are created with)
+templates = {}
+templates_by_sql = {}
+templates_lock = threading.Lock()
+
+def register_template(sql:str, name:str=None) -> QueryTemplate:
+    with templates_lock:
+        if name is None:
+            if sql in templates_by_sql:
+                return templates_by_sql[sql]
+            name = 'q_' + hashlib.md5(sql.encode()).hexdigest()[:12]
+        if name not in templates:
+            templates[name] = QueryTemplate(name, sql)
+            templates_by_sql.setdefault(sql, templates[name])
+        elif templates[name].sql_raw != sql:
+            print(f"ERROR: template {name} is already registered with a different sql")
+            raise ValueError(f"template {name} is already registered with a different sql")
+        return templates[name]
+
+def get_template(name:str) -> QueryTemplate:
+    return templates[name]
@@ -1,3 +1,5 @@
+from src.queries.query_templates import register_template
+
 sql_q= {
         ## profit usd
         'profit_usd': """
@@ -24,179 +26,6 @@ sql_q= {
 
         """
 
-        ## multichain users
-        ,'user_base_xxx': """
-        with raw_data as (   
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'arbitrum' as chain
-                FROM arbitrum_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL  '{{Days}} days')
-                
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'optimism' as chain
-                FROM optimism_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-                
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'polygon_zkevm' as chain
-                FROM polygon_zkevm_tx 
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'zksync_era' as chain
-                FROM zksync_era_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'base' as chain
-                FROM base_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'zora' as chain
-                FROM zora_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'gitcoin_pgn' as chain
-                FROM gitcoin_pgn_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'linea' as chain
-                FROM linea_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-                -- UNION ALL
-                
-                -- SELECT 
-                -- DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                -- from_address as address,
-                -- 'mantle' as chain
-                -- FROM mantle_tx
-                -- WHERE
-                -- block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                -- AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-                UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', block_timestamp) AS day,
-                from_address as address,
-                'scroll' as chain
-                FROM scroll_tx
-                WHERE
-                block_timestamp < DATE_TRUNC('{{aggregation}}', NOW())
-                AND block_timestamp >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-
-        -- IMX   
-        UNION ALL
-                
-                SELECT 
-                DATE_TRUNC('{{aggregation}}', "timestamp") AS day,
-                "user" as address,
-                'imx' as chain
-                FROM imx_deposits id 
-                WHERE
-                "timestamp" < DATE_TRUNC('{{aggregation}}', NOW())
-                AND "timestamp" >= DATE_TRUNC('{{aggregation}}', NOW() - INTERVAL '{{Days}} days')
-                
-        UNION ALL
-                
-                select 
-                        date_trunc('{{aggregation}}', "timestamp") as day 
-                        , "sender" as address
-                        , 'imx' as chain
-                from imx_withdrawals  
-                WHERE timestamp < date_trunc('{{aggregation}}', now())
-                        AND timestamp >= date_trunc('{{aggregation}}',now() - INTERVAL '{{Days}} days')
-
-        union all 
-        
-        select 
-                        date_trunc('{{aggregation}}', "updated_timestamp") as day 
-                        , "user" as address
-                        , 'imx' as chain
-                from imx_orders   
-                WHERE updated_timestamp < date_trunc('{{aggregation}}', now())
-                        AND updated_timestamp >= date_trunc('{{aggregation}}',now() - INTERVAL '{{Days}} days')
-                        
-        union all 
-        
-        select 
-                date_trunc('{{aggregation}}', "timestamp") as day
-                , "user" as address
-                , 'imx' as chain
-                from imx_transfers
-                WHERE timestamp < date_trunc('{{aggregation}}', now())
-                        AND timestamp >= date_trunc('{{aggregation}}',now() - INTERVAL '{{Days}} days')
-                
-        )
-        ,chain_info as (
-                SELECT 
-                day,
-                address,
-                CASE WHEN count(distinct chain) > 1 THEN 'multiple' ELSE MAX(chain) END as origin_key
-                FROM raw_data
-                GROUP BY 1,2
-        )
-
-        SELECT
-                day,
-                origin_key,
-                COUNT(DISTINCT address) AS val
-        FROM
-                chain_info
-        GROUP BY 1,2 
-        ORDER BY 1 DESC
-        """
-
 
         ### IMX
         ## count of all actions that have a transaction_id (not orders!)
@@ -339,438 +168,77 @@ sql_q= {
     """
 
 
-        ### Arbitrum
-        ,'arbitrum_txcount_raw': """
-        SELECT date_trunc('day', at2.block_timestamp) AS day,
-                count(*) AS value,
-                'arbitrum' AS origin_key
-        FROM arbitrum_tx at2
-        WHERE at2.gas_used > 0
-                AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', at2.block_timestamp))
-
-        """
-
-        ### OP Mainnet
-        ,'optimism_txcount_raw': """
-        SELECT date_trunc('day', ot.block_timestamp) AS day,
-                count(*) AS value,
-                'optimism' AS origin_key
-        FROM optimism_tx ot
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', ot.block_timestamp))
-        """
-
-        ### Base
-        ,'base_txcount_raw': """
-        SELECT date_trunc('day', bt.block_timestamp) AS day,
-                count(*) AS value,
-                'base' AS origin_key
-        FROM base_tx bt
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', bt.block_timestamp))
-        """
-
-        ### Polygon zkEVM
-        ,'polygon_zkevm_txcount_raw': """
-        SELECT date_trunc('day', pzt.block_timestamp) AS day,
-                count(*) AS value,
-                'polygon_zkevm' AS origin_key
-        FROM polygon_zkevm_tx pzt
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', pzt.block_timestamp))
-        """
-
-        ### zkSync Era
-        ,'zksync_era_txcount_raw': """
-        SELECT date_trunc('day', zet.block_timestamp) AS day,
-                count(*) AS value,
-                'zksync_era' AS origin_key
-        FROM zksync_era_tx zet
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', zet.block_timestamp))
-        """
-
-        ### Zora
-        ,'zora_txcount_raw': """
-        SELECT date_trunc('day', zt.block_timestamp) AS day,
-                count(*) AS value,
-                'zora' AS origin_key
-        FROM zora_tx zt
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', zt.block_timestamp))
-        """
-
-        ,'zora_fees_paid_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        zora_tx_filtered AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        SUM(tx_fee) AS total_tx_fee
-                FROM public.zora_tx
-                WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                z.day,
-                z.total_tx_fee * e.price_usd AS value
-        --,z.total_tx_fee AS fees_paid_eth
-        FROM zora_tx_filtered z
-        LEFT JOIN eth_price e ON z.day = e."date"
-        ORDER BY z.day DESC
-    """
-
-        ,'zora_txcount': """
-        SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(*) AS value
-        FROM public.zora_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-
-        ,'zora_daa': """
+        ### Chain daily rollup (chain_daily_rollup is refreshed incrementally from the {chain}_tx tables, see DbConnector.refresh_chain_daily_rollup)
+        ,'rollup_txcount_raw': """
         SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(distinct from_address) AS value 
-        FROM public.zora_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-
-        ,'zora_txcosts_median_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        zora_median AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY tx_fee) AS median_tx_fee
-                FROM public.zora_tx
-                WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                z.day,
-                z.median_tx_fee * e.price_usd as value
-                --,z.median_tx_fee as txcosts_median_eth
-        FROM zora_median z
-        LEFT JOIN eth_price e ON z.day = e."date"
-        ORDER BY z.day DESC
-    """
-
-        ### PGN
-        ,'pgn_fees_txcount_raw': """
-        SELECT date_trunc('day', gpt.block_timestamp) AS day,
-                count(*) AS value,
-                'gitcoin_pgn' AS origin_key
-        FROM gitcoin_pgn_tx gpt
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', gpt.block_timestamp))
+                "date" AS day,
+                txcount_raw AS value
+        FROM public.chain_daily_rollup
+        WHERE origin_key = '{{origin_key}}'
+                AND "date" >= current_date - interval '{{Days}} days'
+                AND "date" < current_date
+        ORDER BY 1 DESC
         """
 
-
-        ,'pgn_fees_paid_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        pgn_tx_filtered AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        SUM(tx_fee) AS total_tx_fee
-                FROM public.gitcoin_pgn_tx
-                WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                pgn.day,
-                pgn.total_tx_fee * e.price_usd AS value
-        --,pgn.total_tx_fee AS fees_paid_eth
-        FROM pgn_tx_filtered pgn
-        LEFT JOIN eth_price e ON pgn.day = e."date"
-        ORDER BY pgn.day DESC
-    """
-
-    ,'pgn_txcount': """
+        ,'rollup_txcount': """
         SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(*) AS value
-        FROM public.gitcoin_pgn_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-
-    ,'pgn_daa': """
-        SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(distinct from_address) AS value 
-        FROM public.gitcoin_pgn_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-
-    ,'pgn_txcosts_median_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        pgn_median AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY tx_fee) AS median_tx_fee
-                FROM public.gitcoin_pgn_tx
-                WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                pgn.day,
-                pgn.median_tx_fee * e.price_usd as value
-                --,pgn.median_tx_fee as txcosts_median_eth
-        FROM pgn_median pgn
-        LEFT JOIN eth_price e ON pgn.day = e."date"
-        ORDER BY pgn.day DESC
-    """
-
-        ### Linea
-        ,'linea_txcount_raw': """
-        SELECT date_trunc('day', linea_tx.block_timestamp) AS day,
-                count(*) AS value,
-                'linea' AS origin_key
-        FROM linea_tx
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', linea_tx.block_timestamp))
+                "date" AS day,
+                txcount AS value
+        FROM public.chain_daily_rollup
+        WHERE origin_key = '{{origin_key}}'
+                AND "date" >= current_date - interval '{{Days}} days'
+                AND "date" < current_date
+        ORDER BY 1 DESC
         """
 
-    ,'linea_txcount': """
+        ,'rollup_daa': """
         SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(*) AS value
-        FROM public.linea_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-
-    ,'linea_fees_paid_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        linea_tx_filtered AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        SUM(tx_fee) AS total_tx_fee
-                FROM public.linea_tx
-                WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                z.day,
-                z.total_tx_fee * e.price_usd AS value
-        --,z.total_tx_fee AS fees_paid_eth
-        FROM linea_tx_filtered z
-        LEFT JOIN eth_price e ON z.day = e."date"
-        ORDER BY z.day DESC
-    """
-
-    ,'linea_daa': """
-        SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(distinct from_address) AS value 
-        FROM public.linea_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-
-    ,'linea_txcosts_median_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        linea_median AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY tx_fee) AS median_tx_fee
-                FROM public.linea_tx
-                WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                z.day,
-                z.median_tx_fee * e.price_usd as value
-                --,z.median_tx_fee as txcosts_median_eth
-        FROM linea_median z
-        LEFT JOIN eth_price e ON z.day = e."date"
-        ORDER BY z.day DESC
-   """
-
-        ### Mantle
-        ,'mantle_txcount_raw': """
-        SELECT date_trunc('day', mt.block_timestamp) AS day,
-                count(*) AS value,
-                'mantle' AS origin_key
-        FROM mantle_tx mt
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', mt.block_timestamp))
+                "date" AS day,
+                daa AS value
+        FROM public.chain_daily_rollup
+        WHERE origin_key = '{{origin_key}}'
+                AND "date" >= current_date - interval '{{Days}} days'
+                AND "date" < current_date
+        ORDER BY 1 DESC
         """
 
-        ,'mantle_fees_paid_usd': """
-        WITH mnt_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'MNT' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        mantle_tx_filtered AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        SUM(tx_fee) AS total_tx_fee
-                FROM public.mantle_tx
-                WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                mantle.day,
-                mantle.total_tx_fee * e.price_usd AS value
-        --,mantle.total_tx_fee AS fees_paid_mnt
-        FROM mantle_tx_filtered mantle
-        LEFT JOIN mnt_price e ON mantle.day = e."date"
-        ORDER BY mantle.day DESC
-    """
-        ,'mantle_txcount': """
+        ## fees and tx costs are stored in the native gas token of the chain (ETH or MNT for Mantle)
+        ,'rollup_fees_paid_usd': """
         SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(*) AS value
-        FROM public.mantle_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-        ,'mantle_daa': """
-        SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(distinct from_address) AS value 
-        FROM public.mantle_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-        ,'mantle_txcosts_median_usd': """
-        WITH mnt_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'MNT' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        mantle_median AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY tx_fee) AS median_tx_fee
-                FROM public.mantle_tx
-                WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                mantle.day,
-                mantle.median_tx_fee * e.price_usd as value
-                --,mantle.median_tx_fee as txcosts_median_mnt
-        FROM mantle_median mantle
-        LEFT JOIN mnt_price e ON mantle.day = e."date"
-        ORDER BY mantle.day DESC
-    """
-
-    # Scroll
-        ,'scroll_txcount_raw': """
-        SELECT date_trunc('day', st.block_timestamp) AS day,
-                count(*) AS value,
-                'scroll' AS origin_key
-        FROM scroll_tx st
-        WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY (date_trunc('day', st.block_timestamp))
+                r."date" AS day,
+                r.fees_paid * p.price_usd AS value
+        FROM public.chain_daily_rollup r
+        LEFT JOIN public.prices_daily p ON r."date" = p."date" AND p.token_symbol = '{{token_symbol}}'
+        WHERE r.origin_key = '{{origin_key}}'
+                AND r."date" >= current_date - interval '{{Days}} days'
+                AND r."date" < current_date
+        ORDER BY 1 DESC
         """
 
-        ,'scroll_txcount': """
+        ## {{column}} is one of the fee quantiles that are derived from the fee digests: txcosts_median, txcosts_p10, txcosts_p90
+        ,'rollup_txcosts_usd': """
         SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(*) AS value
-        FROM public.scroll_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
+                r."date" AS day,
+                r.{{column}} * p.price_usd AS value
+        FROM public.chain_daily_rollup r
+        LEFT JOIN public.prices_daily p ON r."date" = p."date" AND p.token_symbol = '{{token_symbol}}'
+        WHERE r.origin_key = '{{origin_key}}'
+                AND r."date" >= current_date - interval '{{Days}} days'
+                AND r."date" < current_date
+        ORDER BY 1 DESC
         """
 
-        ,'scroll_fees_paid_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        scroll_tx_filtered AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        SUM(tx_fee) AS total_tx_fee
-                FROM public.scroll_tx
-                WHERE block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                z.day,
-                z.total_tx_fee * e.price_usd AS value
-        FROM scroll_tx_filtered z
-        LEFT JOIN eth_price e ON z.day = e."date"
-        ORDER BY z.day DESC
-    """
-
-    ,'scroll_daa': """
-        SELECT 
-                DATE_TRUNC('day', block_timestamp) AS day,
-                COUNT(distinct from_address) AS value 
-        FROM public.scroll_tx
-        WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        GROUP BY 1
-        order by 1 DESC
-    """
-
-    ,'scroll_txcosts_median_usd': """
-        WITH eth_price AS (
-                SELECT "date", price_usd
-                FROM public.prices_daily
-                WHERE token_symbol = 'ETH' AND "date" BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-        ),
-        scroll_median AS (
-                SELECT
-                        date_trunc('day', "block_timestamp") AS day,
-                        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY tx_fee) AS median_tx_fee
-                FROM public.scroll_tx
-                WHERE gas_price <> 0 AND block_timestamp BETWEEN date_trunc('day', now()) - interval '{{Days}} days' AND date_trunc('day', now())
-                GROUP BY 1
-        )
-        SELECT
-                z.day,
-                z.median_tx_fee * e.price_usd as value
-        FROM scroll_median z
-        LEFT JOIN eth_price e ON z.day = e."date"
-        ORDER BY z.day DESC
-   """
-
 }
 
+## all sql_q queries are registered as named query templates
+for name, sql in sql_q.items():
+    register_template(sql, name)
 
 class SQLObject():
+    ## runs the query as a prepared statement with bound parameters (see src/queries/query_templates.py), self.sql is only kept for logging
+    def read_df(self, connection):
+        return register_template(self.sql_raw).read_df(connection, self.query_parameters)
+
     ## replace_query_parameters
     def replace_query_parameters(self, sql: str, query_parameters: dict) -> str:
         for key, value in query_parameters.items():
@@ -793,12 +261,23 @@ class SQLQuery(SQLObject):
         self.last_token = None
         self.last_execution_loaded = None
 
+## chains whose KPIs are derived from chain_daily_rollup (they need a {chain}_tx table)
+rollup_chains = ['arbitrum', 'optimism', 'base', 'polygon_zkevm', 'zksync_era', 'zora', 'gitcoin_pgn', 'linea', 'mantle', 'scroll']
+
+## chains that count for the multichain user base (mantle is rolled up, but not part of the user base, same as before the sketches)
+user_base_chains = [chain for chain in rollup_chains if chain != 'mantle'] + ['imx']
+
+## multichain user base is derived from the per chain and day HLL sketches in chain_daily_hll (see src/misc/sketches.py)
+## metric_key: (aggregation, days that are loaded with days = 'auto')
+user_base_metrics = {
+    'user_base_daily': ('day', 7),
+    'user_base_weekly': ('week', 7*4),
+    'user_base_monthly': ('month', 60),
+}
+
 sql_queries = [
     ## Multichain
     SQLQuery(metric_key = "profit_usd", origin_key = "multi", sql=sql_q["profit_usd"], query_parameters={"Days": 7})
-    # ,SQLQuery(metric_key = "user_base_daily", origin_key = "multi", sql=sql_q["user_base_xxx"], query_parameters={"Days": 7, "aggregation": "day"})
-    ,SQLQuery(metric_key = "user_base_weekly", origin_key = "multi", sql=sql_q["user_base_xxx"], query_parameters={"Days": 7*4, "aggregation": "week"})
-    # ,SQLQuery(metric_key = "user_base_monthly", origin_key = "multi", sql=sql_q["user_base_xxx"], query_parameters={"Days": 7*4*12, "aggregation": "month"})
 
 
     ## IMX
@@ -808,53 +287,62 @@ sql_queries = [
     ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "imx", sql=sql_q["imx_fees_paid_usd"], query_parameters={"Days": 7})
 
     ## Arbitrum
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "arbitrum", sql=sql_q["arbitrum_txcount_raw"], query_parameters={"Days": 30})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "arbitrum", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "arbitrum"})
 
     ## OP Mainnet
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "optimism", sql=sql_q["optimism_txcount_raw"], query_parameters={"Days": 30})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "optimism", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "optimism"})
 
     ## Base
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "base", sql=sql_q["base_txcount_raw"], query_parameters={"Days": 30})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "base", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "base"})
 
     ## Polygon zkEVM
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "polygon_zkevm", sql=sql_q["polygon_zkevm_txcount_raw"], query_parameters={"Days": 30})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "polygon_zkevm", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "polygon_zkevm"})
 
     ## zkSync Era
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "zksync_era", sql=sql_q["zksync_era_txcount_raw"], query_parameters={"Days": 30})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "zksync_era", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "zksync_era"})
 
     ## Zora
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "zora", sql=sql_q["zora_txcount_raw"], query_parameters={"Days": 30})
-    ,SQLQuery(metric_key = "txcount", origin_key = "zora", sql=sql_q["zora_txcount"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "daa", origin_key = "zora", sql=sql_q["zora_daa"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "zora", sql=sql_q["zora_fees_paid_usd"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "zora", sql=sql_q["zora_txcosts_median_usd"], query_parameters={"Days": 7})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "zora", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "zora"})
+    ,SQLQuery(metric_key = "txcount", origin_key = "zora", sql=sql_q["rollup_txcount"], query_parameters={"Days": 7, "origin_key": "zora"})
+    ,SQLQuery(metric_key = "daa", origin_key = "zora", sql=sql_q["rollup_daa"], query_parameters={"Days": 7, "origin_key": "zora"})
+    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "zora", sql=sql_q["rollup_fees_paid_usd"], query_parameters={"Days": 7, "origin_key": "zora", "token_symbol": "ETH"})
+    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "zora", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "zora", "token_symbol": "ETH", "column": "txcosts_median"})
+    ,SQLQuery(metric_key = "txcosts_p10_usd", origin_key = "zora", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "zora", "token_symbol": "ETH", "column": "txcosts_p10"})
+    ,SQLQuery(metric_key = "txcosts_p90_usd", origin_key = "zora", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "zora", "token_symbol": "ETH", "column": "txcosts_p90"})
 
     ## PGN
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "gitcoin_pgn", sql=sql_q["pgn_fees_txcount_raw"], query_parameters={"Days": 30})
-    ,SQLQuery(metric_key = "txcount", origin_key = "gitcoin_pgn", sql=sql_q["pgn_txcount"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "daa", origin_key = "gitcoin_pgn", sql=sql_q["pgn_daa"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "gitcoin_pgn", sql=sql_q["pgn_fees_paid_usd"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "gitcoin_pgn", sql=sql_q["pgn_txcosts_median_usd"], query_parameters={"Days": 7})
-    
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "gitcoin_pgn", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "gitcoin_pgn"})
+    ,SQLQuery(metric_key = "txcount", origin_key = "gitcoin_pgn", sql=sql_q["rollup_txcount"], query_parameters={"Days": 7, "origin_key": "gitcoin_pgn"})
+    ,SQLQuery(metric_key = "daa", origin_key = "gitcoin_pgn", sql=sql_q["rollup_daa"], query_parameters={"Days": 7, "origin_key": "gitcoin_pgn"})
+    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "gitcoin_pgn", sql=sql_q["rollup_fees_paid_usd"], query_parameters={"Days": 7, "origin_key": "gitcoin_pgn", "token_symbol": "ETH"})
+    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "gitcoin_pgn", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "gitcoin_pgn", "token_symbol": "ETH", "column": "txcosts_median"})
+    ,SQLQuery(metric_key = "txcosts_p10_usd", origin_key = "gitcoin_pgn", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "gitcoin_pgn", "token_symbol": "ETH", "column": "txcosts_p10"})
+    ,SQLQuery(metric_key = "txcosts_p90_usd", origin_key = "gitcoin_pgn", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "gitcoin_pgn", "token_symbol": "ETH", "column": "txcosts_p90"})
+
     ## Linea
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "linea", sql=sql_q["linea_txcount_raw"], query_parameters={"Days": 30})
-    ,SQLQuery(metric_key = "txcount", origin_key = "linea", sql=sql_q["linea_txcount"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "daa", origin_key = "linea", sql=sql_q["linea_daa"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "linea", sql=sql_q["linea_fees_paid_usd"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "linea", sql=sql_q["linea_txcosts_median_usd"], query_parameters={"Days": 7})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "linea", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "linea"})
+    ,SQLQuery(metric_key = "txcount", origin_key = "linea", sql=sql_q["rollup_txcount"], query_parameters={"Days": 7, "origin_key": "linea"})
+    ,SQLQuery(metric_key = "daa", origin_key = "linea", sql=sql_q["rollup_daa"], query_parameters={"Days": 7, "origin_key": "linea"})
+    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "linea", sql=sql_q["rollup_fees_paid_usd"], query_parameters={"Days": 7, "origin_key": "linea", "token_symbol": "ETH"})
+    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "linea", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "linea", "token_symbol": "ETH", "column": "txcosts_median"})
+    ,SQLQuery(metric_key = "txcosts_p10_usd", origin_key = "linea", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "linea", "token_symbol": "ETH", "column": "txcosts_p10"})
+    ,SQLQuery(metric_key = "txcosts_p90_usd", origin_key = "linea", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "linea", "token_symbol": "ETH", "column": "txcosts_p90"})
 
     ## Mantle
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "mantle", sql=sql_q["mantle_txcount_raw"], query_parameters={"Days": 30})
-    ,SQLQuery(metric_key = "txcount", origin_key = "mantle", sql=sql_q["mantle_txcount"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "daa", origin_key = "mantle", sql=sql_q["mantle_daa"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "mantle", sql=sql_q["mantle_txcosts_median_usd"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "mantle", sql=sql_q["mantle_fees_paid_usd"], query_parameters={"Days": 7})
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "mantle", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "mantle"})
+    ,SQLQuery(metric_key = "txcount", origin_key = "mantle", sql=sql_q["rollup_txcount"], query_parameters={"Days": 7, "origin_key": "mantle"})
+    ,SQLQuery(metric_key = "daa", origin_key = "mantle", sql=sql_q["rollup_daa"], query_parameters={"Days": 7, "origin_key": "mantle"})
+    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "mantle", sql=sql_q["rollup_fees_paid_usd"], query_parameters={"Days": 7, "origin_key": "mantle", "token_symbol": "MNT"})
+    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "mantle", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "mantle", "token_symbol": "MNT", "column": "txcosts_median"})
+    ,SQLQuery(metric_key = "txcosts_p10_usd", origin_key = "mantle", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "mantle", "token_symbol": "MNT", "column": "txcosts_p10"})
+    ,SQLQuery(metric_key = "txcosts_p90_usd", origin_key = "mantle", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "mantle", "token_symbol": "MNT", "column": "txcosts_p90"})
 
     ## Scroll
-    ,SQLQuery(metric_key = "txcount_raw", origin_key = "scroll", sql=sql_q["scroll_txcount_raw"], query_parameters={"Days": 30})
-    ,SQLQuery(metric_key = "txcount", origin_key = "scroll", sql=sql_q["scroll_txcount"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "daa", origin_key = "scroll", sql=sql_q["scroll_daa"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "scroll", sql=sql_q["scroll_fees_paid_usd"], query_parameters={"Days": 7})
-    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "scroll", sql=sql_q["scroll_txcosts_median_usd"], query_parameters={"Days": 7})
-   
+    ,SQLQuery(metric_key = "txcount_raw", origin_key = "scroll", sql=sql_q["rollup_txcount_raw"], query_parameters={"Days": 30, "origin_key": "scroll"})
+    ,SQLQuery(metric_key = "txcount", origin_key = "scroll", sql=sql_q["rollup_txcount"], query_parameters={"Days": 7, "origin_key": "scroll"})
+    ,SQLQuery(metric_key = "daa", origin_key = "scroll", sql=sql_q["rollup_daa"], query_parameters={"Days": 7, "origin_key": "scroll"})
+    ,SQLQuery(metric_key = "fees_paid_usd", origin_key = "scroll", sql=sql_q["rollup_fees_paid_usd"], query_parameters={"Days": 7, "origin_key": "scroll", "token_symbol": "ETH"})
+    ,SQLQuery(metric_key = "txcosts_median_usd", origin_key = "scroll", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "scroll", "token_symbol": "ETH", "column": "txcosts_median"})
+    ,SQLQuery(metric_key = "txcosts_p10_usd", origin_key = "scroll", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "scroll", "token_symbol": "ETH", "column": "txcosts_p10"})
+    ,SQLQuery(metric_key = "txcosts_p90_usd", origin_key = "scroll", sql=sql_q["rollup_txcosts_usd"], query_parameters={"Days": 7, "origin_key": "scroll", "token_symbol": "ETH", "column": "txcosts_p90"})
 ]
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.api.json_creation import JSONCreation
+
+## Benchmark of the per chain x metric steps of the chain and metric details jsons on a synthetic fact_kpis frame
+## (all metrics of JSONCreation, n_chains chains, n_years of daily values). The daily list, the 7d rolling average and the change
+## percentages are compared with the former implementations that mask and pivot the full df for every pair (daily_list_rows,
+## rolling_avg_rows, changes_rows).
+##
+## Run from the backend folder: python tests/benchmark_json_creation.py [n_chains] [n_years]
+
+def get_synthetic_df(metric_keys:list, n_chains:int, n_years:int, seed:int=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2021-01-01', periods=365 * n_years, tz='UTC')
+    dfs = []
+    for i in range(n_chains):
+        ## chains launched at different times, so the series have different lengths
+        chain_dates = dates[int(rng.integers(0, len(dates) // 2)):]
+        for mk in metric_keys:
+            dfs.append(pd.DataFrame({'metric_key': mk, 'origin_key': f'chain_{i}', 'date': chain_dates, 'value': rng.lognormal(8, 2, len(chain_dates))}))
+    df = pd.concat(dfs, ignore_index=True)
+    df['unix'] = df['date'].apply(lambda x: x.timestamp() * 1000)
+    return df
+
+def daily_list_rows(json_creation, df, metric_id, origin_key):
+    mks = json_creation.metrics[metric_id]['metric_keys']
+    df_tmp = df.loc[(df.origin_key==origin_key) & (df.metric_key.isin(mks)), ["unix", "value", "metric_key"]].pivot(index='unix', columns='metric_key', values='value').reset_index()
+    df_tmp.sort_values(by=['unix'], inplace=True, ascending=True)
+    df_tmp = json_creation.df_rename(df_tmp, metric_id, True)
+    return [[int(i[0]), *i[1:]] for i in df_tmp.values.tolist()], df_tmp.columns.to_list()
+
+def rolling_avg_rows(list_of_lists):
+    avg_list = []
+    if len(list_of_lists[0]) == 2:
+        for i in range(len(list_of_lists)):
+            if i < 7:
+                avg_list.append([list_of_lists[i][0], list_of_lists[i][1]])
+            else:
+                avg = (list_of_lists[i][1] + list_of_lists[i-1][1] + list_of_lists[i-2][1] + list_of_lists[i-3][1] + list_of_lists[i-4][1] + list_of_lists[i-5][1] + list_of_lists[i-6][1]) / 7
+                avg_list.append([list_of_lists[i][0], round(avg, 2)])
+    else:
+        for i in range(len(list_of_lists)):
+            if i < 7:
+                avg_list.append([list_of_lists[i][0], list_of_lists[i][1], list_of_lists[i][2]])
+            else:
+                avg_1 = (list_of_lists[i][1] + list_of_lists[i-1][1] + list_of_lists[i-2][1] + list_of_lists[i-3][1] + list_of_lists[i-4][1] + list_of_lists[i-5][1] + list_of_lists[i-6][1]) / 7
+                avg_2 = (list_of_lists[i][2] + list_of_lists[i-1][2] + list_of_lists[i-2][2] + list_of_lists[i-3][2] + list_of_lists[i-4][2] + list_of_lists[i-5][2] + list_of_lists[i-6][2]) / 7
+                avg_list.append([list_of_lists[i][0], avg_1, avg_2])
+    return avg_list
+
+def changes_rows(json_creation, df, metric_id, origin_key):
+    df_tmp = df.loc[(df.origin_key==origin_key) & (df.metric_key.isin(json_creation.metrics[metric_id]['metric_keys'])), ["date", "value", "metric_key"]].pivot(index='date', columns='metric_key', values='value')
+    df_tmp.sort_values(by=['date'], inplace=True, ascending=False)
+    changes_dict = {'types': [], '1d': [], '7d': [], '30d': [], '90d': [], '180d': [], '365d': []}
+    for mk in json_creation.metrics[metric_id]['metric_keys']:
+        cur_val = df_tmp[mk].iloc[0]
+        for change in [1, 7, 30, 90, 180, 365]:
+            prev_val = df_tmp[mk].iloc[change] if df_tmp[mk].shape[0] > change else 0
+            if prev_val == 0 or prev_val < 0 or cur_val < 0:
+                change_val = None
+            else:
+                change_val = round((cur_val - prev_val) / prev_val, 4)
+            changes_dict[f'{change}d'].append(change_val)
+    changes_dict['types'] = json_creation.df_rename(df_tmp, metric_id).columns.to_list()
+    return changes_dict
+
+def timed(timings:dict, step:str, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    timings[step] = timings.get(step, 0) + time.perf_counter() - start
+    return result
+
+def run(n_chains:int=30, n_years:int=4):
+    json_creation = JSONCreation(None, None, None, 'v1')
+    df = get_synthetic_df(json_creation.metrics_list, n_chains, n_years)
+    print(f"...synthetic fact_kpis: {df.shape[0]} rows, {n_chains} chains, {n_years} years, {len(json_creation.metrics)} metrics")
+
+    timings = {}
+    timed(timings, 'get_cube', json_creation.get_cube, df)
+    for origin_key in df['origin_key'].unique():
+        for metric_id in json_creation.metrics:
+            mk_list_int, _ = timed(timings, 'generate_daily_list', json_creation.generate_daily_list, df, metric_id, origin_key)
+            mk_list_rows, _ = timed(timings, 'daily_list_rows', daily_list_rows, json_creation, df, metric_id, origin_key)
+            timed(timings, 'generate_7d_rolling_avg', json_creation.generate_7d_rolling_avg, df, metric_id, origin_key, mk_list_int)
+            timed(timings, 'rolling_avg_rows', rolling_avg_rows, mk_list_rows)
+            timed(timings, 'create_changes_dict', json_creation.create_changes_dict, df, metric_id, origin_key)
+            timed(timings, 'changes_rows', changes_rows, json_creation, df, metric_id, origin_key)
+
+    for step, runtime in timings.items():
+        print(f"{step:<24}{runtime:8.3f}s")
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
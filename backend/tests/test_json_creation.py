@@ -0,0 +1,48 @@
+import os
+import json
+
+import pandas as pd
+import pytest
+
+from src.api.json_creation import JSONCreation
+
+## json_creation_golden.json holds synthetic fact_kpis series (zeros, negative values, series shorter than 7 and 365 days)
+## and the 7d rolling averages and changes dicts that the former row by row implementation created for them.
+## The outputs are compared as json strings, so the floats have to match exactly.
+
+fixture_path = os.path.join(os.path.dirname(__file__), 'fixtures', 'json_creation_golden.json')
+
+with open(fixture_path, 'r') as f:
+    golden = json.load(f)
+
+@pytest.fixture(scope='module')
+def json_creation():
+    return JSONCreation(None, None, None, 'v1')
+
+@pytest.fixture(scope='module')
+def df():
+    dfs = []
+    for series in golden['series']:
+        dfs.append(pd.DataFrame({
+            'metric_key': series['metric_key'],
+            'origin_key': series['origin_key'],
+            'date': pd.date_range(series['start'], periods=len(series['values']), tz='UTC'),
+            'value': series['values'],
+        }))
+    df = pd.concat(dfs, ignore_index=True)
+    df['unix'] = df['date'].apply(lambda x: x.timestamp() * 1000)
+    return df
+
+@pytest.mark.parametrize('expected', golden['expected'], ids=lambda x: f"{x['origin_key']}-{x['metric_id']}")
+def test_create_7d_rolling_avg(json_creation, df, expected):
+    mk_list_int, _ = json_creation.generate_daily_list(df, expected['metric_id'], expected['origin_key'])
+    assert json.dumps(json_creation.create_7d_rolling_avg(mk_list_int)) == json.dumps(expected['rolling_avg'])
+
+@pytest.mark.parametrize('expected', golden['expected'], ids=lambda x: f"{x['origin_key']}-{x['metric_id']}")
+def test_generate_7d_rolling_avg(json_creation, df, expected):
+    mk_list_int, _ = json_creation.generate_daily_list(df, expected['metric_id'], expected['origin_key'])
+    assert json.dumps(json_creation.generate_7d_rolling_avg(df, expected['metric_id'], expected['origin_key'], mk_list_int)) == json.dumps(expected['rolling_avg'])
+
+@pytest.mark.parametrize('expected', golden['expected'], ids=lambda x: f"{x['origin_key']}-{x['metric_id']}")
+def test_create_changes_dict(json_creation, df, expected):
+    assert json.dumps(json_creation.create_changes_dict(df, expected['metric_id'], expected['origin_key'])) == json.dumps(expected['changes'])
@@ -0,0 +1,91 @@
+import io
+import os
+
+import pytest
+
+moto = pytest.importorskip('moto')
+import boto3
+import pandas as pd
+
+from src.misc import json_publisher
+from src.misc.json_publisher import JSONPublisher
+
+## JSONPublisher against moto's in-memory S3 and CloudFront
+
+bucket = 'gtp-test'
+
+@pytest.fixture()
+def aws(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('S3_ENDPOINT_URL', raising=False)
+    monkeypatch.delenv('JSON_CONTENT_ENCODING', raising=False)
+    monkeypatch.delenv('JSON_COMPRESSED_VARIANTS', raising=False)
+    ## the shared clients must be created inside of the mock
+    monkeypatch.setattr(json_publisher, '_clients', {})
+    with moto.mock_s3(), moto.mock_cloudfront():
+        boto3.client('s3').create_bucket(Bucket=bucket)
+        res = boto3.client('cloudfront').create_distribution(DistributionConfig={
+            'CallerReference': 'gtp-test',
+            'Comment': '',
+            'Enabled': True,
+            'Origins': {'Quantity': 1, 'Items': [{'Id': 's3', 'DomainName': f'{bucket}.s3.amazonaws.com', 'S3OriginConfig': {'OriginAccessIdentity': ''}}]},
+            'DefaultCacheBehavior': {'TargetOriginId': 's3', 'ViewerProtocolPolicy': 'allow-all'},
+        })
+        yield res['Distribution']['Id']
+
+def test_publish_uploads_and_skips_unchanged(aws):
+    publisher = JSONPublisher(bucket, aws)
+    assert publisher.publish('v1/chains/arbitrum', {'data': [1, 2, 3]}).result() == True
+    assert len(publisher.flush()) == 1
+    assert boto3.client('s3').get_object(Bucket=bucket, Key='v1/chains/arbitrum.json')['Body'].read() == b'{"data":[1,2,3]}'
+
+    ## unchanged: no upload and no invalidation
+    assert publisher.publish('v1/chains/arbitrum', {'data': [1, 2, 3]}).result() == False
+    assert publisher.flush() == []
+
+    assert publisher.publish('v1/chains/arbitrum', {'data': [1, 2, 4]}).result() == True
+    assert len(publisher.flush()) == 1
+
+def test_multipart_upload(aws):
+    publisher = JSONPublisher(bucket, aws)
+    body = os.urandom(20 * 1024 * 1024)
+    assert publisher.submit(bucket, 'v1/large.bin', body, 'application/octet-stream', invalidate=False).result() == True
+    publisher.flush()
+
+    res = boto3.client('s3').head_object(Bucket=bucket, Key='v1/large.bin')
+    ## the ETag of multipart uploads is not the md5 of the object, the skip check relies on the md5 metadata
+    assert '-' in res['ETag']
+    assert res['ContentLength'] == len(body)
+    assert publisher.submit(bucket, 'v1/large.bin', body, 'application/octet-stream', invalidate=False).result() == False
+    publisher.flush()
+
+def test_variants_are_checked_on_their_own(aws):
+    publisher = JSONPublisher(bucket, aws, variants=['gzip', 'br'])
+    assert publisher.publish('v1/master', {'chains': ['arbitrum']}).result() == True
+    publisher.flush()
+
+    ## a missing variant is uploaded again although the json is unchanged, the other objects are left alone
+    boto3.client('s3').delete_object(Bucket=bucket, Key='v1/master.json.br')
+    assert publisher.publish('v1/master', {'chains': ['arbitrum']}).result() == True
+    assert publisher.changed_paths == ['/v1/master.json.br']
+    publisher.flush()
+    assert boto3.client('s3').head_object(Bucket=bucket, Key='v1/master.json.br')['ContentEncoding'] == 'br'
+
+    assert publisher.publish('v1/master', {'chains': ['arbitrum']}).result() == False
+    assert publisher.flush() == []
+
+def test_publish_parquet_with_max_pending(aws):
+    publisher = JSONPublisher(bucket, aws, max_pending=1)
+    df = pd.DataFrame({'block_number': [1, 2, 3], 'value': [0.1, 0.2, 0.3]})
+    ## submit blocks until the previous upload is done, the parquet files are never invalidated
+    futures = [publisher.publish_parquet(f'optimism/optimism_tx_{i}', df) for i in range(3)]
+    assert [future.result() for future in futures] == [True, True, True]
+    assert publisher.changed_paths == []
+    publisher.flush()
+    body = boto3.client('s3').get_object(Bucket=bucket, Key='optimism/optimism_tx_0.parquet')['Body'].read()
+    assert pd.read_parquet(io.BytesIO(body)).equals(df)
+
+    assert publisher.publish_parquet('optimism/optimism_tx_0', df).result() == False
+    publisher.flush()